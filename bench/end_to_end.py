@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+"""Benchmark the lambda and the worker end to end, against in-process stand-ins.
+
+Each task gets its own run: synthetic inputs are put in a stand-in s3, an s3
+event for them goes through `lambda.main` into a stand-in sqs queue, and a
+worker made by `docker/main.py` from the same environment variables as the
+container works through the queue. External tools are fast stubs, except
+`pdal` when it is on the path (unless `--stub-pdal`):
+
+    bench/end_to_end.py --count 20 --size 50 --output results.json \\
+        --baseline baseline.json
+
+With `--inline`, the lambda runs the jobs its task registry allows itself,
+as it does when deployed with the `magic_bucket` package; `pdal-info` runs
+in header mode then, the only mode that needs no tools.
+
+Reports objects and bytes per second, phase and job latency percentiles,
+and the peak RSS of the task's tools and peak disk use of the work
+directories. Results are saved as JSON, and compared to a `--baseline` saved
+from an earlier run.
+"""
+
+import argparse
+import distutils.spawn
+import imp
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "docker"))
+
+import standins
+from main import create_worker
+from magic_bucket.metrics import percentile
+from magic_bucket.task.ape_near_field_prcs import ApeNearFieldPrcs
+
+MB = 1024 * 1024
+BUCKET = "magic-bucket-bench"
+TASKS = ["pdal-info", "pdal-translate", "rimtatls", "ape-near-field-prcs"]
+
+
+class ListSink(object):
+    """Keeps the worker's metrics records."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def emit(self, record):
+        with self.lock:
+            self.records.append(record)
+
+
+class DiskSampler(object):
+    """Samples the bytes under a directory, keeping the peak."""
+
+    def __init__(self, directory, interval=0.1):
+        self.directory = directory
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="disk-sampler")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            size = 0
+            for directory, _, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    try:
+                        size += os.lstat(
+                            os.path.join(directory, filename)).st_size
+                    except OSError:
+                        pass
+            self.peak = max(self.peak, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", nargs="+", default=TASKS, choices=TASKS)
+    parser.add_argument("--count", type=int, default=10,
+                        help="objects per task")
+    parser.add_argument("--size", type=float, default=10,
+                        help="object size in MB")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--download-concurrency", type=int, default=2)
+    parser.add_argument("--upload-concurrency", type=int, default=2)
+    parser.add_argument("--stub-pdal", action="store_true",
+                        help="use the pdal stub even if pdal is installed")
+    parser.add_argument("--inline", action="store_true",
+                        help="let the lambda run small jobs itself, as the "
+                        "task registry allows")
+    parser.add_argument("--output", help="JSON file to save results to")
+    parser.add_argument("--baseline", help="JSON results to compare to")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    logging.getLogger("magic-bucket").setLevel(
+        logging.INFO if args.verbose else logging.WARNING)
+
+    directory = tempfile.mkdtemp(prefix="magic-bucket-bench-")
+    try:
+        real_pdal = (not args.stub_pdal and
+                     distutils.spawn.find_executable("pdal") is not None)
+        bin_directory = os.path.join(directory, "bin")
+        os.mkdir(bin_directory)
+        ape = standins.write_stub_tools(bin_directory, real_pdal)
+        os.environ["PATH"] = bin_directory + os.pathsep + os.environ["PATH"]
+        if not os.path.exists(ApeNearFieldPrcs.APE):
+            ApeNearFieldPrcs.APE = ape
+            ApeNearFieldPrcs.TOOLS = ["pdal", ape]
+        lambda_module = load_lambda()
+        # The lambda logs everything at INFO on the root logger.
+        logging.getLogger().setLevel(
+            logging.INFO if args.verbose else logging.WARNING)
+
+        results = {
+            "time": time.time(),
+            "settings": {"count": args.count, "size": args.size,
+                         "concurrency": args.concurrency,
+                         "download_concurrency": args.download_concurrency,
+                         "upload_concurrency": args.upload_concurrency,
+                         "real_pdal": real_pdal, "inline": args.inline},
+            "tasks": {},
+        }
+        for task in args.tasks:
+            results["tasks"][task] = run_task(
+                task, args, lambda_module, os.path.join(directory, task),
+                real_pdal)
+    finally:
+        shutil.rmtree(directory)
+
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+def load_lambda():
+    """Loads `lambda.py`, which is not an importable module name."""
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    return imp.load_source("magic_bucket_lambda",
+                           os.path.join(ROOT, "lambda.py"))
+
+
+def run_task(task, args, lambda_module, directory, real_pdal):
+    """Runs one task on `args.count` synthetic objects, returning results."""
+    os.makedirs(os.path.join(directory, "s3"))
+    work_root = os.path.join(directory, "work")
+    os.mkdir(work_root)
+    s3 = standins.S3(os.path.join(directory, "s3"))
+    queue = standins.Queue()
+    keys = generate_inputs(task, s3, args.count, int(args.size * MB),
+                           os.path.join(directory, "inputs"), real_pdal,
+                           args.inline)
+    input_bytes = sum(s3.get(BUCKET, key, "HeadObject")["size"]
+                      for key in keys)
+
+    ecs = standins.EcsClient()
+    lambda_module.sqs = standins.SqsClient(queue)
+    lambda_module.ecs = ecs
+    environ = {
+        "AWS_REGION": "us-east-1",
+        "SQS_QUEUE_URL": queue.url,
+        "SLACK_TOKEN": "bench",
+        "MAGIC_BUCKET_CONCURRENCY": str(args.concurrency),
+        "MAGIC_BUCKET_DOWNLOAD_CONCURRENCY": str(args.download_concurrency),
+        "MAGIC_BUCKET_UPLOAD_CONCURRENCY": str(args.upload_concurrency),
+        "MAGIC_BUCKET_WORK_ROOT": work_root,
+        "MAGIC_BUCKET_CACHE_DIRECTORY": os.path.join(directory, "cache"),
+    }
+    sink = ListSink()
+    worker = create_worker(environ, s3=s3, sqs_queue=queue,
+                           slack_client=standins.SlackClient(),
+                           metrics_sink=sink)
+    sampler = DiskSampler(work_root)
+    lambda_module.metrics_sink = sink
+    if args.inline:
+        lambda_module.inline_magic_bucket = worker.magic_bucket
+        lambda_module.INLINE_MAX_SIZE = None
+    else:
+        lambda_module.INLINE_MAX_SIZE = "0"
+
+    start = time.time()
+    sampler.start()
+    lambda_module.main({"Records": [event_record(s3, key) for key in keys]},
+                       None)
+    try:
+        worker.run()
+    finally:
+        worker.slack.close()
+        sampler.stop()
+    seconds = time.time() - start
+
+    records = [record for record in sink.records if "phases" in record]
+    phases = {}
+    for record in records:
+        for name, phase in record["phases"].items():
+            phases.setdefault(name, []).append(phase["seconds"])
+    latencies = sorted(record["latency"] for record in records
+                       if record.get("latency") is not None)
+    event_latencies = {}
+    for record in records:
+        if record.get("event_latency") is not None:
+            event_latencies.setdefault(record["path"], []).append(
+                record["event_latency"])
+    max_rss = [process["max_rss"] for record in records
+               for process in record["subprocesses"]]
+    return {
+        "objects": len(keys),
+        "bytes": input_bytes,
+        "seconds": seconds,
+        "objects_per_second": len(keys) / seconds,
+        "bytes_per_second": input_bytes / seconds,
+        "failed": sum(1 for record in records
+                      if record.get("status") == "failed"),
+        "latency": _percentiles(latencies),
+        "inline": sum(1 for record in records
+                      if record.get("path") == "inline" and
+                      record.get("status") != "failed"),
+        "event_latency": dict((path, _percentiles(sorted(values)))
+                              for path, values in event_latencies.items()),
+        "phases": dict((name, _percentiles(sorted(values)))
+                       for name, values in phases.items()),
+        "peak_tool_rss": max(max_rss) if max_rss else None,
+        "peak_worker_rss": resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_disk": sampler.peak,
+        "ecs_tasks_started": ecs.started,
+        "s3_requests": s3.requests,
+        "sqs_requests": queue.requests,
+    }
+
+
+def generate_inputs(task, s3, count, size, directory, real_pdal,
+                    inline=False):
+    """Puts `count` synthetic inputs for `task` into the stand-in s3, along
+    with the files the task needs. Returns the input keys.
+
+    For `inline` runs, `pdal-info` reads headers only, so the lambda can run
+    it.
+    """
+    os.mkdir(directory)
+    if task == "pdal-info" and inline:
+        s3.put(BUCKET, "pdal-info/bench/config.json",
+               body=json.dumps({"mode": "header"}))
+    elif task == "pdal-translate":
+        s3.put(BUCKET, "pdal-translate/bench/config.json",
+               body=json.dumps({"output_ext": ".laz"}))
+    elif task == "ape-near-field-prcs":
+        fixed = os.path.join(directory, "fixed.laz")
+        write_laz(fixed, size, real_pdal)
+        s3.put(BUCKET, ApeNearFieldPrcs.FIXED_S3_KEY, filename=fixed)
+    keys = []
+    for i in range(count):
+        if task == "rimtatls":
+            filename = os.path.join(directory, "scan_{}.rxp".format(i))
+            standins.write_rxp(filename, size, seed=i)
+        elif task == "ape-near-field-prcs":
+            filename = os.path.join(directory, "scan_{}.laz".format(i))
+            write_laz(filename, size, real_pdal, seed=i)
+        else:
+            filename = os.path.join(directory, "cloud_{}.las".format(i))
+            standins.write_las(filename, size, seed=i)
+        key = "{}/bench/{}".format(task, os.path.basename(filename))
+        s3.put(BUCKET, key, filename=filename)
+        os.remove(filename)
+        keys.append(key)
+    return keys
+
+
+def write_laz(filename, size, real_pdal, seed=0):
+    """Writes a synthetic LAZ file, compressed if pdal is available.
+
+    Otherwise, the stub tools do not look inside it, so it is a LAS file.
+    """
+    if not real_pdal:
+        standins.write_las(filename, size, seed)
+        return
+    las = os.path.splitext(filename)[0] + ".las"
+    standins.write_las(las, size, seed)
+    subprocess.check_call(["pdal", "translate", las, filename])
+    os.remove(las)
+
+
+def event_record(s3, key):
+    """Returns an s3 event record for an object in the stand-in s3."""
+    entry = s3.get(BUCKET, key, "HeadObject")
+    now = time.time()
+    return {
+        "eventTime": "{}.{:03d}Z".format(
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)),
+            int(now % 1 * 1000)),
+        "eventName": "ObjectCreated:Put",
+        "s3": {"bucket": {"name": BUCKET},
+               "object": {"key": key, "size": entry["size"],
+                          "eTag": entry["etag"].strip('"'),
+                          "sequencer": "{:016X}".format(
+                              int(time.time() * 1e6))}},
+    }
+
+
+def report(results):
+    print("{:<22} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+        "task", "objects", "obj/s", "MB/s", "p50 (s)", "p95 (s)",
+        "tool RSS MB", "disk MB"))
+    for task, result in sorted(results["tasks"].items()):
+        print("{:<22} {:>8} {:>10.2f} {:>10.1f} {:>10.3f} {:>10.3f} "
+              "{:>12} {:>12.1f}".format(
+                  task, result["objects"], result["objects_per_second"],
+                  result["bytes_per_second"] / MB,
+                  result["latency"]["p50"] or 0,
+                  result["latency"]["p95"] or 0,
+                  "{:.1f}".format(result["peak_tool_rss"] / float(MB))
+                  if result["peak_tool_rss"] else "-",
+                  result["peak_disk"] / float(MB)))
+        for name, phase in sorted(result["phases"].items()):
+            print("    {:<18} p50 {:>8.3f} s  p95 {:>8.3f} s".format(
+                name, phase["p50"], phase["p95"]))
+        for path, latency in sorted(result.get("event_latency", {}).items()):
+            print("    {:<18} p50 {:>8.3f} s  p95 {:>8.3f} s".format(
+                "from event, " + path, latency["p50"], latency["p95"]))
+
+
+def compare(results, baseline):
+    """Prints the change in throughput and p95 latency from a baseline."""
+    print("{:<22} {:>14} {:>14}".format("task", "obj/s change",
+                                        "p95 change"))
+    for task, result in sorted(results["tasks"].items()):
+        before = baseline.get("tasks", {}).get(task)
+        if before is None:
+            print("{:<22} {:>14} {:>14}".format(task, "-", "-"))
+            continue
+        print("{:<22} {:>14} {:>14}".format(
+            task, _change(result["objects_per_second"],
+                          before["objects_per_second"]),
+            _change(result["latency"]["p95"], before["latency"]["p95"])))
+
+
+def _change(value, baseline):
+    if not value or not baseline:
+        return "-"
+    return "{:+.1%}".format(value / baseline - 1)
+
+
+def _percentiles(values):
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95),
+            "p99": percentile(values, 99)}
+
+
+if __name__ == "__main__":
+    main()
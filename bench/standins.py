@@ -0,0 +1,367 @@
+"""In-process stand-ins for the AWS services and tools the magic bucket uses.
+
+They implement just enough of the boto3 resources and clients, and of the
+external tools, for the end-to-end benchmark. Objects are kept as files, so
+large inputs do not count against the benchmark's own memory.
+"""
+
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import stat
+import struct
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+def _missing(operation):
+    return ClientError({"Error": {"Code": "404", "Message": "Not Found"}},
+                       operation)
+
+
+class S3(object):
+    """An s3 resource, with objects stored under `directory`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.requests = 0
+
+    def Object(self, bucket_name, key):
+        return S3Object(self, bucket_name, key)
+
+    def Bucket(self, bucket_name):
+        return Bucket(self, bucket_name)
+
+    def put(self, bucket_name, key, filename=None, body=None, metadata=None):
+        """Stores a file, or a string, as an object."""
+        path = os.path.join(self.directory, hashlib.sha1(
+            "{}/{}".format(bucket_name, key)).hexdigest())
+        if filename is not None:
+            shutil.copyfile(filename, path)
+        else:
+            with open(path, "wb") as f:
+                f.write(body)
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(chunk)
+        with self.lock:
+            self.requests += 1
+            self.objects[(bucket_name, key)] = {
+                "path": path, "etag": '"{}"'.format(md5.hexdigest()),
+                "size": os.path.getsize(path), "metadata": metadata or {}}
+
+    def get(self, bucket_name, key, operation):
+        with self.lock:
+            self.requests += 1
+            entry = self.objects.get((bucket_name, key))
+        if entry is None:
+            raise _missing(operation)
+        return entry
+
+    def keys(self, bucket_name, prefix="", delimiter=None):
+        with self.lock:
+            self.requests += 1
+            return sorted((key, entry["etag"])
+                          for (bucket, key), entry in self.objects.items()
+                          if bucket == bucket_name and key.startswith(prefix)
+                          and not (delimiter and
+                                   delimiter in key[len(prefix):]))
+
+
+class Bucket(object):
+
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+        self.objects = self
+
+    def filter(self, Prefix="", Delimiter=None):
+        for key, etag in self.s3.keys(self.name, Prefix, Delimiter):
+            summary = S3Object(self.s3, self.name, key)
+            summary.__dict__["e_tag"] = etag
+            yield summary
+
+
+class S3Object(object):
+
+    def __init__(self, s3, bucket_name, key):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+
+    def load(self):
+        entry = self.s3.get(self.bucket_name, self.key, "HeadObject")
+        self.__dict__.update(e_tag=entry["etag"],
+                             content_length=entry["size"],
+                             metadata=entry["metadata"])
+
+    reload = load
+
+    def __getattr__(self, name):
+        if name in ("e_tag", "content_length", "metadata"):
+            self.load()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def get(self, Range=None):
+        entry = self.s3.get(self.bucket_name, self.key, "GetObject")
+        with open(entry["path"], "rb") as f:
+            if Range is None:
+                return {"Body": io.BytesIO(f.read())}
+            start, end = Range.split("=")[1].split("-")
+            if int(start) >= entry["size"]:
+                raise ClientError({"Error": {
+                    "Code": "InvalidRange",
+                    "Message": "The requested range is not satisfiable"}},
+                    "GetObject")
+            f.seek(int(start))
+            return {"Body": io.BytesIO(f.read(int(end) - int(start) + 1))}
+
+    def put(self, Body, ContentType=None):
+        self.s3.put(self.bucket_name, self.key, body=Body)
+
+    def download_file(self, Filename, Config=None, Callback=None):
+        entry = self.s3.get(self.bucket_name, self.key, "HeadObject")
+        shutil.copyfile(entry["path"], Filename)
+        if Callback is not None:
+            Callback(entry["size"])
+
+    def upload_file(self, Filename, ExtraArgs=None, Config=None,
+                    Callback=None):
+        self.s3.put(self.bucket_name, self.key, filename=Filename,
+                    metadata=(ExtraArgs or {}).get("Metadata"))
+        if Callback is not None:
+            Callback(os.path.getsize(Filename))
+
+
+class Message(object):
+
+    def __init__(self, queue, message_id, body):
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.receipt_handle = None
+        self.visible_at = 0
+        self.attributes = {"ApproximateReceiveCount": "0"}
+
+
+class Queue(object):
+    """An sqs queue resource, with visibility timeouts and long polling.
+
+    Long polls wait at most `max_wait` seconds, so the benchmark does not
+    wait out the worker's final poll of an empty queue.
+    """
+
+    def __init__(self, url="https://sqs.bench/magic-bucket", max_wait=0.1):
+        self.url = url
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.messages = {}
+        self.ids = itertools.count()
+        self.requests = 0
+
+    def send(self, body):
+        with self.condition:
+            message_id = str(next(self.ids))
+            self.messages[message_id] = Message(self, message_id, body)
+            self.condition.notify_all()
+
+    def counts(self):
+        """Returns the number of visible and of in-flight messages."""
+        now = time.time()
+        with self.condition:
+            visible = sum(1 for message in self.messages.values()
+                          if message.visible_at <= now)
+            return visible, len(self.messages) - visible
+
+    def receive_messages(self, AttributeNames=None, MaxNumberOfMessages=1,
+                         WaitTimeSeconds=0, VisibilityTimeout=30):
+        deadline = time.time() + min(WaitTimeSeconds, self.max_wait)
+        with self.condition:
+            self.requests += 1
+            while True:
+                now = time.time()
+                visible = sorted((message for message in
+                                  self.messages.values()
+                                  if message.visible_at <= now),
+                                 key=lambda message: int(message.message_id))
+                if visible or now >= deadline:
+                    break
+                self.condition.wait(deadline - now)
+            received = visible[:MaxNumberOfMessages]
+            for message in received:
+                message.visible_at = now + VisibilityTimeout
+                message.receipt_handle = "{}-{}".format(message.message_id,
+                                                        now)
+                message.attributes["ApproximateReceiveCount"] = str(
+                    int(message.attributes["ApproximateReceiveCount"]) + 1)
+            return received
+
+    def delete_messages(self, Entries):
+        return self._batch(Entries, self._delete)
+
+    def change_message_visibility_batch(self, Entries):
+        return self._batch(Entries, self._change_visibility)
+
+    def _delete(self, message, entry):
+        del self.messages[message.message_id]
+
+    def _change_visibility(self, message, entry):
+        message.visible_at = time.time() + entry["VisibilityTimeout"]
+        self.condition.notify_all()
+
+    def _batch(self, entries, function):
+        successful = []
+        failed = []
+        with self.condition:
+            self.requests += 1
+            handles = dict((message.receipt_handle, message)
+                           for message in self.messages.values())
+            for entry in entries:
+                message = handles.get(entry["ReceiptHandle"])
+                if message is None:
+                    failed.append({"Id": entry["Id"],
+                                   "Message": "Invalid receipt handle"})
+                else:
+                    function(message, entry)
+                    successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": failed}
+
+
+class SqsClient(object):
+    """The sqs client calls the lambda makes, against a `Queue`."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def send_message_batch(self, QueueUrl, Entries):
+        for entry in Entries:
+            self.queue.send(entry["MessageBody"])
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        visible, in_flight = self.queue.counts()
+        return {"Attributes": {
+            "ApproximateNumberOfMessages": str(visible),
+            "ApproximateNumberOfMessagesNotVisible": str(in_flight)}}
+
+
+class EcsClient(object):
+    """Records the tasks the lambda starts; the benchmark runs the worker."""
+
+    def __init__(self):
+        self.started = 0
+
+    def run_task(self, taskDefinition, count):
+        self.started += count
+        return {"tasks": [{"taskArn": "bench-{}".format(i)}
+                          for i in range(count)]}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, **kwargs):
+        return [{"taskArns": []}]
+
+
+class SlackClient(object):
+    """Counts the messages that would be posted."""
+
+    def __init__(self):
+        self.messages = 0
+
+    def api_call(self, method, **kwargs):
+        self.messages += 1
+        return {"ok": True}
+
+
+# Stub tools: as fast as possible, writing outputs the tasks can upload.
+STUB_PDAL = """#!/usr/bin/env python
+import json, shutil, sys
+args = sys.argv[1:]
+if args[0] == "translate":
+    if "-i" in args:
+        shutil.copyfile(args[args.index("-i") + 1], args[args.index("-o") + 1])
+    else:
+        shutil.copyfile(args[1], args[2])
+elif args[0] == "info":
+    print(json.dumps({"filename": args[-1], "stub": True}))
+elif args[0] == "merge":
+    shutil.copyfile(args[1], args[-1])
+"""
+
+STUB_RIMTATLS = """#!/usr/bin/env python
+import shutil, sys
+shutil.copyfile(sys.argv[1], sys.argv[2])
+"""
+
+STUB_APE = """#!/usr/bin/env python
+import sys
+open(sys.argv[4], "w").write("stub cpd of {} against {}\\n".format(
+    sys.argv[3], sys.argv[2]))
+"""
+
+
+def write_stub_tools(directory, real_pdal=False):
+    """Writes stub `pdal`, `rimtatls` and `ape` executables to `directory`.
+
+    Returns the path of the `ape` stub. With `real_pdal`, no `pdal` stub is
+    written, so the one on the path is used.
+    """
+    stubs = {"rimtatls": STUB_RIMTATLS, "ape": STUB_APE}
+    if not real_pdal:
+        stubs["pdal"] = STUB_PDAL
+    for name, source in stubs.items():
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write(source)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+                 stat.S_IXOTH)
+    return os.path.join(directory, "ape")
+
+
+def write_las(filename, size, seed=0):
+    """Writes a synthetic LAS 1.2 file (point format 0) of about `size`
+    bytes, with points on a noisy plane.
+    """
+    header_size = 227
+    record_length = 20
+    count = max(1, (size - header_size) // record_length)
+    scale = 0.01
+    extent = int(count ** 0.5) + 1
+    header = struct.pack(
+        "<4sHHIHH8sBB32s32sHHHIIBHI5I6d",
+        b"LASF", 0, 0, 0, 0, 0, b"\0" * 8, 1, 2,
+        b"magic-bucket bench".ljust(32, b"\0"),
+        b"magic-bucket bench".ljust(32, b"\0"), 1, 2018, header_size,
+        header_size, 0, 0, record_length, count, count, 0, 0, 0, 0,
+        scale, scale, scale, 0.0, 0.0, 0.0)
+    header += struct.pack("<6d", extent * scale, 0.0, extent * scale, 0.0,
+                          1.0, 0.0)
+    with open(filename, "wb") as f:
+        f.write(header)
+        for i in range(count):
+            x = i % extent
+            y = i // extent
+            z = (x * 7 + y * 13 + seed) % 100
+            f.write(struct.pack("<iiiHBBbBH", x, y, z, 100, 0b00010001, 2,
+                                0, 0, 0))
+
+
+def write_rxp(filename, size, seed=0):
+    """Writes an RXP-like file: a short text header and random packets."""
+    with open(filename, "wb") as f:
+        f.write(json.dumps({"format": "rxp-like", "seed": seed}) + "\n")
+        remaining = size - f.tell()
+        while remaining > 0:
+            chunk = os.urandom(min(remaining, 1024 * 1024))
+            f.write(chunk)
+            remaining -= len(chunk)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Benchmark single-process vs. tiled `pdal-translate` on a synthetic cloud.
+
+Needs `pdal` on the path. The cloud is generated with `readers.faux`:
+
+    bench/tiled_translate.py --points 50000000 --capacity 5000000
+"""
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "docker"))
+
+from magic_bucket.task.pdal_translate import PdalTranslate
+
+S3Object = collections.namedtuple("S3Object", ["bucket_name", "key"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--points", type=int, default=10000000)
+    parser.add_argument("--capacity", type=int, default=1000000)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--filters", help="JSON file with a list of filters",
+                        default=None)
+    parser.add_argument("--output-ext", default=".laz")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="magic-bucket-bench-")
+    cloud = os.path.join(directory, "synthetic.las")
+    generate(cloud, args.points)
+    filters = []
+    if args.filters:
+        with open(args.filters) as f:
+            filters = json.load(f)
+    config = {"filters": filters, "output_ext": args.output_ext}
+    tiled = dict(config, tiles={"capacity": args.capacity,
+                                "processes": args.processes})
+
+    print("{:>8} {:>10} {:>14}".format("mode", "seconds", "points/s"))
+    for mode, mode_config in [("single", config), ("tiled", tiled)]:
+        seconds = run(directory, cloud, mode_config)
+        print("{:>8} {:>10.1f} {:>14.0f}".format(mode, seconds,
+                                                 args.points / seconds))
+    shutil.rmtree(directory)
+
+
+def generate(filename, points):
+    """Writes a random synthetic cloud with `points` points."""
+    pipeline = {"pipeline": [
+        {"type": "readers.faux", "count": points, "mode": "random",
+         "bounds": "([0, 1000], [0, 1000], [0, 100])"},
+        filename]}
+    subprocess.check_call(["pdal", "pipeline", "--stdin"],
+                          stdin=_pipe(json.dumps(pipeline)))
+
+
+def run(directory, cloud, config):
+    """Runs PdalTranslate.process on a copy of the cloud, returns seconds."""
+    work_directory = tempfile.mkdtemp(dir=directory)
+    filename = os.path.join(work_directory, os.path.basename(cloud))
+    os.link(cloud, filename)
+    task = PdalTranslate(None, S3Object("bench", "pdal-translate/bench.las"))
+    task.work_directory = work_directory
+    with open(task.path(task.config_file), "w") as f:
+        json.dump(config, f)
+    start = time.time()
+    task.process(filename)
+    seconds = time.time() - start
+    shutil.rmtree(work_directory)
+    return seconds
+
+
+def _pipe(data):
+    f = tempfile.TemporaryFile()
+    f.write(data)
+    f.seek(0)
+    return f
+
+
+if __name__ == "__main__":
+    main()
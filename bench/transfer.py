@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""Benchmark s3 transfer settings against a real or local s3.
+
+Uploads and downloads a random file with each combination of part size and
+concurrency, and prints the throughput. Point `--endpoint-url` at a local s3
+stand-in (e.g. minio or `moto_server`) to benchmark without AWS:
+
+    bench/transfer.py --endpoint-url http://localhost:9000 --bucket bench \\
+        --size 1024 --part-size 8 64 --concurrency 1 4 10
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "docker"))
+
+from magic_bucket import MagicBucket, TransferSettings
+
+MB = 1024 * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoint-url")
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--key", default="bench/transfer.bin")
+    parser.add_argument("--size", type=int, default=256,
+                        help="file size in MB")
+    parser.add_argument("--part-size", type=int, nargs="+", default=[64],
+                        help="part sizes in MB")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10])
+    parser.add_argument("--memory", type=int, default=1024,
+                        help="memory budget in MB")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="magic-bucket-bench-")
+    source = os.path.join(directory, "source.bin")
+    target = os.path.join(directory, "target.bin")
+    with open(source, "wb") as f:
+        for _ in range(args.size):
+            f.write(os.urandom(MB))
+
+    print("{:>10} {:>12} {:>14} {:>16}".format(
+        "part (MB)", "concurrency", "upload (MB/s)", "download (MB/s)"))
+    for part_size in args.part_size:
+        for concurrency in args.concurrency:
+            settings = TransferSettings(part_size=part_size * MB,
+                                        concurrency=concurrency,
+                                        memory_budget=args.memory * MB,
+                                        verify_checksums=True)
+            magic_bucket = MagicBucket(args.region, "bench",
+                                       transfer_settings=settings,
+                                       s3_endpoint_url=args.endpoint_url)
+            upload = _rate(lambda: magic_bucket.upload_file(
+                source, args.bucket, args.key), args.size)
+            s3_object = magic_bucket.s3_object(args.bucket, args.key)
+            download = _rate(lambda: magic_bucket.download_object(
+                s3_object, target), args.size)
+            print("{:>10} {:>12} {:>14.1f} {:>16.1f}".format(
+                part_size, settings.effective_concurrency(), upload,
+                download))
+            os.remove(target)
+    os.remove(source)
+    os.rmdir(directory)
+
+
+def _rate(function, size):
+    start = time.time()
+    function()
+    return size / (time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
+from archive import InvalidArchive
 from exceptions import MagicBucketException
 from magic_bucket import MagicBucket
 from slack import Slack
 from task import create_task, UnknownTask
+from transfer import TransferSettings, TransferIntegrityError
+from worker import Worker
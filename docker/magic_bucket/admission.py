@@ -0,0 +1,140 @@
+"""Admits jobs within a disk and memory budget."""
+
+import multiprocessing
+import os
+import threading
+import time
+
+
+class Admission(object):
+    """Holds queued jobs until they fit in the disk and memory budget.
+
+    Each job carries an estimate of the `disk` and `memory` it needs. The
+    smallest job that fits goes first, so small jobs are not stuck behind a
+    large one, but once a job has waited `max_wait` seconds nothing else is
+    admitted until it fits, so large jobs do not starve.
+
+    Works like a `Queue` for the download stage: `put` a job (or None, to
+    stop one reader) and `get` the next admitted job. `release` a job's
+    budget once its work directory is removed.
+    """
+
+    DEFAULT_CAPACITY = 10
+    DEFAULT_MAX_WAIT = 300
+
+    def __init__(self, disk_budget, memory_budget, capacity=None,
+                 max_wait=None):
+        self.disk_budget = disk_budget
+        self.memory_budget = memory_budget
+        self.capacity = capacity or self.DEFAULT_CAPACITY
+        self.max_wait = max_wait or self.DEFAULT_MAX_WAIT
+        self.condition = threading.Condition()
+        self.pending = []
+        self.stops = 0
+        self.disk_used = 0
+        self.memory_used = 0
+
+    def fits_budget(self, job):
+        """Returns true if the job fits in the budget on its own."""
+        return (job.disk <= self.disk_budget and
+                job.memory <= self.memory_budget)
+
+    def put(self, job):
+        """Queues a job, waiting while `capacity` jobs are queued."""
+        with self.condition:
+            if job is None:
+                self.stops += 1
+            else:
+                while len(self.pending) >= self.capacity:
+                    self.condition.wait()
+                job.queued = time.time()
+                self.pending.append(job)
+            self.condition.notify_all()
+
+    def get(self):
+        """Returns the next job that fits, reserving its budget.
+
+        Returns None once `put(None)` was called and no job is queued.
+        """
+        with self.condition:
+            while True:
+                job = self._next()
+                if job is not None:
+                    self.pending.remove(job)
+                    job.reserved = True
+                    self.disk_used += job.disk
+                    self.memory_used += job.memory
+                    self.condition.notify_all()
+                    return job
+                if self.stops and not self.pending:
+                    self.stops -= 1
+                    return None
+                self.condition.wait()
+
+    def release(self, job):
+        """Returns a job's reservation, if it has one, to the budget."""
+        with self.condition:
+            if not job.reserved:
+                return
+            job.reserved = False
+            self.disk_used -= job.disk
+            self.memory_used -= job.memory
+            self.condition.notify_all()
+
+    def _next(self):
+        if not self.pending:
+            return None
+        oldest = min(self.pending, key=lambda job: job.queued)
+        if time.time() - oldest.queued >= self.max_wait:
+            candidates = [oldest]
+        else:
+            candidates = sorted(self.pending,
+                                key=lambda job: (job.disk, job.queued))
+        for job in candidates:
+            if (self.disk_used + job.disk <= self.disk_budget and
+                    self.memory_used + job.memory <= self.memory_budget):
+                return job
+        return None
+
+
+def free_disk(directory):
+    """Returns the bytes available to us on the filesystem of `directory`."""
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def available_memory():
+    """Returns the bytes of memory available for new processes."""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def available_cpus(cgroup="/sys/fs/cgroup"):
+    """Returns the cpus we may use, rounded up: the container's cpu quota
+    (cgroup v2 `cpu.max`, or v1 `cpu.cfs_quota_us`), or else every cpu of
+    the host.
+    """
+    quota = period = None
+    try:
+        with open(os.path.join(cgroup, "cpu.max")) as f:
+            quota, period = f.read().split()
+    except (IOError, ValueError):
+        try:
+            with open(os.path.join(cgroup, "cpu", "cpu.cfs_quota_us")) as f:
+                quota = f.read().strip()
+            with open(os.path.join(cgroup, "cpu", "cpu.cfs_period_us")) as f:
+                period = f.read().strip()
+        except IOError:
+            pass
+    try:
+        if int(quota) > 0 and int(period) > 0:
+            return max(1, -(-int(quota) // int(period)))
+    except (TypeError, ValueError):
+        pass
+    return multiprocessing.cpu_count()
@@ -0,0 +1,143 @@
+"""Streaming extraction of compressed inputs."""
+
+import contextlib
+import os
+import shutil
+import zipfile
+import zlib
+
+from exceptions import MagicBucketException
+
+CHUNK_SIZE = 1024 * 1024
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class InvalidArchive(MagicBucketException):
+    """A gzip or zip input is corrupt or truncated."""
+
+
+def gunzip_stream(stream, filename, chunk_size=CHUNK_SIZE):
+    """Decompresses a gzip stream into `filename`, one chunk at a time.
+
+    Concatenated gzip members are all decompressed, and zero padding after
+    the last one is ignored, as `gunzip` does. Returns the number of bytes
+    written.
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    padding = False
+    written = 0
+    with _reading("gzip stream"), open(filename, "wb") as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            while chunk and not padding:
+                data = decompressor.decompress(chunk)
+                chunk = decompressor.unused_data
+                if chunk:
+                    data += decompressor.flush()
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                    padding = not chunk.strip(b"\0")
+                f.write(data)
+                written += len(data)
+            if padding and chunk.strip(b"\0"):
+                raise InvalidArchive("Trailing garbage after gzip data")
+        if not padding:
+            # Past the end of a complete member, a byte is left unused.
+            decompressor.decompress(b"\0")
+            if decompressor.unused_data != b"\0":
+                raise InvalidArchive("Truncated gzip stream")
+            data = decompressor.flush()
+            f.write(data)
+            written += len(data)
+    return written
+
+
+def extract_zip(fileobj, directory):
+    """Extracts every member of a zip file (or seekable file object) into
+    `directory`.
+
+    Members are streamed out of the archive one at a time. Existing files
+    are replaced rather than overwritten, since they might be hard links
+    into the artifact cache; only files inside `directory` are removed.
+    Returns the names of the extracted members.
+    """
+    root = os.path.join(os.path.realpath(directory), "")
+    with _reading("zip archive"):
+        archive = zipfile.ZipFile(fileobj)
+        try:
+            for name in archive.namelist():
+                path = member_path(directory, name)
+                if os.path.realpath(path).startswith(root):
+                    _remove(path)
+            archive.extractall(directory)
+            return archive.namelist()
+        finally:
+            archive.close()
+
+
+def member_path(directory, name):
+    """Returns where `extractall` puts the member `name` in `directory`:
+    drive letters, empty, `.` and `..` components are dropped.
+    """
+    name = name.replace("/", os.path.sep)
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+    name = os.path.splitdrive(name)[1]
+    return os.path.join(directory, *[
+        part for part in name.split(os.path.sep)
+        if part not in ("", os.path.curdir, os.path.pardir)])
+
+
+def zip_members(filename):
+    """Returns the names of the files, not directories, in a zip file."""
+    with _reading(os.path.basename(filename)):
+        archive = zipfile.ZipFile(filename)
+        try:
+            return [info.filename for info in archive.infolist()
+                    if not info.filename.endswith("/")]
+        finally:
+            archive.close()
+
+
+def extract_member(filename, member, directory, chunk_size=CHUNK_SIZE):
+    """Streams one member of a zip file into `directory`.
+
+    The member is written under its basename, whatever directory it has in
+    the archive. Each call opens the archive anew, so several threads can
+    extract from the same file at once. Returns the extracted path.
+    """
+    path = os.path.join(directory, os.path.basename(member))
+    _remove(path)
+    with _reading(member):
+        archive = zipfile.ZipFile(filename)
+        try:
+            source = archive.open(member)
+            try:
+                with open(path, "wb") as f:
+                    shutil.copyfileobj(source, f, chunk_size)
+            finally:
+                source.close()
+        finally:
+            archive.close()
+    return path
+
+
+@contextlib.contextmanager
+def _reading(name):
+    """Turns the errors of a corrupt or truncated archive into
+    `InvalidArchive`, a task failure rather than a worker crash.
+
+    Transport and disk errors, which are `IOError`s, are not the archive's
+    fault and pass through, so the message is released and tried again.
+    zipfile reports bad CRCs as `BadZipfile`.
+    """
+    try:
+        yield
+    except (zipfile.BadZipfile, zlib.error, EOFError) as e:
+        raise InvalidArchive("Could not read {}: {}".format(name, e))
+
+
+def _remove(path):
+    if os.path.isfile(path):
+        os.remove(path)
@@ -0,0 +1,223 @@
+"""Size-bounded local cache of s3 objects and files derived from them."""
+
+import collections
+import hashlib
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+MB = 1024 * 1024
+
+
+class ArtifactCache(object):
+    """A content-addressed, least-recently-used cache on local disk.
+
+    Entries are keyed by bucket, key and ETag, so a changed s3 object is
+    never served stale. Files derived from an s3 object (e.g. a `.las`
+    conversion of a `.laz` reference cloud) are cached next to it. Files are
+    hard-linked (or copied, across filesystems) into a task's work directory,
+    so evicting an entry never pulls a file out from under a running task.
+    Tasks must replace, not overwrite, the files they get from the cache.
+    """
+
+    DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(),
+                                     "magic-bucket-cache")
+    DEFAULT_MAX_BYTES = 10 * 1024 * MB
+
+    def __init__(self, magic_bucket, directory=None, max_bytes=None):
+        self.magic_bucket = magic_bucket
+        self.directory = directory or self.DEFAULT_DIRECTORY
+        self.max_bytes = max_bytes or self.DEFAULT_MAX_BYTES
+        self.logger = logging.getLogger("magic-bucket")
+        self.lock = threading.Lock()
+        self.entry_locks = collections.defaultdict(threading.Lock)
+        self.pins = collections.Counter()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.uncached = itertools.count()
+        self._load()
+
+    def fetch(self, bucket_name, key, destination, etag=None):
+        """Places the s3 object at `destination`, downloading it on a miss.
+
+        If the object's `etag` is already known, it is not looked up again.
+        Returns true if the object exists, false otherwise.
+        """
+        entry = self._source_entry(bucket_name, key, etag)
+        if entry is None:
+            return False
+        path = self._acquire(entry, lambda path: self.magic_bucket
+                             .download_file(bucket_name, key, path))
+        if path is None:
+            return False
+        try:
+            _place(path, destination)
+        finally:
+            self._release(entry, path)
+        return True
+
+    def derive(self, bucket_name, key, suffix, function, destination,
+               etag=None):
+        """Places a file derived from an s3 object at `destination`.
+
+        On a miss, `function(source, output)` is called with the cached s3
+        object and the path where the derived file, ending in `suffix`,
+        should be written. If the object's `etag` is already known, it is not
+        looked up again. Returns true if the s3 object exists, false
+        otherwise.
+        """
+        source = self._source_entry(bucket_name, key, etag)
+        if source is None:
+            return False
+        entry = _hash(source, suffix) + suffix
+
+        def create(path):
+            source_path = self._acquire(
+                source, lambda source_path: self.magic_bucket.download_file(
+                    bucket_name, key, source_path))
+            if source_path is None:
+                return False
+            try:
+                function(source_path, path)
+            finally:
+                self._release(source, source_path)
+            return True
+        path = self._acquire(entry, create)
+        if path is None:
+            return False
+        try:
+            _place(path, destination)
+        finally:
+            self._release(entry, path)
+        return True
+
+    def stats(self):
+        """Returns the hit and miss counts and the cache's size in bytes."""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self.entries), "bytes": self.size}
+
+    def _source_entry(self, bucket_name, key, etag=None):
+        if etag is None:
+            etag = self.magic_bucket.object_etag(bucket_name, key)
+        if etag is None:
+            return None
+        return _hash(bucket_name, key, etag) + os.path.splitext(key)[1]
+
+    def _acquire(self, entry, create):
+        """Makes sure `entry` is in the cache, calling `create(path)` if not,
+        and pins it until it is passed to `_release`.
+
+        Returns the entry's path, or None if `create` fails. An entry larger
+        than the whole cache is not kept: its path is then a file of its
+        own, removed on release.
+        """
+        with self.lock:
+            entry_lock = self.entry_locks[entry]
+        with entry_lock:
+            with self.lock:
+                if entry in self.entries:
+                    self.hits += 1
+                    self.entries[entry] = self.entries.pop(entry)
+                    self.pins[entry] += 1
+                    hit = True
+                else:
+                    self.misses += 1
+                    hit = False
+            path = self._path(entry)
+            if hit:
+                os.utime(path, None)
+                self.logger.info("Cache hit for {}".format(entry))
+                return path
+            self.logger.info("Cache miss for {}".format(entry))
+            extension = os.path.splitext(path)[1]
+            partial = "{}.partial{}".format(path, extension)
+            try:
+                if not create(partial):
+                    return None
+                size = os.path.getsize(partial)
+                if size > self.max_bytes:
+                    self.logger.info(
+                        "Not caching {} ({} bytes), it is larger than the "
+                        "cache".format(entry, size))
+                    uncached = "{}.uncached-{}{}".format(
+                        path, next(self.uncached), extension)
+                    os.rename(partial, uncached)
+                    return uncached
+                os.rename(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+            with self.lock:
+                self.entries[entry] = size
+                self.size += size
+                self.pins[entry] += 1
+                self._evict()
+            return path
+
+    def _release(self, entry, path):
+        """Unpins an entry from `_acquire`, or removes its uncached file."""
+        if path != self._path(entry):
+            os.remove(path)
+            return
+        with self.lock:
+            self.pins[entry] -= 1
+            if self.pins[entry] <= 0:
+                del self.pins[entry]
+            self._evict()
+
+    def _evict(self):
+        """Removes least recently used entries until the cache fits.
+
+        Must be called with the lock held.
+        """
+        for entry in list(self.entries):
+            if self.size <= self.max_bytes:
+                break
+            if self.pins[entry] > 0:
+                continue
+            size = self.entries.pop(entry)
+            self.size -= size
+            self.logger.info("Evicting {} ({} bytes) from cache".format(
+                entry, size))
+            os.remove(self._path(entry))
+
+    def _load(self):
+        """Picks up entries left on disk by an earlier process."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        found = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if ".partial" in name or ".uncached" in name:
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+        with self.lock:
+            self._evict()
+
+    def _path(self, entry):
+        return os.path.join(self.directory, entry)
+
+
+def _place(path, destination):
+    """Hard-links (or copies) a file to `destination`, replacing it."""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(path, destination)
+    except OSError:
+        shutil.copyfile(path, destination)
+
+
+def _hash(*parts):
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
@@ -0,0 +1,95 @@
+"""Resolution of per-directory configuration files from s3 listings."""
+
+import logging
+import os
+import threading
+import time
+
+import botocore
+
+
+class ConfigIndex(object):
+    """Answers "which configuration file applies to this key" in memory.
+
+    Each of the key's ancestor directories, up to the task prefix (e.g.
+    `pdal-translate/`), is listed once, without its subdirectories, and its
+    keys and the ETags of its `.json` files are remembered for `ttl`
+    seconds. Lookups for other keys in the same directories, including ones
+    that find no configuration at all, are answered from those listings, so
+    a bulk upload of many tiles costs one listing per directory.
+
+    A configuration that is added or changed is therefore picked up within
+    `ttl` seconds; until then, the old one (and its old ETag) is used. The
+    one exception is the sidecar `<key>.json` of a key that is newer than
+    its directory's listing, which is looked up directly, since the two are
+    usually uploaded together.
+    """
+
+    DEFAULT_TTL = 30
+
+    def __init__(self, s3, ttl=None):
+        self.s3 = s3
+        self.ttl = ttl or self.DEFAULT_TTL
+        self.logger = logging.getLogger("magic-bucket")
+        self.lock = threading.Lock()
+        self.listings = {}
+
+    def nearest(self, bucket_name, key, config_name):
+        """Returns the key and ETag of the configuration for `key`.
+
+        A sidecar `<key>.json` wins, then `config_name` in the key's
+        directory and each of its parents, up to the task prefix. Returns
+        None if there is no configuration.
+        """
+        directories = []
+        dirname = os.path.dirname(key)
+        while dirname:
+            directories.append(dirname)
+            dirname = os.path.dirname(dirname)
+        if not directories:
+            return None
+        listing = self._listing(bucket_name, directories[0])
+        sidecar = key + ".json"
+        if sidecar in listing["configs"]:
+            return sidecar, listing["configs"][sidecar]
+        if key not in listing["keys"]:
+            etag = self._etag(bucket_name, sidecar)
+            if etag is not None:
+                return sidecar, etag
+        for directory in directories:
+            configs = self._listing(bucket_name, directory)["configs"]
+            candidate = directory + "/" + config_name
+            if candidate in configs:
+                return candidate, configs[candidate]
+        return None
+
+    def _listing(self, bucket_name, directory):
+        with self.lock:
+            listing = self.listings.get((bucket_name, directory))
+            if (listing is None or
+                    time.time() - listing["time"] > self.ttl):
+                listing = self._list(bucket_name, directory + "/")
+                self.listings[(bucket_name, directory)] = listing
+        return listing
+
+    def _list(self, bucket_name, prefix):
+        keys = set()
+        configs = {}
+        bucket = self.s3.Bucket(bucket_name)
+        for summary in bucket.objects.filter(Prefix=prefix, Delimiter="/"):
+            keys.add(summary.key)
+            if summary.key.endswith(".json"):
+                configs[summary.key] = summary.e_tag
+        self.logger.info("Listed {} key(s), {} config(s) in s3://{}/{}"
+                         .format(len(keys), len(configs), bucket_name, prefix))
+        return {"time": time.time(), "keys": keys, "configs": configs}
+
+    def _etag(self, bucket_name, key):
+        s3_object = self.s3.Object(bucket_name, key)
+        try:
+            s3_object.load()
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        return s3_object.e_tag
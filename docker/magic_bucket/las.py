@@ -0,0 +1,145 @@
+"""Reads LAS/LAZ public headers and variable length records."""
+
+import base64
+import struct
+
+from exceptions import MagicBucketException
+
+SIGNATURE = b"LASF"
+PUBLIC_HEADER_SIZE = 375
+VLR_HEADER_SIZE = 54
+DEFAULT_READ_SIZE = 64 * 1024
+PROJECTION_USER_ID = "LASF_Projection"
+WKT_RECORD_ID = 2112
+GEO_KEY_DIRECTORY_RECORD_ID = 34735
+PROJECTED_CS_TYPE_GEO_KEY = 3072
+GEOGRAPHIC_TYPE_GEO_KEY = 2048
+
+
+class InvalidLasHeader(MagicBucketException):
+    """The data does not start with a LAS public header."""
+
+
+def read_header(read):
+    """Reads the public header and variable length records of a LAS file.
+
+    `read(start, length)` returns up to `length` bytes starting at `start`,
+    so the file can be local or behind ranged s3 reads. Usually only one read
+    is needed. Returns a dictionary named like the metadata of `pdal info`.
+    """
+    data = read(0, DEFAULT_READ_SIZE)
+    if len(data) < 227 or data[:4] != SIGNATURE:
+        raise InvalidLasHeader("Not a LAS file")
+    header = _public_header(data)
+    end = header["dataoffset"]
+    if len(data) < end:
+        data += read(len(data), end - len(data))
+    header["vlrs"] = _vlrs(data, header["header_size"],
+                           header.pop("vlr_count"))
+    header["srs"] = _srs(header["vlrs"])
+    return header
+
+
+def _public_header(data):
+    (filesource_id, global_encoding) = struct.unpack_from("<HH", data, 4)
+    project_id = data[8:24]
+    major_version, minor_version = struct.unpack_from("<BB", data, 24)
+    system_id = _string(data[26:58])
+    software_id = _string(data[58:90])
+    creation_doy, creation_year, header_size = struct.unpack_from(
+        "<HHH", data, 90)
+    dataoffset, vlr_count = struct.unpack_from("<LL", data, 96)
+    dataformat_id, point_length, count = struct.unpack_from("<BHL", data, 104)
+    scale = struct.unpack_from("<3d", data, 131)
+    offset = struct.unpack_from("<3d", data, 155)
+    maxx, minx, maxy, miny, maxz, minz = struct.unpack_from("<6d", data, 179)
+    if minor_version >= 4 and len(data) >= 255:
+        count = struct.unpack_from("<Q", data, 247)[0]
+    return {
+        "filesource_id": filesource_id,
+        "global_encoding": global_encoding,
+        "project_id": _guid(project_id),
+        "major_version": major_version,
+        "minor_version": minor_version,
+        "system_id": system_id,
+        "software_id": software_id,
+        "creation_doy": creation_doy,
+        "creation_year": creation_year,
+        "header_size": header_size,
+        "dataoffset": dataoffset,
+        "vlr_count": vlr_count,
+        # LAZ files set the high bits of the point format.
+        "compressed": dataformat_id & 0x80 != 0,
+        "dataformat_id": dataformat_id & 0x3f,
+        "point_length": point_length,
+        "count": count,
+        "scale_x": scale[0], "scale_y": scale[1], "scale_z": scale[2],
+        "offset_x": offset[0], "offset_y": offset[1], "offset_z": offset[2],
+        "minx": minx, "miny": miny, "minz": minz,
+        "maxx": maxx, "maxy": maxy, "maxz": maxz,
+    }
+
+
+def _vlrs(data, start, count):
+    vlrs = []
+    position = start
+    for _ in range(count):
+        if position + VLR_HEADER_SIZE > len(data):
+            break
+        user_id = _string(data[position + 2:position + 18])
+        record_id, length = struct.unpack_from("<HH", data, position + 18)
+        description = _string(data[position + 22:position + 54])
+        position += VLR_HEADER_SIZE
+        payload = data[position:position + length]
+        position += length
+        vlrs.append({
+            "user_id": user_id,
+            "record_id": record_id,
+            "description": description,
+            "length": length,
+            "data": base64.b64encode(payload).decode("ascii"),
+        })
+    return vlrs
+
+
+def _srs(vlrs):
+    srs = {"wkt": "", "epsg": None}
+    for vlr in vlrs:
+        if vlr["user_id"] != PROJECTION_USER_ID:
+            continue
+        payload = base64.b64decode(vlr["data"])
+        if vlr["record_id"] == WKT_RECORD_ID:
+            srs["wkt"] = _string(payload)
+        elif vlr["record_id"] == GEO_KEY_DIRECTORY_RECORD_ID:
+            keys = _geo_keys(payload)
+            srs["epsg"] = (keys.get(PROJECTED_CS_TYPE_GEO_KEY) or
+                           keys.get(GEOGRAPHIC_TYPE_GEO_KEY))
+    return srs
+
+
+def _geo_keys(payload):
+    """Returns the short-valued keys of a GeoTIFF key directory."""
+    if len(payload) < 8:
+        return {}
+    count = struct.unpack_from("<4H", payload, 0)[3]
+    keys = {}
+    for i in range(count):
+        offset = 8 + 8 * i
+        if offset + 8 > len(payload):
+            break
+        key_id, location, _, value = struct.unpack_from("<4H", payload,
+                                                        offset)
+        if location == 0:
+            keys[key_id] = value
+    return keys
+
+
+def _string(data):
+    return data.split(b"\0", 1)[0].decode("ascii", "replace").strip()
+
+
+def _guid(data):
+    a, b, c = struct.unpack_from("<LHH", data, 0)
+    d = "".join("{:02X}".format(ord(byte)) if isinstance(byte, str)
+                else "{:02X}".format(byte) for byte in data[8:])
+    return "{:08X}-{:04X}-{:04X}-{}-{}".format(a, b, c, d[:4], d[4:])
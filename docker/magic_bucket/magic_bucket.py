@@ -2,59 +2,234 @@
 
 import json
 import logging
+import math
+import os
+import threading
+import time
 
 import boto3
 import botocore
 
+from cache import ArtifactCache
+from config_index import ConfigIndex
+from messages import InFlightMessages, MAX_BATCH_SIZE
+from metrics import event_time
+import resumable
+from transfer import TransferProgress, TransferSettings, verify
+
 
 class MagicBucket(object):
     """Utility class for operations that will be common between tasks."""
 
-    def __init__(self, region, sqs_queue_url):
+    DEFAULT_WAIT_TIME_SECONDS = 20
+
+    def __init__(self, region, sqs_queue_url, visibility_timeout=None,
+                 transfer_settings=None, s3_endpoint_url=None,
+                 cache_directory=None, cache_max_bytes=None,
+                 idle_timeout=None, s3=None, sqs_queue=None):
+        """Creates the s3 and sqs resources, unless they are passed in, e.g.
+        as stand-ins for benchmarks.
+        """
         self.logger = logging.getLogger("magic-bucket")
-        self.s3 = boto3.resource("s3", region_name=region)
-        sqs = boto3.resource("sqs", region_name=region)
-        self.sqs_queue = sqs.Queue(sqs_queue_url)
+        self.s3 = s3 or boto3.resource("s3", region_name=region,
+                                       endpoint_url=s3_endpoint_url)
+        self.transfer_settings = transfer_settings or TransferSettings()
+        if sqs_queue is None:
+            sqs = boto3.resource("sqs", region_name=region)
+            sqs_queue = sqs.Queue(sqs_queue_url)
+        self.sqs_queue = sqs_queue
+        self.wait_time_seconds = self.DEFAULT_WAIT_TIME_SECONDS
+        self.idle_timeout = idle_timeout
+        self.stopping = threading.Event()
+        self.stop_cause = None
+        self.exit_cause = None
+        self.in_flight = InFlightMessages(self.sqs_queue, visibility_timeout)
+        self.cache = ArtifactCache(self, cache_directory, cache_max_bytes)
+        self.config_index = ConfigIndex(self.s3)
 
-    def receive_message(self):
-        """Fetches a message from the sqs queue.
+    def receive_messages(self, wait_time_seconds=None):
+        """Long-polls the sqs queue for up to ten messages.
 
-        Does *not* delete the message. Returns None if no message is received.
+        Does *not* delete the messages. Returns an empty list if no message
+        is received.
         """
-        messages = self.sqs_queue.receive_messages(MaxNumberOfMessages=1)
-        if messages:
-            return messages[0]
-        else:
-            return None
+        if wait_time_seconds is None:
+            wait_time_seconds = self.wait_time_seconds
+        return self.sqs_queue.receive_messages(
+            AttributeNames=["ApproximateReceiveCount"],
+            MaxNumberOfMessages=MAX_BATCH_SIZE,
+            WaitTimeSeconds=wait_time_seconds,
+            VisibilityTimeout=self.in_flight.visibility_timeout)
 
     def consume_messages(self):
-        """Fetches and removes messages from the sqs queue."""
+        """Fetches messages from the sqs queue until it is empty.
+
+        With an `idle_timeout`, keeps long-polling the queue until no message
+        has been received or in flight for that many seconds, so later
+        uploads are handled by a warm worker, with its clients and caches,
+        instead of a new container.
+        Either way, stops early after `request_stop`. The reason is kept in
+        `exit_cause`: "empty", "idle" or the cause given to `request_stop`.
+
+        Messages stay on the queue, kept invisible by a heartbeat, until they
+        are passed to `finish_message` or `release_message`. Call
+        `stop_consuming` once all messages have been handled.
+        """
+        self.in_flight.start()
+        self.exit_cause = None
+        last_busy = time.time()
         while True:
-            message = self.receive_message()
-            if message is None:
+            if self.stopping.is_set():
+                self.exit_cause = self.stop_cause
                 break
-            else:
-                message.delete()
-                self.logger.info("Deleted message {} from sqs queue {}".format(
-                    message.receipt_handle, self.sqs_queue.url))
-                yield message
+            if self.in_flight.count():
+                last_busy = time.time()
+            wait_time_seconds = self.wait_time_seconds
+            if self.idle_timeout is not None:
+                remaining = self.idle_timeout - (time.time() - last_busy)
+                wait_time_seconds = max(0, min(wait_time_seconds,
+                                               int(math.ceil(remaining))))
+            messages = self.receive_messages(wait_time_seconds)
+            if not messages:
+                if self.idle_timeout is None:
+                    self.exit_cause = "empty"
+                    break
+                if time.time() - last_busy >= self.idle_timeout:
+                    self.exit_cause = "idle"
+                    break
+                continue
+            self.logger.info("Received {} message(s) from sqs queue {}".format(
+                len(messages), self.sqs_queue.url))
+            # The whole batch is kept alive by the heartbeat while the caller
+            # works through it, and what it does not get to is released.
+            for message in messages:
+                self.in_flight.add(message)
+            unstarted = list(messages)
+            try:
+                while unstarted and not self.stopping.is_set():
+                    yield unstarted.pop(0)
+            finally:
+                for message in unstarted:
+                    self.release_message(message)
+
+    def request_stop(self, cause="signal"):
+        """Makes `consume_messages` stop after the current message.
+
+        Safe to call from a signal handler.
+        """
+        self.stop_cause = cause
+        self.stopping.set()
 
-    def s3_objects(self):
-        """Generator over the s3 objects referenced by the sqs messages.
+    def finish_message(self, message):
+        """Marks a message as handled, so it will be deleted from the queue."""
+        self.in_flight.finish(message)
+
+    def release_message(self, message, delay=0):
+        """Returns a message to the queue, visible again after `delay`."""
+        self.in_flight.release(message, delay)
+
+    def stop_consuming(self):
+        """Deletes finished messages and releases any unhandled ones."""
+        self.in_flight.stop()
+
+    def receive_count(self, message):
+        """Returns how many times a message has been received, this time
+        included.
+        """
+        attributes = getattr(message, "attributes", None) or {}
+        return int(attributes.get("ApproximateReceiveCount", 1))
 
-        This generator is destructive; it deletes the sqs messages before
-        returning the s3 object.
+    def message_event_time(self, message):
+        """Returns when the s3 event in an sqs message happened, in seconds
+        since the epoch, or None if the event has no time.
         """
-        for message in self.consume_messages():
-            record = json.loads(message.body)
-            bucket_name = record["s3"]["bucket"]["name"]
-            key = record["s3"]["object"]["key"]
-            yield self.s3.Object(bucket_name, key)
+        record = json.loads(message.body)
+        if "eventTime" not in record:
+            return None
+        return event_time(record["eventTime"])
+
+    def s3_object_for_message(self, message):
+        """Returns the s3 object referenced by an sqs message."""
+        record = json.loads(message.body)
+        bucket_name = record["s3"]["bucket"]["name"]
+        key = record["s3"]["object"]["key"]
+        return self.s3.Object(bucket_name, key)
 
     def s3_object(self, bucket_name, key):
         """Returns an s3 object in the bucket with the key."""
         return self.s3.Object(bucket_name, key)
 
+    def object_etag(self, bucket_name, key):
+        """Returns the ETag of an s3 object, or None if it does not exist."""
+        s3_object = self.s3.Object(bucket_name, key)
+        try:
+            s3_object.load()
+        except botocore.exceptions.ClientError as e:
+            if _is_missing(e):
+                return None
+            else:
+                raise e
+        return s3_object.e_tag
+
+    def object_size(self, s3_object):
+        """Returns the size of an s3 object, or None if it does not exist."""
+        try:
+            s3_object.load()
+        except botocore.exceptions.ClientError as e:
+            if _is_missing(e):
+                return None
+            else:
+                raise e
+        return s3_object.content_length
+
+    def object_metadata(self, s3_object):
+        """Returns the user metadata of an s3 object.
+
+        Returns None if the object does not exist.
+        """
+        try:
+            s3_object.load()
+        except botocore.exceptions.ClientError as e:
+            if _is_missing(e):
+                return None
+            else:
+                raise e
+        return s3_object.metadata
+
+    def read_range(self, s3_object, start, length):
+        """Reads up to `length` bytes of an s3 object, starting at `start`.
+
+        Returns an empty string if the object ends before `start`, e.g. if
+        it is empty.
+        """
+        try:
+            response = s3_object.get(
+                Range="bytes={}-{}".format(start, start + length - 1))
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "InvalidRange":
+                return b""
+            raise
+        return response["Body"].read()
+
+    def get_json(self, bucket_name, key):
+        """Returns the parsed contents of a JSON s3 object.
+
+        Returns None if the object does not exist.
+        """
+        stream = self.open_object(self.s3.Object(bucket_name, key))
+        if stream is None:
+            return None
+        try:
+            return json.loads(stream.read())
+        finally:
+            stream.close()
+
+    def put_json(self, bucket_name, key, data):
+        """Writes `data` as a JSON s3 object."""
+        s3_object = self.s3.Object(bucket_name, key)
+        s3_object.put(Body=json.dumps(data), ContentType="application/json")
+        return s3_object
+
     def download_file(self, bucket_name, key, filename):
         """Downloads an s3 file to `filename`.
 
@@ -66,19 +241,65 @@ class MagicBucket(object):
         """Downloads an s3 object to `filename`.
 
         Returns true if the download is successful, false otherwise.
+        Large downloads resume from the spool, if there is one.
         """
+        settings = self.transfer_settings
+        progress = TransferProgress("Downloaded s3://{}/{}".format(
+            s3_object.bucket_name, s3_object.key))
         try:
-            s3_object.download_file(filename)
+            # Only look the size up when it matters.
+            if (settings.spool is not None and
+                    settings.resumes(s3_object.content_length)):
+                resumable.download(s3_object, filename, settings, progress)
+            else:
+                s3_object.download_file(
+                    filename, Config=settings.transfer_config(),
+                    Callback=progress)
         except botocore.exceptions.ClientError as e:
-            error_code = int(e.response["Error"]["Code"])
-            if error_code == 404:
+            if _is_missing(e):
                 return False
             else:
                 raise e
+        progress.finish()
+        verify(filename, s3_object, self.transfer_settings)
         return True
 
-    def upload_file(self, filename, bucket_name, key):
-        """Uploads an s3 file."""
+    def open_object(self, s3_object):
+        """Returns a stream over the s3 object's body.
+
+        Returns None if the object does not exist.
+        """
+        try:
+            return s3_object.get()["Body"]
+        except botocore.exceptions.ClientError as e:
+            if _is_missing(e):
+                return None
+            else:
+                raise e
+
+    def upload_file(self, filename, bucket_name, key, metadata=None):
+        """Uploads an s3 file, optionally with user metadata.
+
+        Large uploads resume from the spool, if there is one.
+        """
+        settings = self.transfer_settings
         s3_object = self.s3.Object(bucket_name, key)
-        s3_object.upload_file(filename)
+        progress = TransferProgress("Uploaded s3://{}/{}".format(
+            bucket_name, key))
+        if settings.resumes(os.path.getsize(filename)):
+            resumable.upload(s3_object, filename, settings, progress,
+                             metadata)
+        else:
+            extra_args = {"Metadata": metadata} if metadata else None
+            s3_object.upload_file(
+                filename, ExtraArgs=extra_args,
+                Config=settings.transfer_config(), Callback=progress)
+        progress.finish()
+        s3_object.reload()
+        verify(filename, s3_object, self.transfer_settings)
         return s3_object
+
+
+def _is_missing(client_error):
+    """Returns true if the client error means the s3 object does not exist."""
+    return client_error.response["Error"]["Code"] in ("404", "NoSuchKey")
@@ -0,0 +1,126 @@
+"""Bookkeeping for sqs messages that are being worked on."""
+
+import logging
+import threading
+
+MAX_BATCH_SIZE = 10
+
+
+class InFlightMessages(object):
+    """Keeps received sqs messages alive until they are finished.
+
+    A background thread periodically extends the visibility timeout of every
+    in-flight message, so a long task keeps its message hidden from other
+    consumers, while a message whose container dies reappears on the queue
+    after at most one visibility timeout. Finished messages are deleted in
+    batches.
+    """
+
+    DEFAULT_VISIBILITY_TIMEOUT = 120
+
+    def __init__(self, sqs_queue, visibility_timeout=None):
+        self.sqs_queue = sqs_queue
+        self.visibility_timeout = (visibility_timeout or
+                                   self.DEFAULT_VISIBILITY_TIMEOUT)
+        self.interval = self.visibility_timeout / 3.0
+        self.logger = logging.getLogger("magic-bucket")
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.finished = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Starts the heartbeat thread, if it is not already running."""
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="heartbeat")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops the heartbeat, deleting finished messages.
+
+        Messages that are still in flight are released back to the queue.
+        """
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        with self.lock:
+            messages = self.messages.values()
+            self.messages = {}
+        self._change_visibility(messages, 0)
+
+    def count(self):
+        """Returns the number of messages in flight."""
+        with self.lock:
+            return len(self.messages)
+
+    def add(self, message):
+        """Starts tracking a received message."""
+        with self.lock:
+            self.messages[message.receipt_handle] = message
+
+    def finish(self, message):
+        """Schedules a message for deletion."""
+        with self.lock:
+            self.messages.pop(message.receipt_handle, None)
+            self.finished.append(message)
+            flush = len(self.finished) >= MAX_BATCH_SIZE
+        if flush:
+            self.flush()
+
+    def release(self, message, delay=0):
+        """Stops tracking a message and makes it visible after `delay`."""
+        with self.lock:
+            self.messages.pop(message.receipt_handle, None)
+        self._change_visibility([message], delay)
+
+    def flush(self):
+        """Deletes all finished messages."""
+        with self.lock:
+            messages = self.finished
+            self.finished = []
+        for batch in _batches(messages):
+            response = self.sqs_queue.delete_messages(Entries=[
+                {"Id": str(i), "ReceiptHandle": message.receipt_handle}
+                for i, message in enumerate(batch)])
+            self._log_failures("delete", response)
+            self.logger.info("Deleted {} message(s) from sqs queue {}".format(
+                len(batch), self.sqs_queue.url))
+
+    def extend(self):
+        """Extends the visibility timeout of all in-flight messages."""
+        with self.lock:
+            messages = self.messages.values()
+        self._change_visibility(messages, self.visibility_timeout)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.extend()
+                self.flush()
+            except Exception:
+                self.logger.exception("Error in sqs heartbeat")
+
+    def _change_visibility(self, messages, visibility_timeout):
+        for batch in _batches(list(messages)):
+            response = self.sqs_queue.change_message_visibility_batch(
+                Entries=[{"Id": str(i),
+                          "ReceiptHandle": message.receipt_handle,
+                          "VisibilityTimeout": visibility_timeout}
+                         for i, message in enumerate(batch)])
+            self._log_failures("change visibility of", response)
+
+    def _log_failures(self, action, response):
+        for failure in response.get("Failed", []):
+            self.logger.warning("Could not {} sqs message {}: {}".format(
+                action, failure["Id"], failure.get("Message")))
+
+
+def _batches(items):
+    for i in range(0, len(items), MAX_BATCH_SIZE):
+        yield items[i:i + MAX_BATCH_SIZE]
@@ -0,0 +1,200 @@
+"""Per-phase timing and throughput metrics for jobs."""
+
+import calendar
+import collections
+import contextlib
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+
+PHASES = ["queue_wait", "download", "extract", "process", "upload"]
+
+
+class JobMetrics(object):
+    """Duration, bytes and throughput of each phase of one job."""
+
+    def __init__(self, task_name, key, member=None):
+        self.task_name = task_name
+        self.key = key
+        self.member = member
+        self.phases = collections.OrderedDict()
+        self.subprocesses = []
+        self.extra = {}
+
+    def record(self, phase, seconds, bytes=None):
+        """Adds `seconds` (and `bytes`) to a phase."""
+        entry = self.phases.setdefault(phase, {"seconds": 0.0, "bytes": None})
+        entry["seconds"] += seconds
+        if bytes is not None:
+            entry["bytes"] = (entry["bytes"] or 0) + bytes
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times a phase. Set `bytes` on the yielded dictionary, if known."""
+        counters = {"bytes": None}
+        start = time.time()
+        try:
+            yield counters
+        finally:
+            self.record(name, time.time() - start, counters["bytes"])
+
+    def as_dict(self):
+        phases = collections.OrderedDict()
+        for name, entry in self.phases.items():
+            phase = dict(entry)
+            if entry["bytes"] is not None and entry["seconds"] > 0:
+                phase["bytes_per_second"] = entry["bytes"] / entry["seconds"]
+            phases[name] = phase
+        record = collections.OrderedDict([
+            ("time", time.time()),
+            ("task", self.task_name),
+            ("key", self.key),
+            ("member", self.member),
+            ("phases", phases),
+            ("subprocesses", self.subprocesses),
+        ])
+        record.update(self.extra)
+        return record
+
+
+class MetricsSummary(object):
+    """Collects phase durations, and each task's job latencies, over a
+    worker's lifetime.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.seconds = collections.defaultdict(list)
+        self.latencies = collections.defaultdict(list)
+        self.jobs = 0
+
+    def add(self, record):
+        with self.lock:
+            self.jobs += 1
+            for name, phase in record["phases"].items():
+                self.seconds[name].append(phase["seconds"])
+            if record.get("latency") is not None:
+                self.latencies[record["task"]].append(record["latency"])
+
+    def as_dict(self):
+        """Returns the count, p50 and p95 of each phase's duration, and of
+        each task's latency, with its throughput in jobs per minute.
+        """
+        with self.lock:
+            phases = collections.OrderedDict()
+            for name in sorted(self.seconds, key=_phase_order):
+                phases[name] = _distribution(self.seconds[name])
+            minutes = (time.time() - self.start) / 60.0
+            tasks = collections.OrderedDict()
+            for name in sorted(self.latencies):
+                tasks[name] = _distribution(self.latencies[name])
+                if minutes > 0:
+                    tasks[name]["per_minute"] = (len(self.latencies[name]) /
+                                                 minutes)
+            return {"jobs": self.jobs, "phases": phases, "tasks": tasks}
+
+
+def percentile(values, p):
+    """Returns the `p`th percentile of sorted `values`, by nearest rank."""
+    if not values:
+        return None
+    rank = int(-(-len(values) * p // 100))
+    return values[max(rank, 1) - 1]
+
+
+def event_time(timestamp):
+    """Parses an s3 event time, e.g. `2016-05-20T18:12:02.123Z`, into
+    seconds since the epoch.
+    """
+    # Not `time.strptime`, which is not thread-safe in python 2.
+    seconds, _, fraction = timestamp.rstrip("Z").partition(".")
+    date, _, clock = seconds.partition("T")
+    parsed = calendar.timegm([int(part) for part in date.split("-")] +
+                             [int(part) for part in clock.split(":")])
+    return parsed + (float("0." + fraction) if fraction else 0.0)
+
+
+class StreamSink(object):
+    """Writes one JSON record per line to a stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock:
+            self.stream.write(json.dumps(record) + "\n")
+            self.stream.flush()
+
+
+class FileSink(StreamSink):
+    """Appends one JSON record per line to a file."""
+
+    def __init__(self, filename):
+        super(FileSink, self).__init__(open(filename, "a"))
+
+
+class UdpSink(object):
+    """Sends StatsD-style timers and counters over UDP.
+
+    Summary records are skipped; StatsD computes its own percentiles.
+    """
+
+    def __init__(self, host, port, prefix="magic_bucket"):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, record):
+        if "phases" not in record or "task" not in record:
+            return
+        task = record["task"].replace(".", "_")
+        lines = []
+        for name, phase in record["phases"].items():
+            lines.append("{}.{}.{}.seconds:{:.0f}|ms".format(
+                self.prefix, task, name, phase["seconds"] * 1000))
+            if phase.get("bytes") is not None:
+                lines.append("{}.{}.{}.bytes:{}|c".format(
+                    self.prefix, task, name, phase["bytes"]))
+        if record.get("event_latency") is not None:
+            lines.append("{}.{}.{}.event_latency:{:.0f}|ms".format(
+                self.prefix, task, record.get("path", "queue"),
+                record["event_latency"] * 1000))
+        try:
+            self.socket.sendto("\n".join(lines).encode("utf-8"),
+                               self.address)
+        except socket.error as e:
+            logging.getLogger("magic-bucket").warning(
+                "Could not send metrics: {}".format(e))
+
+
+def create_sink(spec):
+    """Creates a sink from `stdout`, `file:<path>` or `udp:<host>:<port>`.
+
+    Returns None for an empty spec.
+    """
+    if not spec:
+        return None
+    kind, _, argument = spec.partition(":")
+    if kind == "stdout":
+        return StreamSink(sys.stdout)
+    elif kind == "file":
+        return FileSink(argument)
+    elif kind == "udp":
+        host, _, port = argument.rpartition(":")
+        return UdpSink(host, port)
+    raise ValueError("Unknown metrics sink: {}".format(spec))
+
+
+def _distribution(values):
+    values = sorted(values)
+    return {"count": len(values), "p50": percentile(values, 50),
+            "p95": percentile(values, 95)}
+
+
+def _phase_order(name):
+    return (PHASES.index(name) if name in PHASES else len(PHASES), name)
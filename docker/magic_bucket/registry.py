@@ -0,0 +1,58 @@
+"""The task registry: which tasks exist, and where they run.
+
+The registry is a JSON file, `tasks.json`, shared with the lambda. Each
+task's top-level prefix in the bucket names it, and each task belongs to a
+pool: an sqs queue, and the ECS task definition (named after the pool) with
+the cpu, memory and (download) concurrency of the containers that drain
+it. Short tasks get their own pool, so they never wait behind long ones.
+A task's `inline_max_size` lets the lambda run objects of up to that many
+megabytes itself.
+"""
+
+import json
+import os
+
+REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "tasks.json")
+
+
+class TaskRegistry(object):
+    """The tasks and pools declared in a registry file.
+
+    Workers only ask which tasks exist. Routing to pools is left to
+    `lambda.py`, which reads the same file without this package.
+    """
+
+    def __init__(self, data):
+        self.default_pool = data["default_pool"]
+        self.pools = data["pools"]
+        self.tasks = data["tasks"]
+
+    @classmethod
+    def load(cls, filename=None):
+        """Loads `filename`, `MAGIC_BUCKET_TASK_REGISTRY`, or `tasks.json`
+        next to this module.
+        """
+        filename = (filename or os.environ.get("MAGIC_BUCKET_TASK_REGISTRY")
+                    or REGISTRY_FILE)
+        with open(filename) as f:
+            return cls(json.load(f))
+
+    def __contains__(self, task_name):
+        return task_name in self.tasks
+
+
+_registry = None
+
+
+def registry():
+    """Returns the registry, loading it on first use."""
+    global _registry
+    if _registry is None:
+        _registry = TaskRegistry.load()
+    return _registry
+
+
+def task_name(key):
+    """Returns the task an s3 key belongs to: its top-level prefix."""
+    return key.split("/", 1)[0]
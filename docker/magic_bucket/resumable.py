@@ -0,0 +1,298 @@
+"""Resumable s3 transfers, checkpointed in a spool directory.
+
+Transfers of at least `TransferSettings.resume_threshold` bytes are split
+into parts, and progress is recorded in a small JSON checkpoint in the
+spool. If a worker is stopped or its connection drops, the next attempt, on
+any worker that shares the spool, verifies the parts that were done and
+carries on with the rest: downloads keep their partial file in the spool,
+and uploads reuse their multipart upload.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from Queue import Empty, Queue
+
+import botocore
+
+from transfer import MB, TransferIntegrityError
+
+MAX_PART_ATTEMPTS = 3
+# Checkpoints that have not been touched for this long are pruned.
+MAX_CHECKPOINT_AGE = 7 * 24 * 60 * 60
+
+logger = logging.getLogger("magic-bucket")
+
+
+class Checkpoint(object):
+    """The state of one transfer, saved as JSON in the spool.
+
+    A download also keeps its partial file, `data_path`, next to it.
+    """
+
+    def __init__(self, spool, kind, bucket_name, key):
+        name = hashlib.sha1("{}:{}/{}".format(kind, bucket_name,
+                                              key)).hexdigest()
+        self.path = os.path.join(spool, name + ".json")
+        self.data_path = os.path.join(spool, name + ".part")
+        self.lock = threading.RLock()
+        self.state = {}
+
+    def load(self):
+        """Reads the saved state, which is empty if there is none."""
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        except (IOError, ValueError):
+            self.state = {}
+        return self.state
+
+    def save(self):
+        """Writes the state, atomically."""
+        with self.lock:
+            temporary = self.path + ".tmp"
+            with open(temporary, "w") as f:
+                json.dump(self.state, f)
+            os.rename(temporary, self.path)
+
+    def record_part(self, number, md5):
+        """Records a finished part and saves the state."""
+        with self.lock:
+            self.state["parts"][str(number)] = md5
+            self.save()
+
+    def remove(self):
+        for path in (self.path, self.data_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def download(s3_object, filename, settings, progress):
+    """Downloads an s3 object to `filename` in ranged parts, resuming a
+    previous attempt from the spool.
+
+    The partial download is discarded if the object has changed since.
+    """
+    checkpoint = _checkpoint(settings, "download", s3_object)
+    size = s3_object.content_length
+    etag = s3_object.e_tag
+    state = checkpoint.load()
+    if (state.get("etag") != etag or state.get("size") != size or
+            state.get("part_size") != settings.part_size or
+            not os.path.exists(checkpoint.data_path)):
+        with open(checkpoint.data_path, "wb") as f:
+            f.truncate(size)
+        checkpoint.state = {"etag": etag, "size": size,
+                            "part_size": settings.part_size, "parts": {}}
+        checkpoint.save()
+    parts = _parts(size, settings.part_size)
+    done = set()
+    for number, start, length in parts:
+        md5 = checkpoint.state["parts"].get(str(number))
+        if md5 is not None and md5 == _md5(checkpoint.data_path, start,
+                                           length):
+            done.add(number)
+            progress(length)
+        else:
+            checkpoint.state["parts"].pop(str(number), None)
+    _log_resume("download", s3_object, len(done), len(parts))
+
+    def transfer(part):
+        number, start, length = part
+        body = s3_object.get(Range="bytes={}-{}".format(
+            start, start + length - 1), IfMatch=etag)["Body"]
+        md5 = hashlib.md5()
+        written = 0
+        with open(checkpoint.data_path, "r+b") as f:
+            f.seek(start)
+            for chunk in iter(lambda: body.read(settings.IO_CHUNK_SIZE),
+                              b""):
+                f.write(chunk)
+                md5.update(chunk)
+                written += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        if written != length:
+            raise TransferIntegrityError(
+                "Part {} of s3://{}/{} has {} bytes, expected {}".format(
+                    number, s3_object.bucket_name, s3_object.key, written,
+                    length))
+        checkpoint.record_part(number, md5.hexdigest())
+        progress(length)
+
+    _run_parts(transfer, [part for part in parts if part[0] not in done],
+               settings.effective_concurrency())
+    shutil.move(checkpoint.data_path, filename)
+    checkpoint.remove()
+
+
+def upload(s3_object, filename, settings, progress, metadata=None):
+    """Uploads `filename` to an s3 object in a multipart upload, reusing
+    the upload of a previous attempt from the spool.
+
+    Parts that were uploaded already are kept if their ETag matches the md5
+    of the same range of the file; the rest are uploaded again.
+    """
+    checkpoint = _checkpoint(settings, "upload", s3_object)
+    size = os.path.getsize(filename)
+    state = checkpoint.load()
+    multipart_upload = None
+    uploaded = {}
+    if (state.get("size") == size and
+            state.get("part_size") == settings.part_size and
+            state.get("metadata") == metadata):
+        multipart_upload = s3_object.MultipartUpload(state["upload_id"])
+        try:
+            uploaded = dict((part.part_number, part.e_tag)
+                            for part in multipart_upload.parts.all())
+        except botocore.exceptions.ClientError as e:
+            if not _is_missing_upload(e):
+                raise
+            multipart_upload = None
+    elif state.get("upload_id"):
+        _abort(s3_object.MultipartUpload(state["upload_id"]))
+    if multipart_upload is None:
+        extra_args = {"Metadata": metadata} if metadata else {}
+        multipart_upload = s3_object.initiate_multipart_upload(**extra_args)
+        checkpoint.state = {"upload_id": multipart_upload.id, "size": size,
+                            "part_size": settings.part_size,
+                            "metadata": metadata}
+        checkpoint.save()
+    parts = _parts(size, settings.part_size)
+    etags = {}
+    for number, start, length in parts:
+        etag = uploaded.get(number)
+        if etag is not None and etag.strip('"') == _md5(filename, start,
+                                                        length):
+            etags[number] = etag
+            progress(length)
+    _log_resume("upload", s3_object, len(etags), len(parts))
+
+    def transfer(part):
+        number, start, length = part
+        with open(filename, "rb") as f:
+            f.seek(start)
+            data = f.read(length)
+        md5 = hashlib.md5(data)
+        response = multipart_upload.Part(number).upload(
+            Body=data, ContentMD5=base64.b64encode(md5.digest()))
+        if response["ETag"].strip('"') != md5.hexdigest():
+            raise TransferIntegrityError(
+                "Part {} of s3://{}/{} has ETag {}, expected {}".format(
+                    number, s3_object.bucket_name, s3_object.key,
+                    response["ETag"], md5.hexdigest()))
+        etags[number] = response["ETag"]
+        progress(length)
+
+    _run_parts(transfer, [part for part in parts if part[0] not in etags],
+               settings.effective_concurrency())
+    multipart_upload.complete(MultipartUpload={"Parts": [
+        {"ETag": etags[number], "PartNumber": number}
+        for number in sorted(etags)]})
+    checkpoint.remove()
+
+
+def prune(spool, max_age=MAX_CHECKPOINT_AGE):
+    """Removes checkpoints, and partial downloads, that are too old to be
+    resumed.
+
+    Multipart uploads are left to the bucket's lifecycle rules.
+    """
+    now = time.time()
+    for name in os.listdir(spool):
+        path = os.path.join(spool, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _checkpoint(settings, kind, s3_object):
+    if not os.path.isdir(settings.spool):
+        os.makedirs(settings.spool)
+    prune(settings.spool)
+    return Checkpoint(settings.spool, kind, s3_object.bucket_name,
+                      s3_object.key)
+
+
+def _parts(size, part_size):
+    """Returns the number, start and length of each part, numbered from 1.
+    """
+    return [(i // part_size + 1, i, min(part_size, size - i))
+            for i in range(0, size, part_size)] or [(1, 0, 0)]
+
+
+def _md5(filename, start, length):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(MB, remaining))
+            if not chunk:
+                break
+            md5.update(chunk)
+            remaining -= len(chunk)
+    return md5.hexdigest()
+
+
+def _run_parts(function, parts, concurrency):
+    """Runs `function` on each part in `concurrency` threads, trying each
+    part up to `MAX_PART_ATTEMPTS` times.
+
+    Raises the first error once all threads have stopped; the parts that
+    were done are kept in the checkpoint for the next attempt.
+    """
+    queue = Queue()
+    for part in parts:
+        queue.put(part)
+    errors = []
+
+    def run():
+        while not errors:
+            try:
+                part = queue.get_nowait()
+            except Empty:
+                return
+            for attempt in range(MAX_PART_ATTEMPTS):
+                try:
+                    function(part)
+                    break
+                except Exception as e:
+                    if attempt + 1 == MAX_PART_ATTEMPTS:
+                        errors.append(e)
+                        return
+                    logger.warning("Retrying part {}: {}".format(part[0], e))
+
+    threads = [threading.Thread(target=run, name="part-{}".format(i))
+               for i in range(min(concurrency, len(parts)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _log_resume(kind, s3_object, done, count):
+    if done:
+        logger.info("Resuming {} of s3://{}/{}: {} of {} parts done".format(
+            kind, s3_object.bucket_name, s3_object.key, done, count))
+
+
+def _abort(multipart_upload):
+    try:
+        multipart_upload.abort()
+    except botocore.exceptions.ClientError as e:
+        if not _is_missing_upload(e):
+            raise
+
+
+def _is_missing_upload(client_error):
+    return client_error.response["Error"]["Code"] in ("404", "NoSuchUpload")
@@ -0,0 +1,167 @@
+"""Runs external tools with bounded memory use."""
+
+import errno
+import os
+import subprocess
+import threading
+import time
+
+from exceptions import MagicBucketException
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_TAIL_SIZE = 64 * 1024
+
+
+class SubprocessError(MagicBucketException):
+    """Some subprocess exited improperly."""
+
+    def __init__(self, args, returncode, output):
+        super(SubprocessError, self).__init__(
+            "Subprocess error: Command '{}' returned non-zero exit status {} "
+            "with output {}".format(args, returncode, output))
+        self.output = output
+        self.returncode = returncode
+
+
+class SubprocessTimeout(SubprocessError):
+    """Some subprocess ran out of time and was killed."""
+
+    def __init__(self, args, timeout, output):
+        MagicBucketException.__init__(
+            self, "Subprocess timeout: Command '{}' was killed after {:.1f} "
+            "seconds with output {}".format(args, timeout, output))
+        self.output = output
+        self.returncode = None
+
+
+class ProcessResult(object):
+    """What a finished subprocess returned, and what it cost."""
+
+    def __init__(self, args, returncode, output, seconds, rusage):
+        self.args = args
+        self.returncode = returncode
+        self.output = output
+        self.seconds = seconds
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        # Linux reports kilobytes.
+        self.max_rss = rusage.ru_maxrss * 1024
+
+    def as_dict(self):
+        return {"tool": os.path.basename(self.args[0]),
+                "returncode": self.returncode,
+                "seconds": self.seconds,
+                "cpu_seconds": self.user_time + self.system_time,
+                "max_rss": self.max_rss}
+
+    def __str__(self):
+        return "{} in {:.1f} s ({:.1f} s cpu, {:.0f} MB peak rss)".format(
+            os.path.basename(self.args[0]), self.seconds,
+            self.user_time + self.system_time, self.max_rss / 1024.0 / 1024)
+
+
+class Tail(object):
+    """Keeps the last `size` bytes written to it."""
+
+    def __init__(self, size=DEFAULT_TAIL_SIZE):
+        self.size = size
+        self.data = b""
+        self.truncated = False
+
+    def write(self, data):
+        self.data += data
+        if len(self.data) > self.size:
+            self.data = self.data[-self.size:]
+            self.truncated = True
+
+    def getvalue(self):
+        if self.truncated:
+            return b"[...]" + self.data
+        return self.data
+
+
+def run(args, cwd=None, stdout=None, timeout=None,
+        tail_size=DEFAULT_TAIL_SIZE):
+    """Runs `args` to completion without holding its output in memory.
+
+    If `stdout` is given, the subprocess's standard output goes straight to
+    it (a real file is handed to the subprocess, anything else with a
+    `write` method is fed from a pipe) and only the tail of standard error
+    is kept. Otherwise the tail of the combined output is kept. The
+    subprocess is killed after `timeout` seconds.
+
+    Returns a `ProcessResult`, whose `output` is the kept tail.
+    """
+    start = time.time()
+    copy_stdout = False
+    if stdout is None:
+        process = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        tail_stream = process.stdout
+    else:
+        try:
+            stdout.flush()
+            target = stdout.fileno()
+        except (AttributeError, IOError, ValueError):
+            target = subprocess.PIPE
+            copy_stdout = True
+        process = subprocess.Popen(args, cwd=cwd, stdout=target,
+                                   stderr=subprocess.PIPE)
+        tail_stream = process.stderr
+    tail = Tail(tail_size)
+    threads = [threading.Thread(target=_drain,
+                                args=(tail_stream, tail.write))]
+    if copy_stdout:
+        threads.append(threading.Thread(target=_drain,
+                                        args=(process.stdout, stdout.write)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    timed_out = threading.Event()
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(max(timeout, 0), _kill,
+                                args=(process, timed_out))
+        timer.start()
+    try:
+        _, status, rusage = _wait(process.pid)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    # Popen must not try to reap the child again.
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    for thread in threads:
+        thread.join()
+    output = tail.getvalue()
+    if timed_out.is_set():
+        raise SubprocessTimeout(args, timeout, output)
+    if process.returncode != 0:
+        raise SubprocessError(args, process.returncode, output)
+    return ProcessResult(args, process.returncode, output,
+                         time.time() - start, rusage)
+
+
+def _wait(pid):
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def _drain(stream, write):
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        write(chunk)
+    stream.close()
+
+
+def _kill(process, timed_out):
+    timed_out.set()
+    try:
+        process.kill()
+    except OSError:
+        pass
@@ -1,34 +1,152 @@
+import collections
+import logging
+import threading
+import time
+from Queue import Empty, Queue
+
 from slackclient import SlackClient
 
 
 class Slack(object):
-    """Wrapper around the slack client to provide utility methods."""
+    """Wrapper around the slack client to provide utility methods.
+
+    Messages are posted by a background thread, so notifying never blocks
+    a task. Messages with a `group` (e.g. an s3 directory) are collected and
+    posted every `digest_interval` seconds as one digest per group, e.g.
+    "48 succeeded, 2 failed in pdal-translate/to-laz". Failures are always
+    posted right away as well. Call `close` to post what is left before
+    exiting.
+
+    `client` can be any object with the slack client's `api_call`, e.g. a
+    fake for testing.
+    """
 
     DEFAULT_CHANNEL = "#magic-bucket-notify"
     DEFAULT_USERNAME = "bucketbot"
+    DEFAULT_DIGEST_INTERVAL = 60
+    MAX_ATTEMPTS = 5
+    EMOJI = {
+        "info": ":information_desk_person:",
+        "success": ":the_horns:",
+        "fail": ":sadpanda:",
+    }
+    DIGEST_LABELS = [("success", "succeeded"), ("fail", "failed"),
+                     ("info", "started")]
 
-    def __init__(self, token):
+    def __init__(self, token, client=None, digest_interval=None):
         """Creates a new slack interface."""
-        self.client = SlackClient(token)
+        self.client = client or SlackClient(token)
         self.channel = self.DEFAULT_CHANNEL
         self.username = self.DEFAULT_USERNAME
+        self.digest_interval = (digest_interval or
+                                self.DEFAULT_DIGEST_INTERVAL)
+        self.logger = logging.getLogger("magic-bucket")
+        self.lock = threading.Lock()
+        self.groups = collections.OrderedDict()
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run, name="slack")
+        self.thread.daemon = True
+        self.thread.start()
 
-    def info(self, message):
+    def info(self, message, group=None):
         """Send an information message."""
-        self.post_message(message, message_emoji=":information_desk_person:")
+        self.notify("info", message, group)
 
-    def success(self, message):
+    def success(self, message, group=None):
         """Send an success message."""
-        self.post_message(message, message_emoji=":the_horns:")
+        self.notify("success", message, group)
 
-    def fail(self, message):
+    def fail(self, message, group=None):
         """Send a fail message."""
-        self.post_message(message, message_emoji=":sadpanda:")
+        self.notify("fail", message, group)
+
+    def notify(self, kind, message, group=None):
+        """Queues a message, or adds it to its group's next digest."""
+        if group is None or kind == "fail":
+            self.post_message(message, message_emoji=self.EMOJI[kind])
+        if group is not None:
+            with self.lock:
+                self.groups.setdefault(group, []).append((kind, message))
 
     def post_message(self, message, message_emoji=None):
-        """Post a message to the pre-configured channel."""
+        """Queue a message for the pre-configured channel."""
         if message_emoji is not None:
             message = "{} {}".format(message_emoji, message)
-        self.client.api_call(
-            "chat.postMessage", channel=self.channel,
-            text=message, username=self.username)
+        self.queue.put(message)
+
+    def flush_digests(self):
+        """Queues a digest for every group with new messages."""
+        with self.lock:
+            groups = self.groups
+            self.groups = collections.OrderedDict()
+        for group, notes in groups.items():
+            digest = self.digest(group, notes)
+            if digest is not None:
+                self.queue.put(digest)
+
+    def digest(self, group, notes):
+        """Summarizes a group's messages.
+
+        A lone message is passed on as it is. Returns None if there is
+        nothing new, i.e. only failures, which have already been posted.
+        """
+        kinds = [kind for kind, _ in notes]
+        if all(kind == "fail" for kind in kinds):
+            return None
+        if len(notes) == 1:
+            kind, message = notes[0]
+            return "{} {}".format(self.EMOJI[kind], message)
+        counts = ["{} {}".format(kinds.count(kind), label)
+                  for kind, label in self.DIGEST_LABELS if kind in kinds]
+        if "fail" in kinds:
+            emoji = self.EMOJI["fail"]
+        elif "success" in kinds:
+            emoji = self.EMOJI["success"]
+        else:
+            emoji = self.EMOJI["info"]
+        return "{} {} in `{}`".format(emoji, ", ".join(counts), group)
+
+    def close(self, timeout=None):
+        """Posts the remaining digests and messages, then stops."""
+        self.flush_digests()
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        next_digest = time.time() + self.digest_interval
+        while True:
+            remaining = next_digest - time.time()
+            if remaining <= 0:
+                self.flush_digests()
+                next_digest = time.time() + self.digest_interval
+                continue
+            try:
+                message = self.queue.get(timeout=remaining)
+            except Empty:
+                continue
+            if message is None:
+                return
+            self._send(message)
+
+    def _send(self, message):
+        """Posts a message, waiting out slack's rate limits."""
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                response = self.client.api_call(
+                    "chat.postMessage", channel=self.channel,
+                    text=message, username=self.username)
+            except Exception as e:
+                self.logger.warning("Could not post to slack: {}".format(e))
+                delay = 2 ** attempt
+            else:
+                if not isinstance(response, dict) or response.get("ok", True):
+                    return
+                if response.get("error") != "ratelimited":
+                    self.logger.warning("Could not post to slack: {}".format(
+                        response.get("error")))
+                    return
+                headers = response.get("headers") or {}
+                delay = float(headers.get("Retry-After", 2 ** attempt))
+            if attempt + 1 < self.MAX_ATTEMPTS:
+                time.sleep(delay)
+        self.logger.warning("Giving up on slack message: {}".format(message))
@@ -1,11 +1,14 @@
-import os
-
 from ..exceptions import MagicBucketException
+from ..registry import registry, task_name
 from ape_near_field_prcs import ApeNearFieldPrcs
+from chain import Chain
 from pdal_info import PdalInfo
 from pdal_translate import PdalTranslate
 from rimtatls import Rimtatls
 
+TASK_CLASSES = dict((task.NAME, task) for task in [
+    ApeNearFieldPrcs, Chain, PdalInfo, PdalTranslate, Rimtatls])
+
 
 class UnknownTask(MagicBucketException):
     """The provided task name is unknown."""
@@ -15,21 +18,12 @@ class UnknownTask(MagicBucketException):
 
 
 def create_task(magic_bucket, s3_object):
-    """Creates a task for the given s3 object."""
-    task_name = s3_object.key
-    while True:
-        dirname = os.path.dirname(task_name)
-        if dirname == "":
-            break
-        else:
-            task_name = dirname
-    if task_name == "pdal-translate":
-        return PdalTranslate(magic_bucket, s3_object)
-    elif task_name == "rimtatls":
-        return Rimtatls(magic_bucket, s3_object)
-    elif task_name == "pdal-info":
-        return PdalInfo(magic_bucket, s3_object)
-    elif task_name == "ape-near-field-prcs":
-        return ApeNearFieldPrcs(magic_bucket, s3_object)
-    else:
-        raise UnknownTask(task_name)
+    """Creates a task for the given s3 object.
+
+    The task is named by the object's top-level prefix, and must be both
+    declared in the registry and implemented here.
+    """
+    name = task_name(s3_object.key)
+    if name not in registry() or name not in TASK_CLASSES:
+        raise UnknownTask(name)
+    return TASK_CLASSES[name](magic_bucket, s3_object)
@@ -1,4 +1,6 @@
 import os
+import threading
+import time
 
 from ..exceptions import MagicBucketException
 from task import Task
@@ -9,36 +11,94 @@ class MissingFixedFile(MagicBucketException):
 
 
 class ApeNearFieldPrcs(Task):
-    """Run ATLAS's near-field-prcs cpd."""
+    """Run ATLAS's near-field-prcs cpd.
 
-    DEFAULT_FIXED_LAZ = "150728_180208.mta.laz"
+    The fixed cloud's ETag is looked up at most once every
+    `FIXED_ETAG_SECONDS` per worker, and its `.las` conversion is kept in
+    the artifact cache, so scans only download and convert it again when
+    it changes. Each scan is converted to `.las` as soon as it is
+    downloaded (or extracted, for archive members), so with a download
+    concurrency above one, as in its pool, the worker converts the next
+    scans while `ape` registers this one. Each `.dat` is uploaded as soon as
+    it is done.
+    """
+
+    APE = "/root/.cargo/bin/ape"
+    FIXED_ETAG_SECONDS = 60
     DEFAULT_FIXED = "150728_180208.mta.las"
     FIXED_S3_KEY = "pdal-translate/ATLAS/near-field-prcs/output/150728_180208.mta.laz"
     NAME = "ape-near-field-prcs"
+    TOOLS = ["pdal", APE]
+    # The input, its .las conversion (about five times a .laz) and a small
+    # output; cpd holds both clouds in memory.
+    DISK_FACTOR = 6.0
+    # A .las scan is not converted, so only it and the output are on disk.
+    LAS_DISK_FACTOR = 1.5
+    MEMORY_FACTOR = 5.0
+
+    fixed_etags = {}
+    fixed_etags_lock = threading.Lock()
 
     def __init__(self, magic_bucket, s3_object):
         super(ApeNearFieldPrcs, self).__init__(magic_bucket, s3_object)
-        self.fixed_laz = self.DEFAULT_FIXED_LAZ
         self.fixed = self.DEFAULT_FIXED
 
     def name(self):
         return self.NAME
 
-    def process(self, laz_filename):
-        if not os.path.isfile(self.fixed):
-            if not self.download_fixed_laz():
+    def disk_factor(self):
+        """Returns the disk factor of the scan, inside an archive or not."""
+        root, extension = os.path.splitext(self.key.lower())
+        if extension in self.ARCHIVE_EXPANSION:
+            extension = os.path.splitext(root)[1]
+        if extension == ".las":
+            return self.LAS_DISK_FACTOR
+        return self.DISK_FACTOR
+
+    def fixed_etag(self):
+        """Returns the fixed cloud's ETag, looked up again once the last
+        lookup is `FIXED_ETAG_SECONDS` old.
+        """
+        fixed = (self.bucket_name, self.FIXED_S3_KEY)
+        with self.fixed_etags_lock:
+            etag, looked_up = self.fixed_etags.get(fixed, (None, 0))
+            if time.time() - looked_up > self.FIXED_ETAG_SECONDS:
+                etag = self.magic_bucket.object_etag(*fixed)
+                self.fixed_etags[fixed] = (etag, time.time())
+        return etag
+
+    def fingerprint_inputs(self):
+        return {"fixed": self.fixed_etag()}
+
+    def prepare_input(self, filename):
+        """Converts a scan to the `.las` that `ape` reads, removing the
+        original.
+        """
+        las_filename = os.path.splitext(filename)[0] + ".las"
+        if filename == las_filename:
+            return filename
+        with self.metrics.phase("extract") as phase:
+            self.subprocess(["pdal", "translate", filename, las_filename])
+            phase["bytes"] = os.path.getsize(las_filename)
+        os.remove(filename)
+        return las_filename
+
+    def process(self, filename):
+        fixed = self.path(self.fixed)
+        if not os.path.isfile(fixed):
+            etag = self.fixed_etag()
+            if etag is None or not self.magic_bucket.cache.derive(
+                    self.bucket_name, self.FIXED_S3_KEY,
+                    os.path.splitext(self.fixed)[1], self.translate, fixed,
+                    etag):
                 raise MissingFixedFile()
-            self.subprocess(["pdal", "translate", self.fixed_laz, self.fixed])
-        filename = os.path.splitext(laz_filename)[0] + ".las"
-        self.subprocess(["pdal", "translate", laz_filename, filename])
         output = os.path.splitext(filename)[0] + ".dat"
-        args = ["/root/.cargo/bin/ape", "cpd", self.fixed, filename, output]
+        args = [self.APE, "cpd", fixed, filename, output]
         self.logger.info("Running {}".format(args))
         stdout = self.subprocess(args)
         self.logger.info("Complete: {}".format(stdout))
         return output
 
-    def download_fixed_laz(self):
-        return self.magic_bucket.download_file(self.bucket_name,
-                                               self.FIXED_S3_KEY,
-                                               self.fixed_laz)
+    def translate(self, source, output):
+        """Translates the fixed cloud to the format `ape` reads."""
+        self.subprocess(["pdal", "translate", source, output])
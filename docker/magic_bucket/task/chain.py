@@ -0,0 +1,104 @@
+import json
+import os
+
+from ape_near_field_prcs import ApeNearFieldPrcs
+from pdal_info import PdalInfo
+from pdal_translate import InvalidConfig, PdalTranslate
+from rimtatls import Rimtatls
+from task import Task
+
+STEP_TASKS = dict((task.NAME, task) for task in
+                  [ApeNearFieldPrcs, PdalInfo, PdalTranslate, Rimtatls])
+
+
+class MissingChainFile(InvalidConfig):
+    """No chain file was found."""
+
+    def __init__(self):
+        super(MissingChainFile, self).__init__(
+            "Missing chain file for chain task")
+
+
+class Chain(Task):
+    """Runs several tasks back to back on local files.
+
+    The steps are read from the nearest `chain.json`, e.g.:
+
+        {"steps": [
+            {"task": "rimtatls"},
+            {"task": "pdal-translate", "config": {"output_ext": ".laz"},
+             "upload": true},
+            {"task": "ape-near-field-prcs"}
+        ]}
+
+    Each step gets the previous step's output. The last step's output is
+    always uploaded, and intermediate outputs only if the step asks for it.
+    """
+
+    DEFAULT_CHAIN_FILE = "chain.json"
+    # Every step keeps its output in the work directory.
+    DISK_FACTOR = 4.0
+    MEMORY_FACTOR = 2.0
+    NAME = "chain"
+
+    def __init__(self, magic_bucket, s3_object):
+        super(Chain, self).__init__(magic_bucket, s3_object)
+        self.chain_file = self.DEFAULT_CHAIN_FILE
+        self.steps = []
+
+    def name(self):
+        return self.NAME
+
+    def prepare(self):
+        found = self.magic_bucket.config_index.nearest(
+            self.bucket_name, self.key, self.chain_file)
+        if found is None:
+            raise MissingChainFile()
+        key, etag = found
+        chain_file = self.path(self.chain_file)
+        if not self.magic_bucket.cache.fetch(self.bucket_name, key,
+                                             chain_file, etag=etag):
+            raise MissingChainFile()
+        with open(chain_file) as f:
+            try:
+                config = json.load(f)
+            except ValueError as e:
+                raise InvalidConfig("Invalid JSON chain: {}".format(e))
+        if not config.get("steps"):
+            raise InvalidConfig("The chain has no steps")
+        for i, step_config in enumerate(config["steps"]):
+            self.steps.append((self.create_step(i, step_config),
+                               step_config))
+
+    def create_step(self, i, step_config):
+        """Creates the task for one step, sharing this task's resources."""
+        name = step_config.get("task")
+        if name not in STEP_TASKS:
+            raise InvalidConfig("Unknown chain step: {}".format(name))
+        step = STEP_TASKS[name](self.magic_bucket, self.s3_object)
+        step.work_directory = self.path("step-{}-{}".format(i, name))
+        os.mkdir(step.work_directory)
+        step.deadline = self.deadline
+        step.subprocess_results = self.subprocess_results
+        step.metrics = self.metrics
+        step.configure(step_config.get("config"))
+        return step
+
+    def fingerprint_inputs(self):
+        return [{"config": step_config, "inputs": step.fingerprint_inputs()}
+                for step, step_config in self.steps]
+
+    def tools(self):
+        tools = set()
+        for step, _ in self.steps:
+            tools.update(step.tools())
+        return sorted(tools)
+
+    def process(self, filename):
+        for i, (step, step_config) in enumerate(self.steps):
+            self.logger.info("Chain step {}: {} on {}".format(
+                i, step.name(), filename))
+            filename = step.process(filename)
+            if step_config.get("upload") and i < len(self.steps) - 1:
+                self.upload(filename)
+        return filename
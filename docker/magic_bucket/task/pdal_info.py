@@ -1,21 +1,94 @@
+import json
+import os
+
+from .. import las
+from pdal_translate import InvalidConfig
 from task import Task
 
 
 class PdalInfo(Task):
-    """Runs `pdal info` on a file."""
+    """Runs `pdal info` on a file.
+
+    By default this is `pdal info --all`, which reads every point. If the
+    nearest `config.json` sets `"mode": "header"`, LAS and LAZ files are
+    instead described from their public header and VLRs alone, read with
+    ranged requests and without downloading the file.
+    """
 
+    DEFAULT_CONFIG_FILE = "config.json"
+    FULL = "full"
+    HEADER = "header"
+    HEADER_EXTENSIONS = [".las", ".laz"]
+    # The input and a small JSON output.
+    DISK_FACTOR = 1.0
+    MEMORY_FACTOR = 2.0
     NAME = "pdal-info"
+    TOOLS = ["pdal"]
+
+    def __init__(self, magic_bucket, s3_object):
+        super(PdalInfo, self).__init__(magic_bucket, s3_object)
+        self.config_file = self.DEFAULT_CONFIG_FILE
+        self.mode = self.FULL
 
     def name(self):
         return self.NAME
 
+    def prepare(self):
+        found = self.magic_bucket.config_index.nearest(
+            self.bucket_name, self.key, self.config_file)
+        if found is None:
+            return
+        key, etag = found
+        config_file = self.path(self.config_file)
+        if not self.magic_bucket.cache.fetch(self.bucket_name, key,
+                                             config_file, etag=etag):
+            return
+        with open(config_file) as f:
+            try:
+                config = json.load(f)
+            except ValueError as e:
+                raise InvalidConfig("Invalid JSON configuration: {}".format(e))
+        self.configure(config)
+
+    def configure(self, config):
+        self.mode = (config or {}).get("mode", self.FULL)
+        if self.mode not in (self.FULL, self.HEADER):
+            raise InvalidConfig("Unknown pdal-info mode: {}".format(self.mode))
+
+    def fingerprint_inputs(self):
+        return {"mode": self.mode}
+
+    def reads_header(self):
+        """Returns true if the output is made from the header alone."""
+        extension = os.path.splitext(self.key)[1].lower()
+        return self.mode == self.HEADER and extension in self.HEADER_EXTENSIONS
+
+    def tools(self):
+        # Headers are read without pdal.
+        if self.reads_header():
+            return []
+        return self.TOOLS
+
+    def process_remote(self):
+        if not self.reads_header():
+            return None
+        basename = os.path.basename(self.key)
+        self.logger.info("Reading the header of {}".format(self.key))
+        metadata = las.read_header(
+            lambda start, length: self.magic_bucket.read_range(
+                self.s3_object, start, length))
+        output = self.path(basename + ".json")
+        with open(output, "w") as f:
+            json.dump({"filename": basename, "header_only": True,
+                       "metadata": metadata}, f, indent=2, sort_keys=True)
+        return output
+
     def process(self, filename):
         args = ["pdal", "info", "--all", filename]
         self.logger.info("Running {}".format(args))
-        stdout = self.subprocess(args)
         output = filename + ".json"
-        with open(output, "w") as f:
-            f.write(stdout)
+        with open(output, "wb") as f:
+            self.subprocess(args, stdout=f)
         return output
 
 if __name__ == "__main__":
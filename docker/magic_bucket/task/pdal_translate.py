@@ -1,6 +1,11 @@
+import glob
+import hashlib
 import json
 import os
+import shutil
+from multiprocessing.pool import ThreadPool
 
+from ..admission import available_cpus
 from ..exceptions import MagicBucketException
 from task import Task
 
@@ -23,69 +28,161 @@ class PdalTranslate(Task):
     DEFAULT_CONFIG_FILE = "config.json"
     DEFAULT_FILTERS_FILE = "filters.json"
     DEFAULT_OUTPUT_DIR = "output"
+    DEFAULT_TILES_DIR = "tiles"
+    # The input, an output of about the same size and, when tiled, the
+    # translated tiles; pdal holds the points in memory.
+    DISK_FACTOR = 3.0
+    MEMORY_FACTOR = 2.0
+    # The uncompressed `.las` tiles, per byte of input.
+    TILE_EXPANSION = {".laz": 5.0}
     NAME = "pdal-translate"
+    TOOLS = ["pdal"]
 
     def __init__(self, magic_bucket, s3_object):
         super(PdalTranslate, self).__init__(magic_bucket, s3_object)
         self.config_file = self.DEFAULT_CONFIG_FILE
         self.filters_file = self.DEFAULT_FILTERS_FILE
         self.output_dir = self.DEFAULT_OUTPUT_DIR
+        self.tiles_dir = self.DEFAULT_TILES_DIR
 
     def name(self):
         return self.NAME
 
+    def disk_factor(self):
+        """Returns the disk factor of a tiled run, since the configuration
+        is not known yet when jobs are admitted.
+        """
+        root, extension = os.path.splitext(self.key.lower())
+        if extension in self.ARCHIVE_EXPANSION:
+            extension = os.path.splitext(root)[1]
+        return self.DISK_FACTOR + self.TILE_EXPANSION.get(extension, 1.0)
+
+    def prepare(self):
+        self.download_config_file()
+
+    def configure(self, config):
+        if config is None:
+            raise MissingConfigFile()
+        with open(self.path(self.config_file), "w") as f:
+            json.dump(config, f)
+
+    def fingerprint_inputs(self):
+        config_file = self.path(self.config_file)
+        if not os.path.isfile(config_file):
+            return None
+        with open(config_file, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
     def process(self, filename):
-        if not os.path.isfile(self.config_file):
-            if not self.download_config_file():
-                raise MissingConfigFile()
-        with open(self.config_file) as f:
+        # A config.json inside a zip archive overwrites the downloaded one.
+        if not os.path.isfile(self.path(self.config_file)):
+            raise MissingConfigFile()
+        with open(self.path(self.config_file)) as f:
             try:
                 config = json.load(f)
             except ValueError as e:
                 raise InvalidConfig("Invalid JSON configuration: {}".format(e))
 
-        filters = config.get("filters")
         output_ext = config.get("output_ext")
-        additional_args = config.get("args")
-
         if output_ext:
             output = os.path.splitext(filename)[0] + output_ext
         else:
             output = filename
-        os.mkdir(self.output_dir)
-        output = os.path.join(self.output_dir, output)
-
-        args = ["pdal", "translate", "-i", filename, "-o", output]
-        if filters:
-            with open(self.filters_file, "w") as f:
-                json.dump(filters, f)
-            args.extend(["--json", self.filters_file])
-        if additional_args:
-            args.extend(additional_args)
-
+        output_dir = self.path(self.output_dir)
+        os.mkdir(output_dir)
+        output = os.path.join(output_dir, os.path.basename(output))
+
+        if config.get("tiles"):
+            return self.translate_tiled(filename, output, config)
+        args = self.translate_args(filename, output, config,
+                                   self.write_filters(config))
         self.logger.info("Running {}".format(args))
         stdout = self.subprocess(args)
         self.logger.info("Complete: {}".format(stdout))
         return output
 
+    def write_filters(self, config):
+        """Writes the configured filters for `pdal translate --json`, and
+        returns the file's path, or None if there are no filters.
+        """
+        filters = config.get("filters")
+        if not filters:
+            return None
+        filters_file = self.path(self.filters_file)
+        with open(filters_file, "w") as f:
+            json.dump(filters, f)
+        return filters_file
+
+    def translate_args(self, source, output, config, filters_file):
+        """Returns the `pdal translate` arguments for a configuration."""
+        additional_args = config.get("args")
+        args = ["pdal", "translate", "-i", source, "-o", output]
+        if filters_file:
+            args.extend(["--json", filters_file])
+        if additional_args:
+            args.extend(additional_args)
+        return args
+
+    def translate_tiled(self, filename, output, config):
+        """Splits the input into tiles, translates them in parallel, and
+        merges the results into `output`.
+
+        `config["tiles"]` holds either a `capacity` (points per tile) or a
+        `length` (tile edge, in the input's units), and optionally the number
+        of `processes`, which defaults to the container's cpus. Filters that
+        look at neighbouring points see each tile on its own.
+        """
+        tiles = config["tiles"]
+        split_args = ["pdal", "split"]
+        if "capacity" in tiles:
+            split_args.extend(["--capacity", str(tiles["capacity"])])
+        elif "length" in tiles:
+            split_args.extend(["--length", str(tiles["length"])])
+        else:
+            raise InvalidConfig("Tiles need a capacity or a length")
+        tiles_dir = self.path(self.tiles_dir)
+        os.mkdir(tiles_dir)
+        extension = os.path.splitext(output)[1]
+        split_args.extend([filename, os.path.join(tiles_dir, "tile.las")])
+        self.logger.info("Running {}".format(split_args))
+        self.subprocess(split_args)
+
+        inputs = sorted(glob.glob(os.path.join(tiles_dir, "tile_*.las")))
+        outputs = [os.path.join(tiles_dir, "out_{}{}".format(i, extension))
+                   for i in range(len(inputs))]
+        processes = tiles.get("processes") or available_cpus()
+        filters_file = self.write_filters(config)
+        self.logger.info("Translating {} tile(s) with {} processes".format(
+            len(inputs), processes))
+        pool = ThreadPool(processes)
+        try:
+            pool.map(lambda pair: self.subprocess(
+                self.translate_args(pair[0], pair[1], config, filters_file)),
+                zip(inputs, outputs))
+        finally:
+            pool.close()
+            pool.join()
+
+        merge_args = ["pdal", "merge"] + outputs + [output]
+        merge_args.extend(config.get("args") or [])
+        self.logger.info("Merging {} tile(s) into {}".format(
+            len(outputs), output))
+        self.subprocess(merge_args)
+        shutil.rmtree(tiles_dir)
+        return output
+
     def download_config_file(self):
-        """Downloads a configuration file from the object's directory."""
-        return (self._download_sidecar_config_file() or
-                self._download_directory_config_file())
-
-    def _download_sidecar_config_file(self):
-        key = self.key + ".json"
-        return self.magic_bucket.download_file(self.bucket_name, key,
-                                               self.config_file)
-
-    def _download_directory_config_file(self):
-        assert self.key.startswith("{}/".format(self.name()))
-        dirname = os.path.dirname(self.key)
-        while dirname:
-            key = os.path.join(dirname, self.config_file)
-            if self.magic_bucket.download_file(self.bucket_name, key,
-                                               self.config_file):
-                return True
-            else:
-                dirname = os.path.dirname(dirname)
-        return False
+        """Downloads the nearest configuration file for the object.
+
+        That is a sidecar `<key>.json`, or the closest `config.json` in the
+        object's directory or its parents.
+        """
+        found = self.magic_bucket.config_index.nearest(
+            self.bucket_name, self.key, self.config_file)
+        if found is None:
+            return False
+        key, etag = found
+        self.logger.info("Using configuration s3://{}/{}".format(
+            self.bucket_name, key))
+        return self.magic_bucket.cache.fetch(
+            self.bucket_name, key, self.path(self.config_file), etag=etag)
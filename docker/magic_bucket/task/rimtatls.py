@@ -7,6 +7,7 @@ class Rimtatls(Task):
     """Riegl's rimtatls correction executable."""
 
     NAME = "rimtatls"
+    TOOLS = ["rimtatls"]
 
     def name(self):
         return self.NAME
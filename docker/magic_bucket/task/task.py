@@ -1,9 +1,19 @@
+import distutils.spawn
+import hashlib
+import json
 import logging
 import os
 import shutil
-import subprocess
+import tempfile
+import time
 
+from ..archive import (extract_member, extract_zip, gunzip_stream,
+                       member_path, zip_members)
 from ..exceptions import MagicBucketException
+from ..metrics import JobMetrics
+from ..runner import run
+# Re-exported: SubprocessError used to be defined here.
+from ..runner import SubprocessError, SubprocessTimeout
 
 
 class MissingS3File(MagicBucketException):
@@ -15,64 +25,388 @@ class MissingS3File(MagicBucketException):
                                             s3_object.key))
 
 
-class SubprocessError(MagicBucketException):
-    """Some subprocess exited improperly."""
-
-    def __init__(self, called_process_error):
-        super(SubprocessError, self).__init__(
-            "Subprocess error: {} with output {}".format(
-                called_process_error, called_process_error.output))
-        self.output = called_process_error.output
-        self.returncode = called_process_error.returncode
-
-
 class Task(object):
     """A generic magic bucket task."""
 
-    DEFAULT_WORK_DIRECTORY = "work"
+    FINGERPRINT_METADATA = "magic-bucket-fingerprint"
+    # Archive members that are inputs; the others, e.g. configurations,
+    # projections and readmes, are extras that every input gets.
+    INPUT_EXTENSIONS = [".bpf", ".e57", ".las", ".laz", ".ply", ".rxp"]
+    MANIFEST_SUFFIX = ".manifest.json"
+    TOOLS = []
+    DEFAULT_WORK_ROOT = None
+    DEFAULT_TIMEOUT = None
     DEFAULT_S3_OUTPUT_DIRECTORY = "output"
+    # Estimated ratio of uncompressed to compressed size, by extension.
+    ARCHIVE_EXPANSION = {".gz": 3.0, ".zip": 3.0}
+    # Disk and memory used per byte of (uncompressed) input, by default for
+    # the input and an output of the same size.
+    DISK_FACTOR = 2.0
+    MEMORY_FACTOR = 0.0
 
     def __init__(self, magic_bucket, s3_object):
         self.magic_bucket = magic_bucket
         self.s3_object = s3_object
         self.bucket_name = s3_object.bucket_name
         self.key = s3_object.key
-        self.work_directory = self.DEFAULT_WORK_DIRECTORY
+        self.work_root = self.DEFAULT_WORK_ROOT
+        self.work_directory = None
         self.s3_output_directory = self.DEFAULT_S3_OUTPUT_DIRECTORY
         self.logger = logging.getLogger("magic-bucket")
+        self.cache_hit = False
+        self.timeout = self.DEFAULT_TIMEOUT
+        self.deadline = None
+        self.subprocess_results = []
+        self.current_fingerprint = None
+        self.input_filename = None
+        self.output_filename = None
+        self.output = None
+        self.archive = None
+        self.members = []
+        self.extras = []
+        self.parent = None
+        self.member = None
+        self.metrics = JobMetrics(self.name(), self.key)
 
     def run(self):
-        """Runs this task."""
-        self.logger.info("Creating {}".format(self.work_directory))
-        os.mkdir(self.work_directory)
-        os.chdir(self.work_directory)
+        """Runs this task, returning the uploaded s3 object.
+
+        Each run gets its own temporary work directory, so several tasks can
+        run side by side in the same process. If `timeout` is set, all of the
+        task's subprocesses together get that many seconds of wall-clock
+        time. If the output for this exact input, configuration and tool
+        version has already been uploaded, the task is skipped, `cache_hit`
+        is set, and the existing output is returned.
+
+        `run` is `fetch`, `execute` and `finish` in a row; the worker calls
+        them separately, to overlap the transfers of one task with the
+        processing of another. A zip archive with several inputs is split
+        into one task per input; `run` returns a list of their outputs.
+        """
+        try:
+            if self.fetch():
+                children = self.split()
+                if children:
+                    self.output = [child.run_member() for child in children]
+                else:
+                    self.execute()
+                    self.finish()
+        finally:
+            self.cleanup()
+        return self.output
+
+    def run_member(self):
+        """Runs a task made by `split`, returning the uploaded s3 object.
+
+        The input is already downloaded by the parent, so there is nothing
+        to fetch.
+        """
         try:
-            filename = self.download_and_extract()
-            output = self.process(filename)
-            s3_object = self.upload(output)
+            self.execute()
+            self.finish()
         finally:
-            os.chdir("..")
+            self.cleanup()
+        return self.output
+
+    def fetch(self):
+        """Creates the work directory and downloads the input.
+
+        Returns false if the task is already done, because its output is up
+        to date.
+        """
+        self.start()
+        if self.is_current():
+            return False
+        start = time.time()
+        self.output_filename = self.process_remote()
+        if self.output_filename is not None:
+            self.metrics.record("process", time.time() - start)
+        if self.output_filename is None:
+            self.input_filename = self.download_and_extract()
+            if self.input_filename is not None:
+                self.input_filename = self.prepare_input(self.input_filename)
+        return True
+
+    def split(self):
+        """Returns one task per input in a multi-input zip archive.
+
+        The tasks extract and process their member when they are executed,
+        in a work directory inside this one, so this task must only be
+        cleaned up after all of them are. Returns an empty list if this task
+        has a single input.
+        """
+        children = []
+        for member in self.members:
+            child = self.__class__(self.magic_bucket, self.s3_object)
+            child.parent = self
+            child.member = member
+            child.work_root = self.work_directory
+            child.timeout = self.timeout
+            child.metrics.member = member
+            children.append(child)
+        return children
+
+    def execute(self):
+        """Processes the downloaded input.
+
+        Tasks for a member of an archive extract the member first.
+        """
+        if self.member is not None and self.input_filename is None:
+            self.start()
+            for name in self.parent.extras:
+                _link(self.parent.path(name), self.path(name))
+            if self.is_current():
+                return
+            self.logger.info("Extracting {} from {}".format(
+                self.member, self.key))
+            with self.metrics.phase("extract") as phase:
+                self.input_filename = extract_member(
+                    self.parent.archive, self.member, self.work_directory)
+                phase["bytes"] = _size(self.input_filename)
+            self.input_filename = self.prepare_input(self.input_filename)
+        if self.output_filename is None:
+            with self.metrics.phase("process") as phase:
+                phase["bytes"] = _size(self.input_filename)
+                self.output_filename = self.process(self.input_filename)
+
+    def finish(self):
+        """Uploads the output, unless it was already up to date."""
+        if self.cache_hit:
+            return
+        with self.metrics.phase("upload") as phase:
+            phase["bytes"] = _size(self.output_filename)
+            self.output = self.upload(self.output_filename,
+                                      self.current_fingerprint)
+
+    def start(self):
+        """Creates the work directory, starts the clock, and prepares."""
+        self.work_directory = tempfile.mkdtemp(
+            prefix="{}-".format(self.name()), dir=self.work_root)
+        self.logger.info("Created {}".format(self.work_directory))
+        if self.timeout is not None:
+            self.deadline = time.time() + self.timeout
+        self.prepare()
+
+    def is_current(self):
+        """Returns true, and sets `output`, if the output is up to date."""
+        self.current_fingerprint = self.fingerprint()
+        s3_object = self.current_output(self.current_fingerprint)
+        if s3_object is None:
+            return False
+        self.logger.info("{} is up to date, skipping".format(s3_object.key))
+        self.cache_hit = True
+        self.output = s3_object
+        return True
+
+    def footprint(self, size):
+        """Estimates the disk and memory, in bytes, needed to run this task
+        on an input object of `size` bytes.
+
+        Zip archives are kept while their contents are processed.
+        """
+        extension = os.path.splitext(self.key)[1].lower()
+        uncompressed = size * self.ARCHIVE_EXPANSION.get(extension, 1.0)
+        disk = uncompressed * self.disk_factor()
+        if extension == ".zip":
+            disk += size
+        return int(disk), int(uncompressed * self.MEMORY_FACTOR)
+
+    def disk_factor(self):
+        """Returns the disk used per byte of (uncompressed) input."""
+        return self.DISK_FACTOR
+
+    def metrics_record(self):
+        """Returns this task's metrics, including its subprocesses."""
+        self.metrics.subprocesses = [result.as_dict()
+                                     for result in self.subprocess_results]
+        return self.metrics.as_dict()
+
+    def description(self):
+        """Returns the key, and the archive member if there is one."""
+        if self.member is None:
+            return self.key
+        return "{}:{}".format(self.key, self.member)
+
+    def cleanup(self):
+        """Removes the work directory."""
+        if self.work_directory is not None:
             self.logger.info("Removing {}".format(self.work_directory))
             shutil.rmtree(self.work_directory)
-        return s3_object
+            self.work_directory = None
+
+    def path(self, filename):
+        """Returns the path to `filename` inside this task's work directory."""
+        if self.work_directory is None:
+            return filename
+        return os.path.join(self.work_directory, filename)
+
+    def fetch_reference(self, key, filename):
+        """Places a reference s3 object from this task's bucket in the work
+        directory, through the local artifact cache.
+
+        Returns true if the object exists, false otherwise.
+        """
+        return self.magic_bucket.cache.fetch(self.bucket_name, key,
+                                             self.path(filename))
 
     def download_and_extract(self):
-        """Downloads and extracts the specified file."""
+        """Downloads and extracts the specified file.
+
+        Gzipped files are decompressed while they are downloaded. Zip files
+        with a single input are extracted in full; for zip files with
+        several inputs, only the other members (e.g. a `config.json`) are
+        extracted, and the inputs are left in the archive for `split`.
+        Returns the input filename, or None if the archive was split.
+        """
         basename = os.path.basename(self.key)
-        self.logger.info("Downloading {} to {}".format(
-            self.s3_object.key, basename))
-        if not self.magic_bucket.download_object(self.s3_object, basename):
-            raise MissingS3File(self.s3_object)
         root, extension = os.path.splitext(basename)
-        if extension == ".zip":
-            self.logger.info("Unzipping {}".format(basename))
-            self.subprocess(["unzip", "-o", basename])
-            basename = root
-        elif extension == ".gz":
-            self.logger.info("Gunzipping {}".format(basename))
-            self.subprocess(["gunzip", "-f", basename])
-            basename = root
-        return basename
+        if extension == ".gz":
+            filename = self.path(root)
+            self.logger.info("Downloading and gunzipping {} to {}".format(
+                self.s3_object.key, filename))
+            # Decompression happens while downloading, so it is all one phase.
+            with self.metrics.phase("download") as phase:
+                stream = self.magic_bucket.open_object(self.s3_object)
+                if stream is None:
+                    raise MissingS3File(self.s3_object)
+                try:
+                    phase["bytes"] = gunzip_stream(stream, filename)
+                finally:
+                    stream.close()
+        elif extension == ".zip":
+            archive = self.path(basename)
+            self.logger.info("Downloading {} to {}".format(
+                self.s3_object.key, archive))
+            with self.metrics.phase("download") as phase:
+                if not self.magic_bucket.download_object(self.s3_object,
+                                                         archive):
+                    raise MissingS3File(self.s3_object)
+                phase["bytes"] = _size(archive)
+            members = zip_members(archive)
+            inputs = [member for member in members
+                      if os.path.splitext(member)[1].lower() in
+                      self.INPUT_EXTENSIONS]
+            if len(inputs) > 1:
+                self.logger.info("{} holds {} inputs".format(
+                    self.key, len(inputs)))
+                self.archive = archive
+                self.members = inputs
+                self.extras = [os.path.basename(extract_member(
+                    archive, member, self.work_directory))
+                    for member in members if member not in inputs]
+                return None
+            self.logger.info("Unzipping {}".format(archive))
+            if inputs:
+                filename = member_path(self.work_directory, inputs[0])
+            else:
+                filename = self.path(root)
+            with self.metrics.phase("extract") as phase:
+                extract_zip(archive, self.work_directory)
+                phase["bytes"] = _size(filename)
+            os.remove(archive)
+        else:
+            filename = self.path(basename)
+            self.logger.info("Downloading {} to {}".format(
+                self.s3_object.key, filename))
+            with self.metrics.phase("download") as phase:
+                if not self.magic_bucket.download_object(self.s3_object,
+                                                         filename):
+                    raise MissingS3File(self.s3_object)
+                phase["bytes"] = _size(filename)
+        return filename
+
+    def prepare(self):
+        """Fetches whatever this task needs, besides its input, to run.
+
+        Called in the work directory before the input is downloaded, so the
+        results can be part of the fingerprint.
+        """
+        pass
+
+    def prepare_input(self, filename):
+        """Readies a downloaded or extracted input for `process`, outside
+        the process phase. Returns the filename to process.
+        """
+        return filename
+
+    def configure(self, config):
+        """Applies an inline configuration, e.g. from a chain, instead of the
+        one `prepare` would fetch.
+        """
+        pass
+
+    def fingerprint_inputs(self):
+        """Returns JSON-serializable data, besides the input object and the
+        tool versions, that changes this task's output.
+        """
+        return None
+
+    def tools(self):
+        """Returns the executables whose version changes this task's output.
+        """
+        return self.TOOLS
+
+    def fingerprint(self):
+        """Returns a digest of everything that determines this task's output.
+        """
+        etag = self.magic_bucket.object_etag(self.bucket_name, self.key)
+        if etag is None:
+            raise MissingS3File(self.s3_object)
+        data = {
+            "etag": etag,
+            "task": self.name(),
+            "inputs": self.fingerprint_inputs(),
+            "member": self.member,
+            "tools": dict((tool, tool_version(tool)) for tool in self.tools()),
+        }
+        return hashlib.sha256(json.dumps(data, sort_keys=True)).hexdigest()
+
+    def current_output(self, fingerprint):
+        """Returns the uploaded output, if it was made with `fingerprint`.
+
+        Returns None if the task has to run.
+        """
+        manifest = self.magic_bucket.get_json(self.bucket_name,
+                                              self.manifest_key())
+        if manifest is None or manifest.get("fingerprint") != fingerprint:
+            return None
+        s3_object = self.magic_bucket.s3_object(self.bucket_name,
+                                                manifest["output"])
+        metadata = self.magic_bucket.object_metadata(s3_object)
+        if (metadata is None or
+                metadata.get(self.FINGERPRINT_METADATA) != fingerprint):
+            return None
+        return s3_object
+
+    def manifest_key(self):
+        """Returns the key of the manifest recording this task's output."""
+        name = os.path.basename(self.key)
+        if self.member is not None:
+            name += "." + os.path.basename(self.member)
+        return self.output_key(name + self.MANIFEST_SUFFIX)
+
+    def output_key(self, filename):
+        """Returns the key that an output file is uploaded to.
+
+        The file will be named just the basename of the filename, to support
+        output files in the subdirectories. The outputs of an archive member
+        keep the member's directory inside the archive, so that members with
+        the same name do not overwrite each other.
+        """
+        directory = os.path.join(os.path.dirname(self.key),
+                                 self.s3_output_directory)
+        if self.member is not None:
+            directory = os.path.join(directory,
+                                     _member_directory(self.member))
+        return os.path.join(directory, os.path.basename(filename))
+
+    def process_remote(self):
+        """Produces the output without downloading the input, if possible.
+
+        Returns the output filename, or None if the input has to be
+        downloaded and passed to `process`.
+        """
+        return None
 
     def process(self, filename):
         raise NotImplementedError
@@ -80,24 +414,83 @@ class Task(object):
     def name(self):
         raise NotImplementedError
 
-    def upload(self, filename):
+    def upload(self, filename, fingerprint=None):
         """Uploads the filename back to the s3 bucket.
 
-        The file will be named just the basename of the filename, to support
-        output files in the subdirectories.
+        If a fingerprint is given, it is stored in the output's metadata and
+        in a manifest next to it.
         """
-        key = os.path.join(os.path.dirname(self.key),
-                           self.s3_output_directory,
-                           os.path.basename(filename))
+        key = self.output_key(filename)
         self.logger.info("Uploading {} to {}".format(filename, key))
-        return self.magic_bucket.upload_file(filename, self.bucket_name, key)
+        metadata = {}
+        if fingerprint is not None:
+            metadata[self.FINGERPRINT_METADATA] = fingerprint
+        s3_object = self.magic_bucket.upload_file(
+            filename, self.bucket_name, key, metadata=metadata)
+        if fingerprint is not None:
+            self.magic_bucket.put_json(
+                self.bucket_name, self.manifest_key(),
+                {"fingerprint": fingerprint, "input": self.key,
+                 "output": key})
+        return s3_object
+
+    def subprocess(self, args, stdout=None):
+        """Runs a subprocess in this task's work directory.
+
+        If `stdout` is a file object, the subprocess's standard output is
+        streamed into it. Returns the tail of the subprocess's output (only
+        of standard error, when `stdout` is given).
+        """
+        timeout = None
+        if self.deadline is not None:
+            timeout = self.deadline - time.time()
+        result = run(args, cwd=self.work_directory, stdout=stdout,
+                     timeout=timeout)
+        self.logger.info("Ran {}".format(result))
+        self.subprocess_results.append(result)
+        return result.output
 
-    def subprocess(self, args):
-        """Runs a subprocess."""
-        try:
-            return subprocess.check_output(args, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise SubprocessError(e)
+
+def _size(filename):
+    """Returns the size of a file, or None if there is no such file."""
+    if filename is None or not os.path.isfile(filename):
+        return None
+    return os.path.getsize(filename)
+
+
+def _member_directory(member):
+    """Returns the directory of an archive member, without any absolute or
+    parent parts, so it can only name a place inside the output directory.
+    """
+    parts = member.replace("\\", "/").split("/")[:-1]
+    return "/".join(part for part in parts if part not in ("", ".", ".."))
+
+
+def _link(source, destination):
+    """Hard-links a file, or copies it across filesystems."""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+_tool_versions = {}
+
+
+def tool_version(executable):
+    """Returns a string that changes whenever `executable` is replaced."""
+    if executable not in _tool_versions:
+        path = distutils.spawn.find_executable(executable)
+        if path is None:
+            version = None
+        else:
+            stat = os.stat(os.path.realpath(path))
+            version = "{}:{}:{}".format(path, stat.st_size,
+                                        int(stat.st_mtime))
+        _tool_versions[executable] = version
+    return _tool_versions[executable]
 
 
 if __name__ == "__main__":
@@ -114,6 +507,9 @@ if __name__ == "__main__":
 
     class LaszipTask(Task):
 
+        def name(self):
+            return "laszip"
+
         def process(self, filename):
             output = os.path.splitext(filename)[0] + ".laz"
             self.subprocess(["pdal", "translate", filename, output])
@@ -0,0 +1,178 @@
+"""Tunable, measured s3 transfers."""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from boto3.s3.transfer import TransferConfig
+
+from exceptions import MagicBucketException
+
+MB = 1024 * 1024
+
+
+class TransferIntegrityError(MagicBucketException):
+    """A transferred file does not match its s3 object."""
+
+
+class TransferSettings(object):
+    """Part size, concurrency and memory budget for multipart transfers.
+
+    Downloads use parallel ranged GETs and uploads parallel multipart PUTs
+    of `part_size` bytes each. Concurrency is capped so that the parts in
+    flight fit into `memory_budget` bytes.
+
+    With a `spool` directory, transfers of at least `resume_threshold` bytes
+    are checkpointed there and resumed by the next attempt (see
+    `resumable`).
+    """
+
+    DEFAULT_PART_SIZE = 64 * MB
+    DEFAULT_CONCURRENCY = 10
+    DEFAULT_MEMORY_BUDGET = 1024 * MB
+    DEFAULT_RESUME_THRESHOLD = 1024 * MB
+    IO_CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, part_size=None, concurrency=None, memory_budget=None,
+                 verify_checksums=False, spool=None, resume_threshold=None):
+        self.part_size = part_size or self.DEFAULT_PART_SIZE
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self.memory_budget = memory_budget or self.DEFAULT_MEMORY_BUDGET
+        self.verify_checksums = verify_checksums
+        self.spool = spool
+        self.resume_threshold = (resume_threshold or
+                                 self.DEFAULT_RESUME_THRESHOLD)
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        """Reads settings from `MAGIC_BUCKET_TRANSFER_*` variables, and the
+        spool from `MAGIC_BUCKET_SPOOL`.
+
+        Sizes are in megabytes.
+        """
+        def megabytes(name):
+            value = environ.get(name)
+            return int(float(value) * MB) if value else None
+        concurrency = environ.get("MAGIC_BUCKET_TRANSFER_CONCURRENCY")
+        return cls(
+            part_size=megabytes("MAGIC_BUCKET_TRANSFER_PART_SIZE"),
+            concurrency=int(concurrency) if concurrency else None,
+            memory_budget=megabytes("MAGIC_BUCKET_TRANSFER_MEMORY"),
+            verify_checksums=environ.get(
+                "MAGIC_BUCKET_TRANSFER_VERIFY_CHECKSUMS", "") == "1",
+            spool=environ.get("MAGIC_BUCKET_SPOOL") or None,
+            resume_threshold=megabytes(
+                "MAGIC_BUCKET_TRANSFER_RESUME_THRESHOLD"))
+
+    def effective_concurrency(self):
+        """Returns the concurrency, limited by the memory budget."""
+        return max(1, min(self.concurrency,
+                          self.memory_budget // self.part_size))
+
+    def resumes(self, size):
+        """Returns true if a transfer of `size` bytes is checkpointed."""
+        return self.spool is not None and size >= self.resume_threshold
+
+    def transfer_config(self):
+        """Returns the boto3 transfer configuration for these settings."""
+        concurrency = self.effective_concurrency()
+        io_budget = self.memory_budget - concurrency * self.part_size
+        return TransferConfig(
+            multipart_threshold=self.part_size,
+            multipart_chunksize=self.part_size,
+            max_concurrency=concurrency,
+            max_io_queue=max(100, io_budget // self.IO_CHUNK_SIZE),
+            io_chunksize=self.IO_CHUNK_SIZE)
+
+    def __str__(self):
+        return "part size {} MB, concurrency {}, memory budget {} MB".format(
+            self.part_size // MB, self.effective_concurrency(),
+            self.memory_budget // MB)
+
+
+class TransferProgress(object):
+    """Counts bytes transferred, for use as a boto3 transfer callback."""
+
+    def __init__(self, description):
+        self.description = description
+        self.bytes = 0
+        self.start = time.time()
+        self.end = None
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self.lock:
+            self.bytes += bytes_amount
+
+    def finish(self):
+        """Stops the clock and logs the transfer rate."""
+        self.end = time.time()
+        logging.getLogger("magic-bucket").info(
+            "{}: {} bytes in {:.1f} s ({:.1f} MB/s)".format(
+                self.description, self.bytes, self.seconds(),
+                self.bytes_per_second() / MB))
+
+    def seconds(self):
+        return (self.end or time.time()) - self.start
+
+    def bytes_per_second(self):
+        seconds = self.seconds()
+        return self.bytes / seconds if seconds > 0 else 0.0
+
+
+def verify(filename, s3_object, settings):
+    """Checks that a local file matches its s3 object.
+
+    Always compares sizes. If the settings ask for it, also compares the md5
+    digest against the object's ETag, for ETags that are single or
+    multipart md5 digests made with our part size.
+    """
+    size = os.path.getsize(filename)
+    if size != s3_object.content_length:
+        raise TransferIntegrityError(
+            "{} has {} bytes, but s3://{}/{} has {}".format(
+                filename, size, s3_object.bucket_name, s3_object.key,
+                s3_object.content_length))
+    if not settings.verify_checksums:
+        return
+    etag = s3_object.e_tag.strip('"')
+    if "-" in etag:
+        parts = int(etag.split("-")[1])
+        if parts != -(-size // settings.part_size):
+            return
+        digest = "{}-{}".format(_multipart_md5(filename, settings.part_size),
+                                parts)
+    else:
+        digest = _md5(filename)
+    if digest != etag:
+        raise TransferIntegrityError(
+            "{} has checksum {}, but s3://{}/{} has ETag {}".format(
+                filename, digest, s3_object.bucket_name, s3_object.key, etag))
+
+
+def _md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(MB), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _multipart_md5(filename, part_size):
+    digests = []
+    with open(filename, "rb") as f:
+        while True:
+            part = hashlib.md5()
+            remaining = part_size
+            while remaining > 0:
+                chunk = f.read(min(MB, remaining))
+                if not chunk:
+                    break
+                part.update(chunk)
+                remaining -= len(chunk)
+            if remaining == part_size:
+                break
+            digests.append(part.digest())
+    return hashlib.md5(b"".join(digests)).hexdigest()
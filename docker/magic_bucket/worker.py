@@ -0,0 +1,416 @@
+"""Runs magic bucket tasks in a download / process / upload pipeline."""
+
+import json
+import logging
+import os
+import posixpath
+import tempfile
+import threading
+import time
+from Queue import Queue
+
+from admission import Admission, available_memory, free_disk
+from exceptions import MagicBucketException
+from metrics import MetricsSummary
+from task import create_task, UnknownTask
+
+GB = 1024.0 * 1024 * 1024
+
+
+class Job(object):
+    """One sqs message, and the task that handles it.
+
+    The jobs for the members of a split archive share one message, through
+    their `group`.
+    """
+
+    def __init__(self, message, task=None, group=None):
+        self.message = message
+        self.s3_object = task.s3_object if task else None
+        self.task = task
+        self.group = group
+        self.received = time.time()
+        self.event_time = None
+        self.queued = None
+        self.disk = 0
+        self.memory = 0
+        self.reserved = False
+
+    def description(self):
+        if self.task is not None:
+            return self.task.description()
+        if self.s3_object is not None:
+            return self.s3_object.key
+        return "message {}".format(self.message.message_id)
+
+    def slack_group(self):
+        """Returns the directory whose slack notifications are digested
+        together with this job's.
+        """
+        if self.s3_object is None:
+            return None
+        return posixpath.dirname(self.s3_object.key)
+
+
+class JobGroup(object):
+    """Counts down the member jobs of a split archive."""
+
+    def __init__(self, job, count):
+        self.job = job
+        self.count = count
+        self.handled = True
+        self.lock = threading.Lock()
+
+    def done(self, handled):
+        """Marks one member as done. Returns true for the last one."""
+        with self.lock:
+            self.count -= 1
+            self.handled = self.handled and handled
+            return self.count == 0
+
+
+class Stage(object):
+    """A pool of threads that run one step of every job.
+
+    Jobs come in through `inbox`. The step returns the jobs that move on to
+    `outbox`, a bounded queue, so a fast stage waits for a slow one instead
+    of piling up work (and disk space) ahead of it.
+    """
+
+    def __init__(self, name, step, concurrency, inbox, outbox=None):
+        self.name = name
+        self.step = step
+        self.concurrency = concurrency
+        self.inbox = inbox
+        self.outbox = outbox
+        self.lock = threading.Lock()
+        self.busy = 0.0
+        self.jobs = 0
+        self.threads = []
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._run,
+                                      name="{}-{}".format(self.name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Waits for the jobs in the inbox, then stops the threads."""
+        for _ in self.threads:
+            self.inbox.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def utilization(self, seconds):
+        """Returns the fraction of `seconds` that the threads were busy."""
+        if seconds <= 0:
+            return 0.0
+        return self.busy / (seconds * self.concurrency)
+
+    def _run(self):
+        while True:
+            job = self.inbox.get()
+            if job is None:
+                return
+            start = time.time()
+            jobs = self.step(job)
+            with self.lock:
+                self.busy += time.time() - start
+                self.jobs += 1
+            if self.outbox is not None:
+                for next_job in jobs:
+                    self.outbox.put(next_job)
+
+
+class Worker(object):
+    """Drains the sqs queue through a three-stage pipeline.
+
+    While one job is being processed, the next ones are downloaded and the
+    previous ones are uploaded. Each stage has its own number of threads;
+    tasks spend most of their time waiting on s3 or on external tools, so
+    threads are enough to keep them busy.
+    """
+
+    DEFAULT_CONCURRENCY = 1
+    DEFAULT_DOWNLOAD_CONCURRENCY = 1
+    DEFAULT_UPLOAD_CONCURRENCY = 1
+    # Fractions of the free disk and available memory that jobs may use.
+    DISK_HEADROOM = 0.9
+    MEMORY_HEADROOM = 0.8
+    DEFAULT_DEFER_SECONDS = 900
+    # Messages are dropped after this many receives, so an input that
+    # crashes the worker does not crash every new container too.
+    DEFAULT_MAX_RECEIVES = 10
+
+    def __init__(self, magic_bucket, slack, concurrency=None, work_root=None,
+                 task_timeout=None, download_concurrency=None,
+                 upload_concurrency=None, metrics_sink=None,
+                 disk_budget=None, memory_budget=None, defer_seconds=None,
+                 max_receives=None):
+        self.magic_bucket = magic_bucket
+        self.slack = slack
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self.download_concurrency = (download_concurrency or
+                                     self.DEFAULT_DOWNLOAD_CONCURRENCY)
+        self.upload_concurrency = (upload_concurrency or
+                                   self.DEFAULT_UPLOAD_CONCURRENCY)
+        self.work_root = work_root
+        self.task_timeout = task_timeout
+        self.metrics_sink = metrics_sink
+        self.summary = MetricsSummary()
+        self.disk_budget = disk_budget
+        self.memory_budget = memory_budget
+        self.defer_seconds = defer_seconds or self.DEFAULT_DEFER_SECONDS
+        self.max_receives = max_receives or self.DEFAULT_MAX_RECEIVES
+        self.admission = None
+        self.logger = logging.getLogger("magic-bucket")
+        self.error = None
+
+    def run(self):
+        """Runs tasks until the sqs queue is empty, or idle (see
+        `MagicBucket.consume_messages`).
+
+        Jobs are admitted to the pipeline within a disk and memory budget,
+        smallest first (see `Admission`); jobs that could never fit are
+        returned to the queue for `defer_seconds`, e.g. for a worker with
+        more room.
+
+        Re-raises the first unhandled exception from any of the stages,
+        after the jobs that are already running have finished. Messages are
+        only deleted once their task has been handled; messages left over
+        after an unhandled exception are returned to the queue.
+
+        Returns the utilization of each stage.
+        """
+        self.admission = Admission(*self.budget())
+        self.logger.info(
+            "Admitting jobs within {:.1f} GB of disk and {:.1f} GB of "
+            "memory".format(self.admission.disk_budget / GB,
+                            self.admission.memory_budget / GB))
+        to_download = self.admission
+        to_process = Queue(maxsize=self.concurrency)
+        to_upload = Queue(maxsize=self.upload_concurrency)
+        stages = [
+            Stage("download", self._step(self.download),
+                  self.download_concurrency, to_download, to_process),
+            Stage("process", self._step(self.process), self.concurrency,
+                  to_process, to_upload),
+            Stage("upload", self._step(self.upload),
+                  self.upload_concurrency, to_upload),
+        ]
+        for stage in stages:
+            stage.start()
+        start = time.time()
+        try:
+            for message in self.magic_bucket.consume_messages():
+                if self.error is not None:
+                    self.magic_bucket.release_message(message)
+                    break
+                for job in self._step(self.admit)(Job(message)):
+                    to_download.put(job)
+        finally:
+            for stage in stages:
+                stage.stop()
+            self.magic_bucket.stop_consuming()
+            seconds = time.time() - start
+            self.logger.info("Stopping after {:.0f} s: {}".format(
+                seconds, "error" if self.error is not None
+                else self.magic_bucket.exit_cause or "interrupted"))
+            utilization = dict((stage.name, stage.utilization(seconds))
+                               for stage in stages)
+            for stage in stages:
+                self.logger.info(
+                    "Stage {}: {} job(s), {} thread(s), {:.0%} busy".format(
+                        stage.name, stage.jobs, stage.concurrency,
+                        utilization[stage.name]))
+            self.logger.info("Artifact cache: {}".format(
+                self.magic_bucket.cache.stats()))
+            summary = self.summary.as_dict()
+            self.logger.info("Metrics: {}".format(json.dumps(summary)))
+            if self.metrics_sink is not None:
+                self.metrics_sink.emit({"summary": summary})
+        if self.error is not None:
+            raise self.error
+        return utilization
+
+    def budget(self):
+        """Returns the disk and memory, in bytes, that jobs may use.
+
+        Unless they are set, the budgets are a share of the free disk in the
+        work root, less the room the artifact cache may still grow into
+        there, and of the available memory.
+        """
+        disk_budget = self.disk_budget
+        if disk_budget is None:
+            work_root = self.work_root or tempfile.gettempdir()
+            disk_budget = free_disk(work_root) * self.DISK_HEADROOM
+            cache = self.magic_bucket.cache
+            if (os.path.isdir(cache.directory) and
+                    os.stat(cache.directory).st_dev ==
+                    os.stat(work_root).st_dev):
+                disk_budget -= max(0, cache.max_bytes - cache.size)
+        memory_budget = self.memory_budget
+        if memory_budget is None:
+            memory_budget = available_memory() * self.MEMORY_HEADROOM
+        return int(max(0, disk_budget)), int(memory_budget)
+
+    def admit(self, job):
+        """Creates the job's task and estimates its footprint from the size
+        of its s3 object.
+
+        Defers the job if it would not fit in the budget on its own. Gives
+        up on a job whose message has been received `max_receives` times,
+        deferrals included, and deletes the message.
+        """
+        job.s3_object = self.magic_bucket.s3_object_for_message(job.message)
+        receive_count = self.magic_bucket.receive_count(job.message)
+        if receive_count > self.max_receives:
+            self.slack.fail(
+                "Giving up on `{}` after {} attempts".format(
+                    job.s3_object.key, receive_count - 1),
+                group=job.slack_group())
+            self.done(job)
+            return []
+        try:
+            job.task = create_task(self.magic_bucket, job.s3_object)
+        except UnknownTask as e:
+            self.slack.fail("Unknown task: *{}*".format(e.task_name),
+                            group=job.slack_group())
+            self.done(job)
+            return []
+        if self.work_root is not None:
+            job.task.work_root = self.work_root
+        if self.task_timeout is not None:
+            job.task.timeout = self.task_timeout
+        size = self.magic_bucket.object_size(job.s3_object) or 0
+        job.disk, job.memory = job.task.footprint(size)
+        if self.admission.fits_budget(job):
+            return [job]
+        self.slack.info(
+            "Deferring *{}* on `{}` for {} s: it needs about {:.1f} GB of "
+            "disk and {:.1f} GB of memory, more than this worker has".format(
+                job.task.name(), job.s3_object.key, self.defer_seconds,
+                job.disk / GB, job.memory / GB), group=job.slack_group())
+        self.magic_bucket.release_message(job.message, self.defer_seconds)
+        return []
+
+    def download(self, job):
+        """Fetches the job's input.
+
+        A zip archive with several inputs turns into one job per input.
+        """
+        job.event_time = self.magic_bucket.message_event_time(job.message)
+        if job.event_time is not None:
+            job.task.metrics.record("queue_wait",
+                                    max(0.0, job.received - job.event_time))
+        self.slack.info(
+            "Running *{}* on `{}`".format(job.task.name(), job.s3_object.key),
+            group=job.slack_group())
+        if not job.task.fetch():
+            self.succeed(job)
+            return []
+        children = job.task.split()
+        if not children:
+            return [job]
+        group = JobGroup(job, len(children))
+        jobs = [Job(job.message, child, group) for child in children]
+        for child_job in jobs:
+            child_job.received = job.received
+            child_job.event_time = job.event_time
+        return jobs
+
+    def process(self, job):
+        job.task.execute()
+        return [job]
+
+    def upload(self, job):
+        job.task.finish()
+        self.succeed(job)
+        return []
+
+    def succeed(self, job):
+        if job.task.cache_hit:
+            message = "Skipped *{}* on `{}`, s3://{}/{} is up to date"
+            job.task.metrics.extra["status"] = "skipped"
+        else:
+            message = "Completed *{}* on `{}`, uploaded to s3://{}/{}"
+            job.task.metrics.extra["status"] = "succeeded"
+        self.slack.success(message.format(
+            job.task.name(), job.description(), job.task.output.bucket_name,
+            job.task.output.key), group=job.slack_group())
+        self.done(job)
+
+    def done(self, job):
+        """Cleans up after a handled job and deletes its message."""
+        self._end(job, True)
+
+    def abandon(self, job):
+        """Cleans up after a job and returns its message to the queue."""
+        self._end(job, False)
+
+    def _end(self, job, handled):
+        if job.task is not None:
+            job.task.cleanup()
+            if not handled:
+                job.task.metrics.extra["status"] = "abandoned"
+            job.task.metrics.extra["latency"] = time.time() - job.received
+            # Comparable with the jobs the lambda runs inline.
+            job.task.metrics.extra["path"] = "queue"
+            if job.event_time is not None:
+                job.task.metrics.extra["event_latency"] = (
+                    time.time() - job.event_time)
+            self.emit_metrics(job.task)
+        if job.group is not None:
+            if not job.group.done(handled):
+                return
+            parent = job.group.job.task
+            parent.cleanup()
+            parent.metrics.extra["members"] = len(parent.members)
+            self.emit_metrics(parent)
+            handled = job.group.handled
+            self.admission.release(job.group.job)
+        else:
+            self.admission.release(job)
+        if handled:
+            self.magic_bucket.finish_message(job.message)
+        else:
+            self.magic_bucket.release_message(job.message)
+
+    def emit_metrics(self, task):
+        """Adds a task's metrics to the summary and sends them to the sink."""
+        record = task.metrics_record()
+        self.summary.add(record)
+        if self.metrics_sink is not None:
+            try:
+                self.metrics_sink.emit(record)
+            except Exception:
+                self.logger.exception("Could not emit metrics")
+
+    def _step(self, function):
+        """Wraps a stage function with the pipeline's error handling."""
+        def step(job):
+            if self.error is not None:
+                self.abandon(job)
+                return []
+            try:
+                return function(job)
+            except MagicBucketException as e:
+                if job.task is not None:
+                    job.task.metrics.extra["status"] = "failed"
+                self.slack.fail("Error while running *{}* on *{}*: {}".format(
+                    job.task.name() if job.task else "?", job.description(),
+                    e), group=job.slack_group())
+                self.done(job)
+            except Exception as e:
+                self.logger.exception(
+                    "Unhandled exception on {}".format(job.description()))
+                self.abandon(job)
+                if self.error is None:
+                    self.error = e
+                    # Stops waiting for messages, which may take a while on
+                    # an idle queue.
+                    self.magic_bucket.request_stop("error")
+            return []
+        return step
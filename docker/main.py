@@ -4,40 +4,107 @@
 
 import logging
 import os
+import signal
 
-from magic_bucket import (MagicBucket, create_task, UnknownTask, Slack,
-                          MagicBucketException)
+from magic_bucket import MagicBucket, Slack, TransferSettings, Worker
+from magic_bucket.metrics import create_sink
 
 
 def main():
-    """Handle each s3 object, as retrieved from the SQS queue."""
-    logging.basicConfig()
+    """Handle each s3 object, as retrieved from the SQS queue.
+
+    `MAGIC_BUCKET_CONCURRENCY` sets how many objects are processed at once,
+    while `MAGIC_BUCKET_DOWNLOAD_CONCURRENCY` and
+    `MAGIC_BUCKET_UPLOAD_CONCURRENCY` set how many are downloaded and
+    uploaded alongside them. `MAGIC_BUCKET_WORK_ROOT` sets where their work
+    directories are created, and `MAGIC_BUCKET_TASK_TIMEOUT` limits the
+    seconds each task's external tools may run.
+
+    s3 transfers are tuned with the `MAGIC_BUCKET_TRANSFER_*` variables.
+    Reference files are cached in `MAGIC_BUCKET_CACHE_DIRECTORY`, up to
+    `MAGIC_BUCKET_CACHE_SIZE` megabytes.
+
+    By default the container exits once the queue is empty. With
+    `MAGIC_BUCKET_IDLE_TIMEOUT`, it keeps polling the queue until it has been
+    idle for that many seconds. SIGTERM stops it after the running tasks.
+
+    Jobs are admitted within `MAGIC_BUCKET_DISK_BUDGET` and
+    `MAGIC_BUCKET_MEMORY_BUDGET` megabytes, by default most of the free disk
+    and memory. Jobs too large for the budget are returned to the queue for
+    `MAGIC_BUCKET_DEFER_SECONDS`. Messages received more than
+    `MAGIC_BUCKET_MAX_RECEIVES` times (default 10) are reported as failed and
+    deleted.
+
+    `MAGIC_BUCKET_METRICS` sends per-job timing records to `stdout`,
+    `file:<path>` or `udp:<host>:<port>` (StatsD).
+    """
+    logging.basicConfig(
+        format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
     logger = logging.getLogger("magic-bucket")
     logger.setLevel(logging.INFO)
-    magic_bucket = MagicBucket(os.environ["AWS_REGION"],
-                               os.environ["SQS_QUEUE_URL"])
-    slack = Slack(os.environ["SLACK_TOKEN"])
+    worker = create_worker(os.environ)
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: worker.magic_bucket.request_stop("signal"))
     try:
-        for s3_object in magic_bucket.s3_objects():
-            try:
-                task = create_task(magic_bucket, s3_object)
-            except UnknownTask as e:
-                slack.fail("Unknown task: *{}*".format(e.task_name))
-                continue
-            slack.info(
-                "Running *{}* on `{}`".format(task.name(), s3_object.key))
-            try:
-                output = task.run()
-            except MagicBucketException as e:
-                slack.fail("Error while running *{}* on *{}*: {}".format(
-                    task.name(), s3_object.key, e))
-            else:
-                slack.success("Completed *{}* on `{}`, uploaded to s3://{}/{}"
-                              .format(task.name(), s3_object.key,
-                                      output.bucket_name, output.key))
+        worker.run()
     except Exception as e:
-        slack.fail("Unhandled exception, aborting: {}".format(e))
+        worker.slack.fail("Unhandled exception, aborting: {}".format(e))
         raise e
+    finally:
+        worker.slack.close()
+
+
+def create_worker(environ, s3=None, sqs_queue=None, slack_client=None,
+                  metrics_sink=None):
+    """Creates a worker configured by `environ`.
+
+    The s3 and sqs resources, the slack client and the metrics sink can be
+    passed in, e.g. stand-ins for benchmarks; by default they are made from
+    the environment.
+    """
+    magic_bucket = MagicBucket(
+        environ["AWS_REGION"], environ["SQS_QUEUE_URL"],
+        transfer_settings=TransferSettings.from_environ(environ),
+        s3_endpoint_url=environ.get("S3_ENDPOINT_URL"),
+        cache_directory=environ.get("MAGIC_BUCKET_CACHE_DIRECTORY"),
+        cache_max_bytes=int(environ.get("MAGIC_BUCKET_CACHE_SIZE", 0)) *
+        1024 * 1024,
+        idle_timeout=_float(environ.get("MAGIC_BUCKET_IDLE_TIMEOUT")),
+        s3=s3, sqs_queue=sqs_queue)
+    slack = Slack(environ["SLACK_TOKEN"], client=slack_client)
+    if metrics_sink is None:
+        metrics_sink = create_sink(environ.get("MAGIC_BUCKET_METRICS"))
+    return Worker(magic_bucket, slack,
+                  concurrency=_int(environ.get("MAGIC_BUCKET_CONCURRENCY")),
+                  work_root=environ.get("MAGIC_BUCKET_WORK_ROOT"),
+                  task_timeout=_float(environ.get(
+                      "MAGIC_BUCKET_TASK_TIMEOUT")),
+                  download_concurrency=_int(environ.get(
+                      "MAGIC_BUCKET_DOWNLOAD_CONCURRENCY")),
+                  upload_concurrency=_int(environ.get(
+                      "MAGIC_BUCKET_UPLOAD_CONCURRENCY")),
+                  metrics_sink=metrics_sink,
+                  disk_budget=_megabytes(environ.get(
+                      "MAGIC_BUCKET_DISK_BUDGET")),
+                  memory_budget=_megabytes(environ.get(
+                      "MAGIC_BUCKET_MEMORY_BUDGET")),
+                  defer_seconds=_int(environ.get(
+                      "MAGIC_BUCKET_DEFER_SECONDS")),
+                  max_receives=_int(environ.get(
+                      "MAGIC_BUCKET_MAX_RECEIVES")))
+
+
+def _float(value):
+    return float(value) if value else None
+
+
+def _int(value):
+    return int(value) if value else None
+
+
+def _megabytes(value):
+    return int(value) * 1024 * 1024 if value else None
 
 
 if __name__ == "__main__":
@@ -1,21 +1,72 @@
+import json
+import os
+
 from fabric.api import task, local
 
 LOCAL_DOCKER_TAG = "gadomski/magic-bucket"
 REGISTRY_DOCKER_TAG = "605350515131.dkr.ecr.us-east-1.amazonaws.com/magic-bucket:latest"
 LAMBDA_ZIP = "build/lambda.zip"
 LAMBDA_ZIP_URL = "fileb://{}".format(LAMBDA_ZIP)
+TASK_REGISTRY = "docker/magic_bucket/tasks.json"
+TASK_DEFINITION = "task-definition.json"
 
 
 @task
 def update_lambda():
-    local("mkdir -p build")
-    local("zip -j {} lambda.py".format(LAMBDA_ZIP))
+    """Ships the lambda with the magic_bucket package, to run small jobs
+    inline, and its dependencies.
+    """
+    local("rm -rf build/lambda {}".format(LAMBDA_ZIP))
+    local("mkdir -p build/lambda")
+    local("pip install --target build/lambda slackclient")
+    local("cp lambda.py {} build/lambda".format(TASK_REGISTRY))
+    local("cp -r docker/magic_bucket build/lambda")
+    local("find build/lambda -name '*.pyc' -delete")
+    local("cd build/lambda && zip -r {} .".format(os.path.abspath(LAMBDA_ZIP)))
     local("aws lambda update-function-code --function-name magic-bucket --zip-file {}".format(LAMBDA_ZIP_URL))
 
 
 @task
-def register_task_definition():
-    local("aws ecs register-task-definition --cli-input-json file://task-definition.json")
+def register_task_definitions():
+    """Registers one task definition per pool in the task registry."""
+    local("mkdir -p build")
+    for name, pool in load_task_registry()["pools"].items():
+        filename = "build/task-definition-{}.json".format(name)
+        with open(filename, "w") as f:
+            json.dump(task_definition(name, pool), f, indent=4)
+        local("aws ecs register-task-definition --cli-input-json file://{}".format(filename))
+
+
+@task
+def create_queues():
+    """Creates the sqs queue of every pool in the task registry."""
+    for name in load_task_registry()["pools"]:
+        local("aws sqs create-queue --queue-name {}".format(name))
+
+
+def load_task_registry():
+    with open(TASK_REGISTRY) as f:
+        return json.load(f)
+
+
+def task_definition(name, pool):
+    """Returns `task-definition.json`, sized and pointed at a pool's queue."""
+    with open(TASK_DEFINITION) as f:
+        definition = json.load(f)
+    definition["family"] = name
+    container = definition["containerDefinitions"][0]
+    container["cpu"] = pool["cpu"]
+    container["memory"] = pool["memory"]
+    environment = dict((variable["name"], variable["value"])
+                       for variable in container["environment"])
+    environment["SQS_QUEUE_URL"] = pool["queue"]
+    environment["MAGIC_BUCKET_CONCURRENCY"] = str(pool["concurrency"])
+    if "download_concurrency" in pool:
+        environment["MAGIC_BUCKET_DOWNLOAD_CONCURRENCY"] = str(
+            pool["download_concurrency"])
+    container["environment"] = [{"name": key, "value": value}
+                                for key, value in sorted(environment.items())]
+    return definition
 
 
 @task
@@ -2,63 +2,533 @@
 
 This script takes one or more s3 record events and fans them out to:
 
-    - An SQS message containing information about the source and target files.
-    - An ECS task that will fetch the SQS message and process the files.
+    - SQS messages containing information about the source and target files,
+      sent in batches. Duplicate and superseded records for the same key are
+      coalesced, and records for an object version that was queued recently
+      are dropped.
+    - As many ECS tasks as are needed to work through the queue, up to a
+      maximum number of containers.
+
+Each record is routed by its top-level prefix, the task name, to the queue
+and ECS task definition of the task's pool in the task registry,
+`tasks.json`, so short tasks are never stuck behind long ones.
+
+Small objects, up to a task's `inline_max_size` megabytes in the registry,
+are run right here instead, when the `magic_bucket` package is bundled with
+this script, skipping the queue and the container start, if their task can
+make its output without downloading the input or running any tools (e.g.
+`pdal-info` in header mode). Their outcome is posted to slack like the
+worker's. Jobs that fail inline are queued as usual.
 """
 
+import collections
 import json
 import logging
 import os
+import posixpath
+import sqlite3
+import time
 import boto3
 
+try:
+    from magic_bucket import MagicBucket, Slack, create_task, UnknownTask
+    from magic_bucket.metrics import create_sink, event_time
+except ImportError:
+    # Not bundled (see `fab update_lambda`), so every job is queued.
+    MagicBucket = None
+
 KEY_EXTENSION_BLACKLIST = [".json", ".md"]
 OUTPUT_DIRNAME = "output"
+SQS_BATCH_SIZE = 10
+ECS_RUN_TASK_MAX_COUNT = 10
 
 sqs = boto3.client("sqs")
 ecs = boto3.client("ecs")
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-SQS_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/605350515131/magic-bucket"
-ECS_TASK = "magic-bucket"
+TASK_REGISTRY = os.environ.get("TASK_REGISTRY")
+MESSAGES_PER_CONTAINER = int(os.environ.get("MESSAGES_PER_CONTAINER", 20))
+MAX_CONTAINERS = int(os.environ.get("MAX_CONTAINERS", 10))
+IDEMPOTENCY_TABLE = os.environ.get("IDEMPOTENCY_TABLE")
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 3600))
+# Caps every task's `inline_max_size`, in megabytes; 0 runs nothing inline.
+INLINE_MAX_SIZE = os.environ.get("INLINE_MAX_SIZE")
+INLINE_WORK_ROOT = "/tmp"
+INLINE_CACHE_SIZE = int(os.environ.get("INLINE_CACHE_SIZE", 100))
+# Seconds of the lambda's time left for queueing the rest of the event.
+INLINE_TIME_RESERVE = 30
+SLACK_TOKEN = os.environ.get("SLACK_TOKEN")
+SLACK_CLOSE_TIMEOUT = 10
+MB = 1024 * 1024
 
 
-def main(event, _):
+def main(event, context):
     """Entrypoint."""
-    message_sent = False
-    for record in event["Records"]:
-        key = record["s3"]["object"]["key"]
-        if os.path.basename(os.path.dirname(key)) == OUTPUT_DIRNAME:
-            logger.info(
-                "Key parent directory is {}, not sending sqs message".format(
-                    OUTPUT_DIRNAME))
-            continue
-        _, extension = os.path.splitext(key)
-        if extension in KEY_EXTENSION_BLACKLIST:
-            logger.info(
-                "Key extension {} is blacklisted, not sending sqs message".format(extension))
-            continue
-        if send_sqs_message(record):
-            message_sent = True
-    if message_sent:
-        run_ecs_task()
+    records = [record for record in event["Records"] if should_send(record)]
+    records = coalesce(records)
+    slack = create_slack()
+    try:
+        queue_records(records, context, slack)
+    finally:
+        if slack is not None:
+            slack.close(SLACK_CLOSE_TIMEOUT)
     return True
 
 
-def send_sqs_message(record):
-    """Sends an SQS message containing the record information."""
-    message_body = json.dumps(record)
-    logger.info("Sending SQS message to {}: {}".format(
-        SQS_QUEUE_URL, message_body))
-    response = sqs.send_message(
-        QueueUrl=SQS_QUEUE_URL, MessageBody=message_body)
-    logger.info("SQS message sent OK: {}".format(response))
+def queue_records(records, context=None, slack=None):
+    """Runs the records inline, or sends them to their pool's queue and
+    starts tasks to work through it.
+    """
+    for pool_name, pool_records in route(records, registry).items():
+        pool = registry["pools"][pool_name]
+        # Records are claimed pool by pool, right before they are run or
+        # sent. If anything fails, the claims of the records that were
+        # neither are released, so the retried event is let through the
+        # idempotency store.
+        unsent = claim(pool_records, idempotency_store)
+        try:
+            for record in list(unsent):
+                if run_inline(record, registry, context, slack):
+                    unsent.remove(record)
+            if not unsent:
+                continue
+            sent = send_sqs_messages(unsent, queue_url=pool["queue"])
+        except Exception:
+            unclaim(unsent, idempotency_store)
+            raise
+        scale_ecs_tasks(
+            queue_url=pool["queue"], task_definition=pool_name,
+            messages_per_container=pool.get("messages_per_container",
+                                            MESSAGES_PER_CONTAINER),
+            max_containers=pool.get("max_containers", MAX_CONTAINERS),
+            minimum_depth=sent)
+
+
+def should_send(record):
+    """Returns true if the record should be sent to the SQS queue."""
+    key = record["s3"]["object"]["key"]
+    if os.path.basename(os.path.dirname(key)) == OUTPUT_DIRNAME:
+        logger.info(
+            "Key parent directory is {}, not sending sqs message".format(
+                OUTPUT_DIRNAME))
+        return False
+    _, extension = os.path.splitext(key)
+    if extension in KEY_EXTENSION_BLACKLIST:
+        logger.info(
+            "Key extension {} is blacklisted, not sending sqs message".format(extension))
+        return False
     return True
 
 
-def run_ecs_task():
-    """Runs the hardcoded ECS task."""
-    logger.info("Running ECS task: {}".format(ECS_TASK))
-    response = ecs.run_task(taskDefinition=ECS_TASK, count=1)
-    logger.info("ECS task run OK: {}".format(response))
+def load_registry(filename=None):
+    """Loads the task registry.
+
+    Reads `filename`, `TASK_REGISTRY`, or `tasks.json` next to this script
+    (where `fab update_lambda` puts it), falling back to the worker's copy
+    in a checkout.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    filenames = [filename or TASK_REGISTRY,
+                 os.path.join(directory, "tasks.json"),
+                 os.path.join(directory, "docker", "magic_bucket",
+                              "tasks.json")]
+    for filename in filenames:
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                return json.load(f)
+    raise IOError("Could not find the task registry, tasks.json")
+
+
+def route(records, registry):
+    """Groups records by the pool of their task, in the order the pools
+    first appear.
+
+    Records for unknown tasks go to the default pool, whose workers report
+    them.
+    """
+    pools = collections.OrderedDict()
+    for record in records:
+        task_name = record["s3"]["object"]["key"].split("/", 1)[0]
+        task = registry["tasks"].get(task_name, {})
+        pool_name = task.get("pool", registry["default_pool"])
+        pools.setdefault(pool_name, []).append(record)
+    return pools
+
+
+def inline_max_size(record, registry):
+    """Returns the largest object, in bytes, that a record's task may run
+    inline, or None if it may not.
+    """
+    if MagicBucket is None:
+        return None
+    task_name = record["s3"]["object"]["key"].split("/", 1)[0]
+    limit = registry["tasks"].get(task_name, {}).get("inline_max_size")
+    if limit is None:
+        return None
+    if INLINE_MAX_SIZE is not None:
+        limit = min(limit, float(INLINE_MAX_SIZE))
+    return int(limit * MB) if limit > 0 else None
+
+
+def run_inline(record, registry, context=None, slack=None):
+    """Runs a small job's task in this lambda, with the same `Task`
+    interface as the worker, in a work directory in `/tmp`.
+
+    Only tasks that make their output in `process_remote`, without the
+    input or any tools, are run. Returns true if the job is done, false if
+    it has to be queued: it is too large, there is too little time left, its
+    task needs the input, or it failed. Jobs that are run record their
+    metrics, with their latency since the s3 event, to `metrics_sink`, and
+    post their success to `slack`; failures are reported by the worker that
+    runs them again.
+    """
+    limit = inline_max_size(record, registry)
+    size = record["s3"]["object"].get("size")
+    if limit is None or size is None or size > limit:
+        return False
+    timeout = None
+    if context is not None:
+        timeout = (context.get_remaining_time_in_millis() / 1000.0 -
+                   INLINE_TIME_RESERVE)
+        if timeout < INLINE_TIME_RESERVE:
+            return False
+    bucket_name, key, _ = object_version(record)
+    magic_bucket = get_inline_magic_bucket()
+    try:
+        task = create_task(magic_bucket,
+                           magic_bucket.s3_object(bucket_name, key))
+    except UnknownTask:
+        return False
+    task.work_root = INLINE_WORK_ROOT
+    task.timeout = timeout
+    try:
+        done = run_remote(task)
+    except Exception:
+        logger.exception("Could not run {} on s3://{}/{} inline, "
+                         "queueing it".format(task.name(), bucket_name, key))
+        task.metrics.extra["status"] = "failed"
+        done = False
+    else:
+        if not done:
+            logger.info("{} needs s3://{}/{} downloaded, queueing it".format(
+                task.name(), bucket_name, key))
+            return False
+        logger.info("Ran {} on s3://{}/{} inline".format(
+            task.name(), bucket_name, key))
+        if task.cache_hit:
+            message = "Skipped *{}* on `{}`, s3://{}/{} is up to date"
+            task.metrics.extra["status"] = "skipped"
+        else:
+            message = "Completed *{}* on `{}`, uploaded to s3://{}/{}"
+            task.metrics.extra["status"] = "succeeded"
+        if slack is not None:
+            slack.success(message.format(
+                task.name(), task.description(), task.output.bucket_name,
+                task.output.key), group=posixpath.dirname(key))
+    finally:
+        task.cleanup()
+    task.metrics.extra["path"] = "inline"
+    if "eventTime" in record:
+        task.metrics.extra["event_latency"] = (
+            time.time() - event_time(record["eventTime"]))
+    if metrics_sink is not None:
+        metrics_sink.emit(task.metrics_record())
+    return done
+
+
+def run_remote(task):
+    """Runs a task like the worker's `fetch` and `finish`, but without
+    downloading the input.
+
+    Returns false, before anything is uploaded, if the task needs its input.
+    """
+    task.start()
+    if task.is_current():
+        return True
+    start = time.time()
+    task.output_filename = task.process_remote()
+    if task.output_filename is None:
+        return False
+    task.metrics.record("process", time.time() - start)
+    task.finish()
     return True
+
+
+def get_inline_magic_bucket():
+    """Returns the magic bucket for inline jobs, made on first use and kept
+    for the lambda container's lifetime, along with its artifact cache.
+    """
+    global inline_magic_bucket
+    if inline_magic_bucket is None:
+        pool = registry["pools"][registry["default_pool"]]
+        inline_magic_bucket = MagicBucket(
+            os.environ.get("AWS_REGION", "us-east-1"), pool["queue"],
+            cache_directory=os.path.join(INLINE_WORK_ROOT,
+                                         "magic-bucket-cache"),
+            cache_max_bytes=INLINE_CACHE_SIZE * MB)
+    return inline_magic_bucket
+
+
+def create_slack():
+    """Returns a slack notifier for inline jobs, or None if none can run.
+
+    It posts from a thread of its own, so it is made for each event and
+    closed before the lambda returns.
+    """
+    if MagicBucket is None or not SLACK_TOKEN:
+        return None
+    return Slack(SLACK_TOKEN)
+
+
+def coalesce(records):
+    """Returns one record per bucket and key, the one with the latest
+    sequencer, in the order the keys first appear.
+    """
+    latest = {}
+    order = []
+    for record in records:
+        s3 = record["s3"]
+        name = (s3["bucket"]["name"], s3["object"]["key"])
+        if name not in latest:
+            order.append(name)
+        elif sequencer(record) < sequencer(latest[name]):
+            continue
+        latest[name] = record
+    if len(order) < len(records):
+        logger.info("Coalesced {} record(s) into {}".format(
+            len(records), len(order)))
+    return [latest[name] for name in order]
+
+
+def sequencer(record):
+    """Returns a record's sequencer as a number, for comparisons.
+
+    Sequencers are hexadecimal strings that only compare when they are
+    padded to the same length; parsing them does just that.
+    """
+    value = record["s3"]["object"].get("sequencer")
+    return int(value, 16) if value else -1
+
+
+def object_version(record):
+    """Returns the bucket, key and ETag of a record's object."""
+    s3 = record["s3"]
+    return (s3["bucket"]["name"], s3["object"]["key"],
+            s3["object"].get("eTag"))
+
+
+def claim(records, store):
+    """Returns the records whose object version has not been queued yet,
+    claiming them in the idempotency store.
+
+    Records without an ETag are always returned. If the store fails, the
+    claims made so far are released.
+    """
+    if store is None:
+        return list(records)
+    claimed = []
+    try:
+        for record in records:
+            bucket, key, etag = object_version(record)
+            if etag is None or store.claim(bucket, key, etag):
+                claimed.append(record)
+            else:
+                logger.info(
+                    "s3://{}/{} ({}) was already queued, skipping".format(
+                        bucket, key, etag))
+    except Exception:
+        unclaim(claimed, store)
+        raise
+    return claimed
+
+
+def unclaim(records, store):
+    """Releases the records' claims in the idempotency store."""
+    if store is None:
+        return
+    for record in records:
+        bucket, key, etag = object_version(record)
+        if etag is not None:
+            store.release(bucket, key, etag)
+
+
+class DynamoDbStore(object):
+    """An idempotency store in a DynamoDB table, keyed by `id`.
+
+    Claims expire after `ttl` seconds, so the same object can be queued
+    again on purpose, e.g. after its configuration changed. Enable the
+    table's time to live on `expires` to clean up old claims.
+    """
+
+    def __init__(self, table, ttl=IDEMPOTENCY_TTL, client=None):
+        self.table = table
+        self.ttl = ttl
+        self.client = client or boto3.client("dynamodb")
+
+    def claim(self, bucket, key, etag):
+        """Returns true if the object version was not claimed yet."""
+        now = int(time.time())
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={"id": {"S": _version_id(bucket, key, etag)},
+                      "expires": {"N": str(now + self.ttl)}},
+                ConditionExpression="attribute_not_exists(id) OR "
+                "expires < :now",
+                ExpressionAttributeValues={":now": {"N": str(now)}})
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release(self, bucket, key, etag):
+        """Forgets a claim."""
+        self.client.delete_item(
+            TableName=self.table,
+            Key={"id": {"S": _version_id(bucket, key, etag)}})
+
+
+class SqliteStore(object):
+    """An idempotency store in a SQLite file, e.g. for tests and benchmarks.
+    """
+
+    def __init__(self, filename, ttl=IDEMPOTENCY_TTL):
+        self.ttl = ttl
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS claims "
+            "(id TEXT PRIMARY KEY, expires INTEGER)")
+
+    def claim(self, bucket, key, etag):
+        """Returns true if the object version was not claimed yet."""
+        now = int(time.time())
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR REPLACE INTO claims (id, expires) "
+                "SELECT ?, ? WHERE NOT EXISTS "
+                "(SELECT 1 FROM claims WHERE id = ? AND expires >= ?)",
+                (_version_id(bucket, key, etag), now + self.ttl,
+                 _version_id(bucket, key, etag), now))
+            return cursor.rowcount == 1
+
+    def release(self, bucket, key, etag):
+        """Forgets a claim."""
+        with self.connection:
+            self.connection.execute("DELETE FROM claims WHERE id = ?",
+                                    (_version_id(bucket, key, etag),))
+
+
+def create_idempotency_store():
+    """Returns the store named by the environment, if any.
+
+    `IDEMPOTENCY_TABLE` is a DynamoDB table, or a SQLite file if it starts
+    with `sqlite:`.
+    """
+    if not IDEMPOTENCY_TABLE:
+        return None
+    if IDEMPOTENCY_TABLE.startswith("sqlite:"):
+        return SqliteStore(IDEMPOTENCY_TABLE[len("sqlite:"):])
+    return DynamoDbStore(IDEMPOTENCY_TABLE)
+
+
+def _version_id(bucket, key, etag):
+    return "{}/{}@{}".format(bucket, key, etag.strip('"'))
+
+
+idempotency_store = create_idempotency_store()
+registry = load_registry()
+inline_magic_bucket = None
+metrics_sink = (create_sink(os.environ.get("MAGIC_BUCKET_METRICS", "stdout"))
+                if MagicBucket is not None else None)
+
+
+def send_sqs_messages(records, queue_url, sqs_client=None):
+    """Sends SQS messages containing the record information, in batches.
+
+    Returns the number of messages sent.
+    """
+    sqs_client = sqs_client or sqs
+    sent = 0
+    for i in range(0, len(records), SQS_BATCH_SIZE):
+        batch = records[i:i + SQS_BATCH_SIZE]
+        entries = [{"Id": str(j), "MessageBody": json.dumps(record)}
+                   for j, record in enumerate(batch)]
+        logger.info("Sending {} SQS message(s) to {}".format(
+            len(entries), queue_url))
+        response = sqs_client.send_message_batch(
+            QueueUrl=queue_url, Entries=entries)
+        failed = response.get("Failed", [])
+        if failed:
+            # Partial failures are not retried by SQS, and the records are
+            # lost if we don't raise, so let the lambda retry the event.
+            raise RuntimeError("Could not send SQS messages: {}".format(
+                failed))
+        sent += len(entries)
+    logger.info("SQS messages sent OK: {}".format(sent))
+    return sent
+
+
+def scale_ecs_tasks(queue_url, task_definition, sqs_client=None,
+                    ecs_client=None,
+                    messages_per_container=MESSAGES_PER_CONTAINER,
+                    max_containers=MAX_CONTAINERS, minimum_depth=0):
+    """Starts enough ECS tasks to work through the SQS queue's backlog.
+
+    The queue's attributes are approximate and lag behind messages that were
+    just sent, so `minimum_depth` can be used as a floor for the depth.
+    Returns the number of tasks started.
+    """
+    sqs_client = sqs_client or sqs
+    ecs_client = ecs_client or ecs
+    depth = max(queue_depth(sqs_client, queue_url), minimum_depth)
+    running = running_task_count(ecs_client, task_definition)
+    count = tasks_to_start(depth, running, messages_per_container,
+                           max_containers)
+    logger.info("Queue depth {}, {} task(s) running, starting {}".format(
+        depth, running, count))
+    started = 0
+    while started < count:
+        batch = min(count - started, ECS_RUN_TASK_MAX_COUNT)
+        response = ecs_client.run_task(taskDefinition=task_definition,
+                                       count=batch)
+        for failure in response.get("failures", []):
+            logger.warning("ECS task failed to start: {}".format(failure))
+        started += len(response.get("tasks", []))
+        if not response.get("tasks"):
+            break
+    logger.info("ECS task run OK: {} started".format(started))
+    return started
+
+
+def tasks_to_start(depth, running, messages_per_container, max_containers):
+    """Returns how many tasks to start for a queue with `depth` messages.
+
+    At least one task is always running when there is work to do.
+    """
+    if depth <= 0:
+        return 0
+    wanted = -(-depth // messages_per_container)
+    wanted = min(max(wanted, 1), max_containers)
+    return max(wanted - running, 0)
+
+
+def queue_depth(sqs_client, queue_url):
+    """Returns the approximate number of messages waiting or in flight."""
+    response = sqs_client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=["ApproximateNumberOfMessages",
+                        "ApproximateNumberOfMessagesNotVisible"])
+    attributes = response["Attributes"]
+    return (int(attributes["ApproximateNumberOfMessages"]) +
+            int(attributes["ApproximateNumberOfMessagesNotVisible"]))
+
+
+def running_task_count(ecs_client, task_definition):
+    """Returns the number of tasks in the family that are, or will be, running.
+    """
+    count = 0
+    paginator = ecs_client.get_paginator("list_tasks")
+    for page in paginator.paginate(family=task_definition,
+                                   desiredStatus="RUNNING"):
+        count += len(page["taskArns"])
+    return count
@@ -0,0 +1,2 @@
+# slack_test.py posts to a real slack channel; run it by hand.
+collect_ignore = ["slack_test.py"]
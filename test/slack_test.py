@@ -6,3 +6,6 @@ slack = Slack(os.environ["SLACK_TOKEN"])
 print slack.info("Information message")
 print slack.success("Success message")
 print slack.fail("Failure message")
+for i in range(3):
+    slack.success("Digested message {}".format(i), group="slack-test")
+slack.close()
@@ -0,0 +1,182 @@
+"""Tests for admitting jobs within a disk and memory budget."""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "docker"))
+
+from magic_bucket.admission import Admission, available_cpus
+
+
+class Job(object):
+
+    def __init__(self, disk, memory=0):
+        self.disk = disk
+        self.memory = memory
+        self.queued = None
+        self.reserved = False
+
+
+def in_thread(function, *args):
+    """Calls `function` in a thread, returning the thread and a list that
+    will hold the result.
+    """
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function(*args)))
+    thread.daemon = True
+    thread.start()
+    return thread, result
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.admission = Admission(100, 100)
+
+    def test_smallest_first(self):
+        large, small = Job(50), Job(10)
+        self.admission.put(large)
+        self.admission.put(small)
+        self.assertIs(self.admission.get(), small)
+        self.assertIs(self.admission.get(), large)
+        self.assertEqual(self.admission.disk_used, 60)
+
+    def test_waits_for_budget(self):
+        first, second = Job(60), Job(60)
+        self.admission.put(first)
+        self.admission.put(second)
+        self.assertIs(self.admission.get(), first)
+        thread, result = in_thread(self.admission.get)
+        thread.join(0.1)
+        self.assertEqual(result, [])
+        self.admission.release(first)
+        thread.join(5)
+        self.assertEqual(result, [second])
+        self.assertEqual(self.admission.disk_used, 60)
+
+    def test_memory_budget(self):
+        first, second = Job(1, memory=70), Job(1, memory=70)
+        self.admission.put(first)
+        self.admission.put(second)
+        self.assertIs(self.admission.get(), first)
+        thread, result = in_thread(self.admission.get)
+        thread.join(0.1)
+        self.assertEqual(result, [])
+        self.admission.release(first)
+        thread.join(5)
+        self.assertEqual(result, [second])
+
+    def test_overdue_job_goes_next(self):
+        running, large, small = Job(60), Job(80), Job(10)
+        self.admission.put(running)
+        self.assertIs(self.admission.get(), running)
+        self.admission.put(large)
+        self.admission.put(small)
+        large.queued = time.time() - Admission.DEFAULT_MAX_WAIT
+        thread, result = in_thread(self.admission.get)
+        thread.join(0.1)
+        self.assertEqual(result, [])
+        self.admission.release(running)
+        thread.join(5)
+        self.assertEqual(result, [large])
+        self.assertIs(self.admission.get(), small)
+
+    def test_small_jobs_pass_large_ones_before_max_wait(self):
+        running, large, small = Job(60), Job(80), Job(10)
+        self.admission.put(running)
+        self.admission.get()
+        self.admission.put(large)
+        self.admission.put(small)
+        self.assertIs(self.admission.get(), small)
+
+    def test_release_is_idempotent(self):
+        job = Job(40)
+        self.admission.put(job)
+        self.admission.get()
+        self.admission.release(job)
+        self.admission.release(job)
+        self.assertEqual(self.admission.disk_used, 0)
+        self.admission.release(Job(10))
+        self.assertEqual(self.admission.disk_used, 0)
+
+    def test_stop_after_pending_jobs(self):
+        job = Job(10)
+        self.admission.put(job)
+        self.admission.put(None)
+        self.assertIs(self.admission.get(), job)
+        self.assertIsNone(self.admission.get())
+
+    def test_one_stop_per_reader(self):
+        readers = [in_thread(self.admission.get) for _ in range(2)]
+        self.admission.put(None)
+        self.admission.put(None)
+        for thread, result in readers:
+            thread.join(5)
+            self.assertEqual(result, [None])
+
+    def test_put_waits_at_capacity(self):
+        admission = Admission(100, 100, capacity=1)
+        first, second = Job(10), Job(10)
+        admission.put(first)
+        thread, _ = in_thread(admission.put, second)
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertIs(admission.get(), first)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIs(admission.get(), second)
+
+    def test_fits_budget(self):
+        self.assertTrue(self.admission.fits_budget(Job(100, memory=100)))
+        self.assertFalse(self.admission.fits_budget(Job(101)))
+        self.assertFalse(self.admission.fits_budget(Job(1, memory=101)))
+
+
+class AvailableCpusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cgroup = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cgroup)
+
+    def write(self, name, content):
+        path = os.path.join(self.cgroup, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_cgroup_v2_quota(self):
+        self.write("cpu.max", "150000 100000\n")
+        self.assertEqual(available_cpus(self.cgroup), 2)
+        self.write("cpu.max", "20000 100000\n")
+        self.assertEqual(available_cpus(self.cgroup), 1)
+
+    def test_cgroup_v1_quota(self):
+        self.write("cpu/cpu.cfs_quota_us", "300000\n")
+        self.write("cpu/cpu.cfs_period_us", "100000\n")
+        self.assertEqual(available_cpus(self.cgroup), 3)
+
+    def test_no_quota(self):
+        self.assertEqual(available_cpus(self.cgroup),
+                         multiprocessing.cpu_count())
+        self.write("cpu.max", "max 100000\n")
+        self.assertEqual(available_cpus(self.cgroup),
+                         multiprocessing.cpu_count())
+        os.remove(os.path.join(self.cgroup, "cpu.max"))
+        self.write("cpu/cpu.cfs_quota_us", "-1\n")
+        self.write("cpu/cpu.cfs_period_us", "100000\n")
+        self.assertEqual(available_cpus(self.cgroup),
+                         multiprocessing.cpu_count())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+"""Tests for the streaming extraction of compressed inputs."""
+
+import gzip
+import io
+import os
+import errno
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "docker"))
+
+from magic_bucket.archive import (extract_member, extract_zip, gunzip_stream,
+                                  InvalidArchive, member_path, zip_members)
+
+
+def gzipped(data):
+    buffer = io.BytesIO()
+    f = gzip.GzipFile(fileobj=buffer, mode="wb")
+    f.write(data)
+    f.close()
+    return buffer.getvalue()
+
+
+class ResetStream(object):
+    """Reads `data`, then fails like a dropped connection."""
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size):
+        data = self.stream.read(size)
+        if not data:
+            raise socket.error(errno.ECONNRESET, "Connection reset by peer")
+        return data
+
+
+class GunzipStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "output")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def gunzip(self, data, chunk_size=7):
+        written = gunzip_stream(io.BytesIO(data), self.filename, chunk_size)
+        with open(self.filename, "rb") as f:
+            output = f.read()
+        self.assertEqual(len(output), written)
+        return output
+
+    def test_gunzip(self):
+        data = os.urandom(1000) * 3
+        self.assertEqual(data, self.gunzip(gzipped(data)))
+
+    def test_concatenated_members(self):
+        self.assertEqual(b"first second", self.gunzip(
+            gzipped(b"first ") + gzipped(b"second")))
+
+    def test_zero_padding(self):
+        self.assertEqual(b"padded", self.gunzip(
+            gzipped(b"padded") + b"\0" * 100))
+
+    def test_trailing_garbage(self):
+        with self.assertRaises(InvalidArchive):
+            self.gunzip(gzipped(b"data") + b"\0" * 10 + b"garbage")
+
+    def test_corrupt(self):
+        data = bytearray(gzipped(os.urandom(1000)))
+        data[20:40] = b"\xff" * 20
+        with self.assertRaises(InvalidArchive):
+            self.gunzip(bytes(data))
+
+    def test_truncated(self):
+        with self.assertRaises(InvalidArchive):
+            self.gunzip(gzipped(os.urandom(1000))[:-100])
+
+    def test_not_gzip(self):
+        with self.assertRaises(InvalidArchive):
+            self.gunzip(b"not a gzip file")
+
+    def test_connection_errors_pass_through(self):
+        stream = ResetStream(gzipped(os.urandom(1000))[:-100])
+        with self.assertRaises(socket.error) as raised:
+            gunzip_stream(stream, self.filename, 7)
+        self.assertNotIsInstance(raised.exception, InvalidArchive)
+
+
+class ZipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = os.path.join(self.directory, "input.zip")
+        with zipfile.ZipFile(self.archive, "w",
+                             zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("day1/scan.rxp", b"one" * 1000)
+            archive.writestr("config.json", b"{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_members(self):
+        self.assertEqual(["day1/scan.rxp", "config.json"],
+                         zip_members(self.archive))
+
+    def test_extract_member(self):
+        path = extract_member(self.archive, "day1/scan.rxp", self.directory)
+        self.assertEqual(os.path.join(self.directory, "scan.rxp"), path)
+        with open(path, "rb") as f:
+            self.assertEqual(b"one" * 1000, f.read())
+
+    def test_extract_zip_replaces_links(self):
+        other = os.path.join(self.directory, "other")
+        with open(other, "wb") as f:
+            f.write(b"cached")
+        os.link(other, os.path.join(self.directory, "config.json"))
+        extract_zip(self.archive, self.directory)
+        with open(other, "rb") as f:
+            self.assertEqual(b"cached", f.read())
+
+    def test_extract_zip_stays_in_the_directory(self):
+        directory = os.path.join(self.directory, "work")
+        os.mkdir(directory)
+        outside = os.path.join(self.directory, "outside")
+        with open(outside, "wb") as f:
+            f.write(b"keep")
+        with zipfile.ZipFile(self.archive, "w") as f:
+            f.writestr("../outside", b"parent")
+            f.writestr(outside, b"absolute")
+        extract_zip(self.archive, directory)
+        with open(outside, "rb") as f:
+            self.assertEqual(b"keep", f.read())
+        with open(os.path.join(directory, "outside"), "rb") as f:
+            self.assertEqual(b"parent", f.read())
+        with open(member_path(directory, outside), "rb") as f:
+            self.assertEqual(b"absolute", f.read())
+
+    def test_member_path(self):
+        self.assertEqual("/work/a/b/scan.las",
+                         member_path("/work", "/../a/./b//scan.las"))
+        self.assertEqual("/work/scan.las", member_path("/work", "scan.las"))
+
+    def test_bad_zip(self):
+        with open(self.archive, "wb") as f:
+            f.write(b"not a zip file")
+        with self.assertRaises(InvalidArchive):
+            zip_members(self.archive)
+
+    def test_corrupt_member(self):
+        with open(self.archive, "rb") as f:
+            data = bytearray(f.read())
+        data[60:80] = b"\xff" * 20
+        with open(self.archive, "wb") as f:
+            f.write(bytes(data))
+        with self.assertRaises(InvalidArchive):
+            extract_member(self.archive, "day1/scan.rxp", self.directory)
+
+    def test_bad_crc(self):
+        with zipfile.ZipFile(self.archive, "w") as archive:
+            archive.writestr("scan.las", b"points" * 100)
+        with open(self.archive, "rb") as f:
+            data = f.read()
+        start = data.index(b"points")
+        with open(self.archive, "wb") as f:
+            f.write(data[:start] + b"POINTS" + data[start + 6:])
+        with self.assertRaises(InvalidArchive):
+            extract_member(self.archive, "scan.las", self.directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
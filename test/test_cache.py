@@ -0,0 +1,105 @@
+"""Tests for the artifact cache."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "docker"))
+
+from magic_bucket.cache import ArtifactCache
+
+
+class StubMagicBucket(object):
+    """Serves objects from a dictionary of key to contents."""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = 0
+
+    def object_etag(self, bucket_name, key):
+        if key not in self.objects:
+            return None
+        return '"{}"'.format(hash(self.objects[key]))
+
+    def download_file(self, bucket_name, key, filename):
+        self.downloads += 1
+        with open(filename, "wb") as f:
+            f.write(self.objects[key])
+        return True
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.magic_bucket = StubMagicBucket({"small.laz": b"s" * 400,
+                                             "other.laz": b"o" * 400,
+                                             "large.laz": b"l" * 2000})
+        self.cache = ArtifactCache(self.magic_bucket,
+                                   os.path.join(self.directory, "cache"),
+                                   max_bytes=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, key):
+        destination = os.path.join(self.directory, key)
+        self.assertTrue(self.cache.fetch("bucket", key, destination))
+        with open(destination, "rb") as f:
+            self.assertEqual(self.magic_bucket.objects[key], f.read())
+
+    def test_hit(self):
+        self.fetch("small.laz")
+        self.fetch("small.laz")
+        self.assertEqual(1, self.magic_bucket.downloads)
+        self.assertEqual({"hits": 1, "misses": 1, "entries": 1,
+                          "bytes": 400}, self.cache.stats())
+
+    def test_missing(self):
+        self.assertFalse(self.cache.fetch(
+            "bucket", "missing.laz", os.path.join(self.directory, "x")))
+
+    def test_evicts_least_recently_used(self):
+        self.fetch("small.laz")
+        self.fetch("other.laz")
+        self.fetch("small.laz")
+        self.magic_bucket.objects["third.laz"] = b"t" * 400
+        self.fetch("third.laz")
+        self.fetch("small.laz")
+        self.assertEqual(3, self.magic_bucket.downloads)
+        self.fetch("other.laz")
+        self.assertEqual(4, self.magic_bucket.downloads)
+
+    def test_larger_than_the_cache(self):
+        self.fetch("large.laz")
+        self.fetch("large.laz")
+        self.assertEqual(2, self.magic_bucket.downloads)
+        self.assertEqual(0, self.cache.stats()["entries"])
+        self.assertEqual([], os.listdir(self.cache.directory))
+
+    def test_derive(self):
+        def upper(source, output):
+            with open(source, "rb") as f, open(output, "wb") as g:
+                g.write(f.read().upper())
+        for _ in range(2):
+            destination = os.path.join(self.directory, "small.las")
+            self.assertTrue(self.cache.derive("bucket", "small.laz", ".las",
+                                              upper, destination))
+            with open(destination, "rb") as f:
+                self.assertEqual(b"S" * 400, f.read())
+        self.assertEqual(1, self.magic_bucket.downloads)
+
+    def test_placed_files_survive_eviction(self):
+        self.fetch("small.laz")
+        self.fetch("other.laz")
+        self.magic_bucket.objects["third.laz"] = b"t" * 400
+        self.fetch("third.laz")
+        with open(os.path.join(self.directory, "small.laz"), "rb") as f:
+            self.assertEqual(b"s" * 400, f.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
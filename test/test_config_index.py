@@ -0,0 +1,118 @@
+"""Tests for the configuration index."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "docker"))
+
+from botocore.exceptions import ClientError
+
+from magic_bucket.config_index import ConfigIndex
+
+
+class StubS3(object):
+    """An s3 resource over a dictionary of key to ETag, counting requests.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.listings = []
+        self.heads = []
+
+    def Bucket(self, bucket_name):
+        return StubBucket(self)
+
+    def Object(self, bucket_name, key):
+        return StubObject(self, key)
+
+
+class StubBucket(object):
+
+    def __init__(self, s3):
+        self.s3 = s3
+        self.objects = self
+
+    def filter(self, Prefix, Delimiter):
+        self.s3.listings.append(Prefix)
+        for key, etag in sorted(self.s3.objects.items()):
+            if key.startswith(Prefix) and Delimiter not in key[len(Prefix):]:
+                yield StubObject(self.s3, key, etag)
+
+
+class StubObject(object):
+
+    def __init__(self, s3, key, e_tag=None):
+        self.s3 = s3
+        self.key = key
+        self.e_tag = e_tag
+
+    def load(self):
+        self.s3.heads.append(self.key)
+        if self.key not in self.s3.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        self.e_tag = self.s3.objects[self.key]
+
+
+class ConfigIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = StubS3({
+            "pdal-translate/config.json": "root",
+            "pdal-translate/to-laz/config.json": "to-laz",
+            "pdal-translate/to-laz/a.las": "a",
+            "pdal-translate/to-laz/b.las": "b",
+            "pdal-translate/to-laz/b.las.json": "sidecar",
+            "pdal-translate/to-laz/output/a.laz": "output",
+            "pdal-translate/other/c.las": "c",
+        })
+        self.index = ConfigIndex(self.s3)
+
+    def nearest(self, key):
+        return self.index.nearest("bucket", key, "config.json")
+
+    def test_directory_config(self):
+        self.assertEqual(("pdal-translate/to-laz/config.json", "to-laz"),
+                         self.nearest("pdal-translate/to-laz/a.las"))
+
+    def test_sidecar_wins(self):
+        self.assertEqual(("pdal-translate/to-laz/b.las.json", "sidecar"),
+                         self.nearest("pdal-translate/to-laz/b.las"))
+
+    def test_parent_config(self):
+        self.assertEqual(("pdal-translate/config.json", "root"),
+                         self.nearest("pdal-translate/other/c.las"))
+
+    def test_no_config(self):
+        del self.s3.objects["pdal-translate/config.json"]
+        self.assertIsNone(self.nearest("pdal-translate/other/c.las"))
+
+    def test_lists_each_directory_once(self):
+        self.nearest("pdal-translate/to-laz/a.las")
+        self.nearest("pdal-translate/to-laz/b.las")
+        self.nearest("pdal-translate/other/c.las")
+        self.assertEqual(["pdal-translate/to-laz/", "pdal-translate/other/",
+                          "pdal-translate/"], self.s3.listings)
+        self.assertEqual([], self.s3.heads)
+
+    def test_new_key_does_not_relist(self):
+        self.nearest("pdal-translate/to-laz/a.las")
+        for i in range(5):
+            key = "pdal-translate/to-laz/new{}.las".format(i)
+            self.s3.objects[key] = "new"
+            self.assertEqual(("pdal-translate/to-laz/config.json", "to-laz"),
+                             self.nearest(key))
+        self.assertEqual(["pdal-translate/to-laz/"], self.s3.listings)
+        self.assertEqual(5, len(self.s3.heads))
+
+    def test_sidecar_of_a_new_key(self):
+        self.nearest("pdal-translate/to-laz/a.las")
+        self.s3.objects["pdal-translate/to-laz/d.las"] = "d"
+        self.s3.objects["pdal-translate/to-laz/d.las.json"] = "d-sidecar"
+        self.assertEqual(("pdal-translate/to-laz/d.las.json", "d-sidecar"),
+                         self.nearest("pdal-translate/to-laz/d.las"))
+
+
+if __name__ == "__main__":
+    unittest.main()
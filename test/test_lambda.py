@@ -0,0 +1,477 @@
+"""Tests for the lambda, against stub sqs and ecs clients."""
+
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "docker"))
+
+from magic_bucket.task.task import Task
+
+
+def load_lambda():
+    """Loads `lambda.py`, which is not an importable module name."""
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    return imp.load_source("magic_bucket_lambda",
+                           os.path.join(ROOT, "lambda.py"))
+
+
+lambda_module = load_lambda()
+
+
+def record(key, etag="etag", sequencer=None, bucket="bucket"):
+    s3_object = {"key": key, "eTag": etag}
+    if sequencer is not None:
+        s3_object["sequencer"] = sequencer
+    return {"s3": {"bucket": {"name": bucket}, "object": s3_object}}
+
+
+class StubSqs(object):
+    """Records sent messages; batches listed in `fail` partly fail."""
+
+    def __init__(self, visible=0, in_flight=0, fail=()):
+        self.visible = visible
+        self.in_flight = in_flight
+        self.fail = set(fail)
+        self.batches = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append((QueueUrl, [json.loads(entry["MessageBody"])
+                                        for entry in Entries]))
+        if len(self.batches) - 1 in self.fail:
+            return {"Successful": [{"Id": entry["Id"]}
+                                   for entry in Entries[1:]],
+                    "Failed": [{"Id": Entries[0]["Id"],
+                                "Code": "InternalError"}]}
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        return {"Attributes": {
+            "ApproximateNumberOfMessages": str(self.visible),
+            "ApproximateNumberOfMessagesNotVisible": str(self.in_flight)}}
+
+
+class StubEcs(object):
+    """Starts at most `capacity` tasks per call; `running` are listed."""
+
+    def __init__(self, running=0, capacity=None):
+        self.running = running
+        self.capacity = capacity
+        self.runs = []
+
+    def run_task(self, taskDefinition, count):
+        self.runs.append((taskDefinition, count))
+        started = count if self.capacity is None else min(count,
+                                                          self.capacity)
+        return {"tasks": [{"taskArn": str(i)} for i in range(started)],
+                "failures": [{"reason": "RESOURCE:CPU"}] * (count - started)}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, family, desiredStatus):
+        return [{"taskArns": ["running"] * self.running}]
+
+
+class TasksToStartTest(unittest.TestCase):
+
+    def test_no_work(self):
+        self.assertEqual(0, lambda_module.tasks_to_start(0, 0, 20, 10))
+
+    def test_one_task_for_a_small_backlog(self):
+        self.assertEqual(1, lambda_module.tasks_to_start(1, 0, 20, 10))
+
+    def test_rounds_up(self):
+        self.assertEqual(3, lambda_module.tasks_to_start(41, 0, 20, 10))
+
+    def test_counts_running_tasks(self):
+        self.assertEqual(1, lambda_module.tasks_to_start(41, 2, 20, 10))
+        self.assertEqual(0, lambda_module.tasks_to_start(41, 5, 20, 10))
+
+    def test_caps_at_max_containers(self):
+        self.assertEqual(10, lambda_module.tasks_to_start(1000, 0, 20, 10))
+
+
+class ScaleEcsTasksTest(unittest.TestCase):
+
+    def scale(self, sqs, ecs, minimum_depth=0):
+        return lambda_module.scale_ecs_tasks(
+            "queue-url", "family", sqs_client=sqs, ecs_client=ecs,
+            messages_per_container=10, max_containers=25,
+            minimum_depth=minimum_depth)
+
+    def test_starts_in_batches_of_ten(self):
+        ecs = StubEcs()
+        self.assertEqual(25, self.scale(StubSqs(visible=300), ecs))
+        self.assertEqual([("family", 10), ("family", 10), ("family", 5)],
+                         ecs.runs)
+
+    def test_counts_in_flight_messages_and_running_tasks(self):
+        ecs = StubEcs(running=2)
+        self.assertEqual(1, self.scale(StubSqs(visible=20, in_flight=10),
+                                       ecs))
+
+    def test_minimum_depth(self):
+        self.assertEqual(2, self.scale(StubSqs(), StubEcs(),
+                                       minimum_depth=15))
+
+    def test_stops_when_no_task_starts(self):
+        ecs = StubEcs(capacity=0)
+        self.assertEqual(0, self.scale(StubSqs(visible=300), ecs))
+        self.assertEqual(1, len(ecs.runs))
+
+    def test_partial_start(self):
+        ecs = StubEcs(capacity=4)
+        self.assertEqual(25, self.scale(StubSqs(visible=300), ecs))
+        self.assertEqual([10, 10, 10, 10, 9, 5, 1],
+                         [count for _, count in ecs.runs])
+
+
+class SendSqsMessagesTest(unittest.TestCase):
+
+    def test_batches_of_ten(self):
+        sqs = StubSqs()
+        records = [record("pdal-info/{}.las".format(i)) for i in range(23)]
+        self.assertEqual(23, lambda_module.send_sqs_messages(
+            records, "queue-url", sqs_client=sqs))
+        self.assertEqual([10, 10, 3], [len(batch) for _, batch in
+                                       sqs.batches])
+        self.assertEqual(records, [body for _, batch in sqs.batches
+                                   for body in batch])
+
+    def test_partial_failure_raises(self):
+        sqs = StubSqs(fail=[1])
+        records = [record("pdal-info/{}.las".format(i)) for i in range(23)]
+        with self.assertRaises(RuntimeError):
+            lambda_module.send_sqs_messages(records, "queue-url",
+                                            sqs_client=sqs)
+        self.assertEqual(2, len(sqs.batches))
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def test_keeps_the_latest_sequencer(self):
+        old = record("pdal-info/a.las", etag="old", sequencer="0A")
+        new = record("pdal-info/a.las", etag="new", sequencer="0B")
+        self.assertEqual([new], lambda_module.coalesce([old, new]))
+        self.assertEqual([new], lambda_module.coalesce([new, old]))
+
+    def test_compares_sequencers_of_different_lengths(self):
+        short = record("pdal-info/a.las", etag="short", sequencer="FF")
+        long = record("pdal-info/a.las", etag="long", sequencer="0100")
+        self.assertEqual([long], lambda_module.coalesce([long, short]))
+
+    def test_keeps_the_order_of_first_appearance(self):
+        records = [record("pdal-info/b.las", sequencer="01"),
+                   record("pdal-info/a.las", sequencer="02"),
+                   record("pdal-info/b.las", sequencer="03"),
+                   record("pdal-info/a.las", bucket="other")]
+        self.assertEqual(
+            [("bucket", "pdal-info/b.las", "03"),
+             ("bucket", "pdal-info/a.las", "02"),
+             ("other", "pdal-info/a.las", None)],
+            [(r["s3"]["bucket"]["name"], r["s3"]["object"]["key"],
+              r["s3"]["object"].get("sequencer"))
+             for r in lambda_module.coalesce(records)])
+
+    def test_without_sequencers_the_last_record_wins(self):
+        first = record("pdal-info/a.las", etag="first")
+        last = record("pdal-info/a.las", etag="last")
+        self.assertEqual([last], lambda_module.coalesce([first, last]))
+
+    def test_sequencer(self):
+        self.assertEqual(255, lambda_module.sequencer(
+            record("a", sequencer="00FF")))
+        self.assertEqual(-1, lambda_module.sequencer(record("a")))
+
+
+class SqliteStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = lambda_module.SqliteStore(":memory:")
+
+    def test_claims_once(self):
+        self.assertTrue(self.store.claim("bucket", "key", "etag"))
+        self.assertFalse(self.store.claim("bucket", "key", "etag"))
+        self.assertFalse(self.store.claim("bucket", "key", '"etag"'))
+        self.assertTrue(self.store.claim("bucket", "key", "other"))
+        self.assertTrue(self.store.claim("bucket", "other", "etag"))
+
+    def test_claims_expire(self):
+        store = lambda_module.SqliteStore(":memory:", ttl=-1)
+        self.assertTrue(store.claim("bucket", "key", "etag"))
+        self.assertTrue(store.claim("bucket", "key", "etag"))
+
+    def test_release(self):
+        self.store.claim("bucket", "key", "etag")
+        self.store.release("bucket", "key", "etag")
+        self.assertTrue(self.store.claim("bucket", "key", "etag"))
+
+
+class FailingStore(object):
+    """Claims everything, but fails on the `fail_at`th claim."""
+
+    def __init__(self, fail_at):
+        self.fail_at = fail_at
+        self.claims = []
+        self.released = []
+
+    def claim(self, bucket, key, etag):
+        if len(self.claims) + 1 == self.fail_at:
+            raise RuntimeError("store unavailable")
+        self.claims.append(key)
+        return True
+
+    def release(self, bucket, key, etag):
+        self.released.append(key)
+
+
+class ClaimTest(unittest.TestCase):
+
+    def test_releases_claims_when_the_store_fails(self):
+        store = FailingStore(fail_at=3)
+        records = [record("pdal-info/{}.las".format(i)) for i in range(4)]
+        with self.assertRaises(RuntimeError):
+            lambda_module.claim(records, store)
+        self.assertEqual(["pdal-info/0.las", "pdal-info/1.las"],
+                         store.released)
+
+    def test_records_without_etag_are_not_claimed(self):
+        store = lambda_module.SqliteStore(":memory:")
+        records = [record("pdal-info/a.las", etag=None)] * 2
+        self.assertEqual(records, lambda_module.claim(records, store))
+
+
+def queue_everything(record, registry, context=None, slack=None):
+    return False
+
+
+class MainTest(unittest.TestCase):
+    """Runs the entrypoint with stub clients and a SQLite idempotency
+    store; nothing runs inline unless `run_inline` is replaced.
+    """
+
+    PATCHED = ["sqs", "ecs", "idempotency_store", "run_inline"]
+
+    def setUp(self):
+        self.saved = dict((name, getattr(lambda_module, name))
+                          for name in self.PATCHED)
+        lambda_module.sqs = StubSqs()
+        lambda_module.ecs = StubEcs()
+        lambda_module.idempotency_store = lambda_module.SqliteStore(
+            ":memory:")
+        lambda_module.run_inline = queue_everything
+        self.event = {"Records": [record("pdal-info/a.las"),
+                                  record("pdal-translate/b.las"),
+                                  record("pdal-translate/output/b.las")]}
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(lambda_module, name, value)
+
+    def sent(self):
+        return sorted(body["s3"]["object"]["key"]
+                      for _, batch in lambda_module.sqs.batches
+                      for body in batch)
+
+    def test_sends_to_each_pool_once(self):
+        self.assertTrue(lambda_module.main(self.event, None))
+        self.assertEqual(["pdal-info/a.las", "pdal-translate/b.las"],
+                         self.sent())
+        self.assertEqual(["magic-bucket-short", "magic-bucket"],
+                         [family for family, _ in lambda_module.ecs.runs])
+        lambda_module.main(self.event, None)
+        self.assertEqual(2, len(lambda_module.sqs.batches))
+
+    def test_releases_unsent_records_when_sending_fails(self):
+        lambda_module.sqs = StubSqs(fail=[1])
+        with self.assertRaises(RuntimeError):
+            lambda_module.main(self.event, None)
+        lambda_module.sqs = StubSqs()
+        lambda_module.main(self.event, None)
+        self.assertEqual(["pdal-translate/b.las"], self.sent())
+
+    def test_keeps_claims_of_sent_records_when_scaling_fails(self):
+        def fail(taskDefinition, count):
+            raise RuntimeError("ecs unavailable")
+        lambda_module.ecs.run_task = fail
+        with self.assertRaises(RuntimeError):
+            lambda_module.main(self.event, None)
+        lambda_module.sqs = StubSqs()
+        lambda_module.ecs = StubEcs()
+        lambda_module.main(self.event, None)
+        self.assertEqual(["pdal-translate/b.las"], self.sent())
+
+    def test_inline_jobs_are_not_sent(self):
+        lambda_module.run_inline = (
+            lambda record, registry, context, slack:
+            record["s3"]["object"]["key"].startswith("pdal-info/"))
+        lambda_module.main(self.event, None)
+        self.assertEqual(["pdal-translate/b.las"], self.sent())
+        self.assertEqual(["magic-bucket"],
+                         [family for family, _ in lambda_module.ecs.runs])
+
+    def test_releases_records_when_running_inline_fails(self):
+        def fail(record, registry, context, slack):
+            raise RuntimeError("no space left")
+        lambda_module.run_inline = fail
+        with self.assertRaises(RuntimeError):
+            lambda_module.main(self.event, None)
+        lambda_module.run_inline = queue_everything
+        lambda_module.main(self.event, None)
+        self.assertEqual(["pdal-info/a.las", "pdal-translate/b.las"],
+                         self.sent())
+
+
+class S3Object(object):
+
+    def __init__(self, bucket_name, key):
+        self.bucket_name = bucket_name
+        self.key = key
+
+
+class StubMagicBucket(object):
+    """Keeps uploaded files and JSON in dictionaries."""
+
+    def __init__(self):
+        self.uploads = {}
+        self.json = {}
+
+    def s3_object(self, bucket_name, key):
+        return S3Object(bucket_name, key)
+
+    def object_etag(self, bucket_name, key):
+        return '"etag"'
+
+    def get_json(self, bucket_name, key):
+        return self.json.get(key)
+
+    def put_json(self, bucket_name, key, data):
+        self.json[key] = data
+
+    def object_metadata(self, s3_object):
+        return self.uploads.get(s3_object.key, (None, None))[1]
+
+    def upload_file(self, filename, bucket_name, key, metadata=None):
+        with open(filename) as f:
+            self.uploads[key] = (f.read(), metadata)
+        return S3Object(bucket_name, key)
+
+
+class RemoteTask(Task):
+    """Makes its output from the key alone, if `remote` is set."""
+
+    def __init__(self, magic_bucket, s3_object, remote=True):
+        super(RemoteTask, self).__init__(magic_bucket, s3_object)
+        self.remote = remote
+
+    def name(self):
+        return "remote"
+
+    def process_remote(self):
+        if not self.remote:
+            return None
+        output = self.path("out.json")
+        with open(output, "w") as f:
+            f.write(self.key)
+        return output
+
+    def process(self, filename):
+        raise AssertionError("The input was downloaded")
+
+
+class StubSlack(object):
+
+    def __init__(self):
+        self.successes = []
+
+    def success(self, message, group=None):
+        self.successes.append((message, group))
+
+
+class RunInlineTest(unittest.TestCase):
+
+    PATCHED = ["MagicBucket", "create_task", "get_inline_magic_bucket",
+               "metrics_sink", "INLINE_WORK_ROOT"]
+    REGISTRY = {"default_pool": "pool", "pools": {"pool": {}},
+                "tasks": {"remote": {"pool": "pool", "inline_max_size": 1}}}
+
+    def setUp(self):
+        self.saved = dict((name, getattr(lambda_module, name))
+                          for name in self.PATCHED)
+        self.directory = tempfile.mkdtemp()
+        self.magic_bucket = StubMagicBucket()
+        self.slack = StubSlack()
+        self.records = []
+        self.remote = True
+        lambda_module.MagicBucket = object
+        lambda_module.create_task = (
+            lambda magic_bucket, s3_object:
+            RemoteTask(magic_bucket, s3_object, self.remote))
+        lambda_module.get_inline_magic_bucket = lambda: self.magic_bucket
+        lambda_module.metrics_sink = self
+        lambda_module.INLINE_WORK_ROOT = self.directory
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(lambda_module, name, value)
+        shutil.rmtree(self.directory)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def run_inline(self, key="remote/dir/a.las", size=1000):
+        event_record = record(key)
+        event_record["s3"]["object"]["size"] = size
+        return lambda_module.run_inline(event_record, self.REGISTRY,
+                                        slack=self.slack)
+
+    def test_runs_remote_tasks(self):
+        self.assertTrue(self.run_inline())
+        self.assertEqual(["remote/dir/output/out.json"],
+                         list(self.magic_bucket.uploads))
+        self.assertEqual([(
+            "Completed *remote* on `remote/dir/a.las`, uploaded to "
+            "s3://bucket/remote/dir/output/out.json", "remote/dir")],
+            self.slack.successes)
+        self.assertEqual("succeeded", self.records[0]["status"])
+        self.assertEqual("inline", self.records[0]["path"])
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_skips_current_outputs(self):
+        self.run_inline()
+        self.assertTrue(self.run_inline())
+        self.assertTrue(self.slack.successes[1][0].startswith(
+            "Skipped *remote*"))
+        self.assertEqual("skipped", self.records[1]["status"])
+
+    def test_queues_tasks_that_need_their_input(self):
+        self.remote = False
+        self.assertFalse(self.run_inline())
+        self.assertEqual({}, self.magic_bucket.uploads)
+        self.assertEqual([], self.slack.successes)
+        self.assertEqual([], self.records)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_queues_failed_tasks(self):
+        def fail(filename, bucket_name, key, metadata=None):
+            raise IOError("s3 unavailable")
+        self.magic_bucket.upload_file = fail
+        self.assertFalse(self.run_inline())
+        self.assertEqual([], self.slack.successes)
+        self.assertEqual("failed", self.records[0]["status"])
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_queues_large_objects_and_other_tasks(self):
+        self.assertFalse(self.run_inline(size=2 * lambda_module.MB))
+        self.assertFalse(self.run_inline(key="pdal-info/a.las"))
+        self.assertEqual([], self.records)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Tests for reading LAS public headers."""
+
+import base64
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "docker"))
+
+from magic_bucket.las import InvalidLasHeader, read_header
+
+
+def vlr(user_id, record_id, payload):
+    return (struct.pack("<H16sHH32s", 0, user_id, record_id, len(payload),
+                        b"description") + payload)
+
+
+def las(vlrs=(), minor_version=2, dataformat_id=0, count=3,
+        extended_count=None):
+    header_size = 375 if minor_version >= 4 else 227
+    records = b"".join(vlrs)
+    header = struct.pack(
+        "<4sHHIHH8sBB32s32sHHHIIBHI5I6d",
+        b"LASF", 7, 1, 0x01020304, 5, 6, b"\x01" * 8, 1, minor_version,
+        b"system", b"software", 32, 2018, header_size,
+        header_size + len(records), len(vlrs), dataformat_id, 20, count,
+        count, 0, 0, 0, 0, 0.01, 0.01, 0.01, 1.0, 2.0, 3.0)
+    header += struct.pack("<6d", 10.0, 0.0, 20.0, 5.0, 30.0, -1.0)
+    if minor_version >= 4:
+        header += b"\0" * (247 - len(header))
+        header += struct.pack("<Q", extended_count or count)
+        header += b"\0" * (header_size - len(header))
+    return header + records + b"\0" * 20 * count
+
+
+def reader(data, reads=None):
+    def read(start, length):
+        if reads is not None:
+            reads.append((start, length))
+        return data[start:start + length]
+    return read
+
+
+class ReadHeaderTest(unittest.TestCase):
+
+    def test_public_header(self):
+        header = read_header(reader(las()))
+        self.assertEqual(header["filesource_id"], 7)
+        self.assertEqual(header["global_encoding"], 1)
+        self.assertEqual(header["project_id"],
+                         "01020304-0005-0006-0101-010101010101")
+        self.assertEqual((header["major_version"], header["minor_version"]),
+                         (1, 2))
+        self.assertEqual(header["system_id"], "system")
+        self.assertEqual(header["software_id"], "software")
+        self.assertEqual((header["creation_doy"], header["creation_year"]),
+                         (32, 2018))
+        self.assertEqual(header["count"], 3)
+        self.assertEqual(header["dataformat_id"], 0)
+        self.assertFalse(header["compressed"])
+        self.assertEqual((header["offset_x"], header["offset_y"],
+                          header["offset_z"]), (1.0, 2.0, 3.0))
+        self.assertEqual((header["minx"], header["maxx"]), (0.0, 10.0))
+        self.assertEqual((header["miny"], header["maxy"]), (5.0, 20.0))
+        self.assertEqual((header["minz"], header["maxz"]), (-1.0, 30.0))
+        self.assertEqual(header["vlrs"], [])
+        self.assertEqual(header["srs"], {"wkt": "", "epsg": None})
+
+    def test_compressed_point_format(self):
+        header = read_header(reader(las(dataformat_id=0x80 | 3)))
+        self.assertTrue(header["compressed"])
+        self.assertEqual(header["dataformat_id"], 3)
+
+    def test_extended_point_count(self):
+        header = read_header(reader(las(minor_version=4, count=0,
+                                        extended_count=2 ** 33)))
+        self.assertEqual(header["count"], 2 ** 33)
+
+    def test_wkt(self):
+        data = las([vlr(b"LASF_Projection", 2112, b"PROJCS[\"x\"]\0")])
+        header = read_header(reader(data))
+        self.assertEqual(header["srs"]["wkt"], 'PROJCS["x"]')
+        self.assertEqual(len(header["vlrs"]), 1)
+        self.assertEqual(header["vlrs"][0]["record_id"], 2112)
+        self.assertEqual(header["vlrs"][0]["description"], "description")
+
+    def test_epsg_from_geo_keys(self):
+        keys = struct.pack("<4H", 1, 1, 0, 2) + struct.pack(
+            "<4H", 1024, 0, 1, 1) + struct.pack("<4H", 3072, 0, 1, 32613)
+        header = read_header(reader(las([
+            vlr(b"other", 34735, struct.pack("<8H", 1, 1, 0, 1, 3072, 0, 1,
+                                             4326)),
+            vlr(b"LASF_Projection", 34735, keys)])))
+        self.assertEqual(header["srs"]["epsg"], 32613)
+
+    def test_geographic_epsg(self):
+        keys = struct.pack("<8H", 1, 1, 0, 1, 2048, 0, 1, 4326)
+        header = read_header(reader(las([
+            vlr(b"LASF_Projection", 34735, keys)])))
+        self.assertEqual(header["srs"]["epsg"], 4326)
+
+    def test_reads_records_beyond_first_read(self):
+        payload = b"x" * 40000
+        data = las([vlr(b"big", 1, payload), vlr(b"big", 2, payload),
+                    vlr(b"LASF_Projection", 2112, b"WKT\0")])
+        reads = []
+        header = read_header(reader(data, reads))
+        self.assertEqual(len(reads), 2)
+        self.assertEqual(reads[1][0], 64 * 1024)
+        self.assertEqual(base64.b64decode(header["vlrs"][1]["data"]),
+                         payload)
+        self.assertEqual(header["srs"]["wkt"], "WKT")
+
+    def test_one_read_for_small_headers(self):
+        reads = []
+        read_header(reader(las([vlr(b"LASF_Projection", 2112, b"WKT\0")]),
+                           reads))
+        self.assertEqual(reads, [(0, 64 * 1024)])
+
+    def test_truncated_records(self):
+        data = las([vlr(b"one", 1, b"a"), vlr(b"two", 2, b"b")])
+        header = read_header(reader(data[:227 + 54 + 1]))
+        self.assertEqual([v["user_id"] for v in header["vlrs"]], ["one"])
+
+    def test_not_las(self):
+        with self.assertRaises(InvalidLasHeader):
+            read_header(reader(b"PK\x03\x04" + b"\0" * 300))
+        with self.assertRaises(InvalidLasHeader):
+            read_header(reader(las()[:100]))
+
+
+if __name__ == "__main__":
+    unittest.main()
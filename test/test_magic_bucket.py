@@ -0,0 +1,102 @@
+"""Tests for consuming sqs messages and reading ranges, against the
+benchmark's stand-ins.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "docker"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import standins
+from magic_bucket import MagicBucket
+from magic_bucket.las import InvalidLasHeader
+from magic_bucket.task.pdal_info import PdalInfo
+
+
+class ConsumeMessagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = standins.Queue(max_wait=0)
+        self.magic_bucket = MagicBucket(
+            "us-east-1", self.queue.url, s3=standins.S3(self.directory),
+            sqs_queue=self.queue)
+        for i in range(3):
+            self.queue.send("message {}".format(i))
+
+    def tearDown(self):
+        self.magic_bucket.stop_consuming()
+        shutil.rmtree(self.directory)
+
+    def test_keeps_the_whole_batch_in_flight(self):
+        messages = self.magic_bucket.consume_messages()
+        first = next(messages)
+        self.assertEqual("message 0", first.body)
+        self.assertEqual(3, self.magic_bucket.in_flight.count())
+        self.assertEqual((0, 3), self.queue.counts())
+
+    def test_releases_the_rest_of_the_batch_when_closed(self):
+        messages = self.magic_bucket.consume_messages()
+        next(messages)
+        messages.close()
+        self.assertEqual(1, self.magic_bucket.in_flight.count())
+        self.assertEqual((2, 1), self.queue.counts())
+
+    def test_releases_the_rest_of_the_batch_on_stop(self):
+        messages = self.magic_bucket.consume_messages()
+        next(messages)
+        self.magic_bucket.request_stop("error")
+        self.assertEqual([], list(messages))
+        self.assertEqual("error", self.magic_bucket.exit_cause)
+        self.assertEqual((2, 1), self.queue.counts())
+
+    def test_stops_when_empty(self):
+        bodies = [message.body for message in
+                  self.magic_bucket.consume_messages()]
+        self.assertEqual(["message 0", "message 1", "message 2"], bodies)
+        self.assertEqual("empty", self.magic_bucket.exit_cause)
+
+
+class ReadRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.s3 = standins.S3(self.directory)
+        self.magic_bucket = MagicBucket(
+            "us-east-1", "queue-url", s3=self.s3,
+            sqs_queue=standins.Queue())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, key, start, length):
+        return self.magic_bucket.read_range(
+            self.magic_bucket.s3_object("bucket", key), start, length)
+
+    def test_reads_a_range(self):
+        self.s3.put("bucket", "data", body=b"0123456789")
+        self.assertEqual(b"234", self.read("data", 2, 3))
+        self.assertEqual(b"89", self.read("data", 8, 100))
+
+    def test_past_the_end_is_empty(self):
+        self.s3.put("bucket", "data", body=b"0123456789")
+        self.assertEqual(b"", self.read("data", 10, 100))
+        self.s3.put("bucket", "empty", body=b"")
+        self.assertEqual(b"", self.read("empty", 0, 100))
+
+    def test_empty_las_header(self):
+        self.s3.put("bucket", "pdal-info/empty.las", body=b"")
+        task = PdalInfo(self.magic_bucket, self.magic_bucket.s3_object(
+            "bucket", "pdal-info/empty.las"))
+        task.mode = PdalInfo.HEADER
+        with self.assertRaises(InvalidLasHeader):
+            task.process_remote()
+
+
+if __name__ == "__main__":
+    unittest.main()
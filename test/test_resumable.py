@@ -0,0 +1,345 @@
+"""Tests for resumable s3 transfers, against a fake s3 object."""
+
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "docker"))
+
+from botocore.exceptions import ClientError
+
+from magic_bucket import resumable
+from magic_bucket.transfer import TransferSettings
+
+PART_SIZE = 4
+DATA = b"0123456789"
+
+
+def _error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+def _etag(data):
+    return '"{}"'.format(hashlib.md5(data).hexdigest())
+
+
+class Failures(object):
+    """Raises for the parts it is told to, `times` times each (or always,
+    for None).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = {}
+
+    def add(self, part, times=None):
+        self.remaining[part] = times
+
+    def check(self, part):
+        with self.lock:
+            if part not in self.remaining:
+                return
+            times = self.remaining[part]
+            if times is not None:
+                if times == 0:
+                    return
+                self.remaining[part] = times - 1
+        raise IOError("Connection dropped on part {}".format(part))
+
+
+class FakeObject(object):
+    """An s3 object with ranged, conditional GETs and multipart uploads."""
+
+    def __init__(self, data=DATA):
+        self.bucket_name = "bucket"
+        self.key = "task/scan.las"
+        self.lock = threading.Lock()
+        self.failures = Failures()
+        self.gets = []
+        self.uploads = {}
+        self.initiated = 0
+        self.aborted = []
+        self.metadata = None
+        self.changes = None
+        self.replace(data)
+
+    def replace(self, data):
+        self.data = data
+        self.content_length = len(data)
+        self.e_tag = _etag(data)
+
+    def get(self, Range, IfMatch=None):
+        start, end = [int(n) for n in Range.split("=")[1].split("-")]
+        with self.lock:
+            self.gets.append((start, end))
+            if self.changes is not None:
+                self.replace(self.changes)
+                self.changes = None
+        if IfMatch is not None and IfMatch != self.e_tag:
+            raise _error("PreconditionFailed", "GetObject")
+        self.failures.check(start // PART_SIZE + 1)
+        return {"Body": io.BytesIO(self.data[start:end + 1])}
+
+    def initiate_multipart_upload(self, Metadata=None):
+        with self.lock:
+            self.initiated += 1
+            upload = FakeMultipartUpload(self, str(self.initiated), Metadata)
+            self.uploads[upload.id] = upload
+        return upload
+
+    def MultipartUpload(self, upload_id):
+        return self.uploads.get(upload_id) or MissingUpload()
+
+
+class FakePart(object):
+
+    def __init__(self, upload, number):
+        self.multipart_upload = upload
+        self.part_number = number
+
+    @property
+    def e_tag(self):
+        return _etag(self.multipart_upload.bodies[self.part_number])
+
+    def upload(self, Body, ContentMD5):
+        self.multipart_upload.object.failures.check(self.part_number)
+        with self.multipart_upload.object.lock:
+            self.multipart_upload.bodies[self.part_number] = Body
+            self.multipart_upload.uploaded.append(self.part_number)
+        return {"ETag": self.e_tag}
+
+
+class FakeMultipartUpload(object):
+
+    def __init__(self, s3_object, upload_id, metadata):
+        self.object = s3_object
+        self.id = upload_id
+        self.metadata = metadata
+        self.bodies = {}
+        self.uploaded = []
+        self.parts = self
+
+    def Part(self, number):
+        return FakePart(self, number)
+
+    def all(self):
+        return [FakePart(self, number) for number in sorted(self.bodies)]
+
+    def complete(self, MultipartUpload):
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        if numbers != sorted(self.bodies):
+            raise _error("InvalidPart", "CompleteMultipartUpload")
+        self.object.replace(b"".join(self.bodies[n] for n in numbers))
+        self.object.metadata = self.metadata
+        del self.object.uploads[self.id]
+
+    def abort(self):
+        self.object.aborted.append(self.id)
+        del self.object.uploads[self.id]
+
+
+class MissingUpload(object):
+    """A multipart upload that was completed, aborted or expired."""
+
+    def __init__(self):
+        self.parts = self
+
+    def all(self):
+        raise _error("NoSuchUpload", "ListParts")
+
+    def abort(self):
+        raise _error("NoSuchUpload", "AbortMultipartUpload")
+
+
+class ResumableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = os.path.join(self.directory, "spool")
+        self.settings = TransferSettings(part_size=PART_SIZE, concurrency=2,
+                                         spool=self.spool)
+        self.filename = os.path.join(self.directory, "scan.las")
+        self.progress = []
+        self.object = FakeObject()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with open(self.filename, "rb") as f:
+            return f.read()
+
+    def write(self, data):
+        with open(self.filename, "wb") as f:
+            f.write(data)
+
+
+class DownloadTest(ResumableTest):
+
+    def download(self):
+        resumable.download(self.object, self.filename, self.settings,
+                           self.progress.append)
+
+    def fail_once(self):
+        """Fails a download on its last part, leaving the others done."""
+        self.object.failures.add(3)
+        with self.assertRaises(IOError):
+            self.download()
+        self.assertEqual(2, len(os.listdir(self.spool)))
+        self.object.failures = Failures()
+        self.object.gets = []
+
+    def test_download(self):
+        self.download()
+        self.assertEqual(DATA, self.read())
+        self.assertEqual(len(DATA), sum(self.progress))
+        self.assertEqual([(0, 3), (4, 7), (8, 9)], sorted(self.object.gets))
+        self.assertEqual([], os.listdir(self.spool))
+
+    def test_retries_parts(self):
+        self.object.failures.add(2, times=1)
+        self.download()
+        self.assertEqual(DATA, self.read())
+        self.assertEqual(2, self.object.gets.count((4, 7)))
+
+    def test_resumes(self):
+        self.fail_once()
+        self.download()
+        self.assertEqual(DATA, self.read())
+        self.assertEqual([(8, 9)], self.object.gets)
+        self.assertEqual([], os.listdir(self.spool))
+
+    def test_verifies_the_parts_that_were_done(self):
+        self.fail_once()
+        partial = [name for name in os.listdir(self.spool)
+                   if name.endswith(".part")][0]
+        with open(os.path.join(self.spool, partial), "r+b") as f:
+            f.write(b"x")
+        self.download()
+        self.assertEqual(DATA, self.read())
+        self.assertEqual([(0, 3), (8, 9)], sorted(self.object.gets))
+
+    def test_restarts_when_the_etag_changes(self):
+        self.fail_once()
+        self.object.replace(b"abcdefghij")
+        self.download()
+        self.assertEqual(b"abcdefghij", self.read())
+        self.assertEqual([(0, 3), (4, 7), (8, 9)], sorted(self.object.gets))
+
+    def test_object_changing_during_the_download(self):
+        self.object.changes = b"abcdefghij"
+        with self.assertRaises(ClientError):
+            self.download()
+
+
+class UploadTest(ResumableTest):
+
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        self.object = FakeObject(b"")
+        self.write(DATA)
+
+    def upload(self, metadata=None):
+        resumable.upload(self.object, self.filename, self.settings,
+                         self.progress.append, metadata)
+
+    def fail_once(self, metadata=None):
+        """Fails an upload on its last part, leaving the others done."""
+        self.object.failures.add(3)
+        with self.assertRaises(IOError):
+            self.upload(metadata)
+        self.assertEqual(1, len(os.listdir(self.spool)))
+        self.object.failures = Failures()
+        upload = self.object.uploads["1"]
+        self.assertEqual([1, 2], sorted(upload.bodies))
+        upload.uploaded = []
+        return upload
+
+    def test_upload(self):
+        self.upload({"fingerprint": "f"})
+        self.assertEqual(DATA, self.object.data)
+        self.assertEqual({"fingerprint": "f"}, self.object.metadata)
+        self.assertEqual(len(DATA), sum(self.progress))
+        self.assertEqual({}, self.object.uploads)
+        self.assertEqual([], os.listdir(self.spool))
+
+    def test_retries_parts(self):
+        self.object.failures.add(2, times=1)
+        self.upload()
+        self.assertEqual(DATA, self.object.data)
+        self.assertEqual(1, self.object.initiated)
+
+    def test_reuses_the_upload(self):
+        upload = self.fail_once()
+        self.upload()
+        self.assertEqual(DATA, self.object.data)
+        self.assertEqual(1, self.object.initiated)
+        self.assertEqual([3], upload.uploaded)
+        self.assertEqual([], os.listdir(self.spool))
+
+    def test_verifies_the_parts_that_were_done(self):
+        upload = self.fail_once()
+        self.write(b"x" + DATA[1:])
+        self.upload()
+        self.assertEqual(b"x" + DATA[1:], self.object.data)
+        self.assertEqual(1, self.object.initiated)
+        self.assertEqual([1, 3], sorted(upload.uploaded))
+
+    def test_aborts_the_upload_when_the_file_changes(self):
+        self.fail_once()
+        self.write(DATA + b"more")
+        self.upload()
+        self.assertEqual(DATA + b"more", self.object.data)
+        self.assertEqual(["1"], self.object.aborted)
+        self.assertEqual(2, self.object.initiated)
+
+    def test_aborts_the_upload_when_the_metadata_changes(self):
+        self.fail_once({"fingerprint": "a"})
+        self.upload({"fingerprint": "b"})
+        self.assertEqual({"fingerprint": "b"}, self.object.metadata)
+        self.assertEqual(["1"], self.object.aborted)
+
+    def test_starts_over_when_the_upload_is_gone(self):
+        self.fail_once()
+        del self.object.uploads["1"]
+        self.upload()
+        self.assertEqual(DATA, self.object.data)
+        self.assertEqual(2, self.object.initiated)
+        self.assertEqual([], self.object.aborted)
+
+    def test_ignores_aborting_an_upload_that_is_gone(self):
+        self.fail_once()
+        del self.object.uploads["1"]
+        self.write(DATA + b"more")
+        self.upload()
+        self.assertEqual(DATA + b"more", self.object.data)
+        self.assertEqual(2, self.object.initiated)
+
+
+class PruneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool)
+
+    def test_removes_old_checkpoints(self):
+        old = os.path.join(self.spool, "old.json")
+        new = os.path.join(self.spool, "new.json")
+        for path in (old, new):
+            with open(path, "w") as f:
+                f.write("{}")
+        os.utime(old, (0, 0))
+        resumable.prune(self.spool)
+        self.assertEqual(["new.json"], os.listdir(self.spool))
+
+
+if __name__ == "__main__":
+    unittest.main()
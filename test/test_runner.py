@@ -0,0 +1,113 @@
+"""Tests for running external tools."""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "docker"))
+
+from magic_bucket.runner import run, SubprocessError, SubprocessTimeout
+
+PYTHON = sys.executable
+
+
+def python(code):
+    return [PYTHON, "-c", code]
+
+
+class Sink(object):
+    """Collects what is written to it, without a file descriptor."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+class RunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_result(self):
+        result = run(python("import sys; sys.stdout.write('out')"))
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.output, b"out")
+        self.assertEqual(result.as_dict()["tool"],
+                         os.path.basename(PYTHON))
+        self.assertGreater(result.max_rss, 0)
+
+    def test_combined_output(self):
+        result = run(python("import sys; sys.stdout.write('out'); "
+                            "sys.stdout.flush(); sys.stderr.write('err')"))
+        self.assertEqual(result.output, b"outerr")
+
+    def test_cwd(self):
+        result = run(python("import os; print(os.getcwd())"),
+                     cwd=self.directory)
+        self.assertEqual(os.path.realpath(result.output.strip()),
+                         os.path.realpath(self.directory))
+
+    def test_error(self):
+        with self.assertRaises(SubprocessError) as context:
+            run(python("import sys; sys.stderr.write('broken'); "
+                       "sys.exit(3)"))
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.output, b"broken")
+
+    def test_stdout_to_file(self):
+        filename = os.path.join(self.directory, "out")
+        with open(filename, "wb") as f:
+            result = run(python("import sys; sys.stdout.write('x' * 100000); "
+                                "sys.stderr.write('err')"), stdout=f)
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), b"x" * 100000)
+        self.assertEqual(result.output, b"err")
+
+    def test_stdout_to_sink(self):
+        sink = Sink()
+        result = run(python("import sys; sys.stdout.write('x' * 100000); "
+                            "sys.stderr.write('err')"), stdout=sink)
+        self.assertEqual(sink.getvalue(), b"x" * 100000)
+        self.assertEqual(result.output, b"err")
+
+    def test_stderr_tail_is_truncated(self):
+        sink = Sink()
+        result = run(python("import sys; sys.stdout.write('out'); "
+                            "sys.stderr.write('a' * 1000 + 'end')"),
+                     stdout=sink, tail_size=10)
+        self.assertEqual(result.output, b"[...]aaaaaaaend")
+        self.assertEqual(sink.getvalue(), b"out")
+
+    def test_short_output_is_not_truncated(self):
+        result = run(python("import sys; sys.stdout.write('end')"),
+                     tail_size=10)
+        self.assertEqual(result.output, b"end")
+
+    def test_timeout_kills(self):
+        start = time.time()
+        with self.assertRaises(SubprocessTimeout) as context:
+            run(python("import sys, time; sys.stdout.write('started'); "
+                       "sys.stdout.flush(); time.sleep(60)"), timeout=0.5)
+        self.assertLess(time.time() - start, 30)
+        self.assertIsNone(context.exception.returncode)
+        self.assertEqual(context.exception.output, b"started")
+
+    def test_finishes_within_timeout(self):
+        result = run(python("pass"), timeout=30)
+        self.assertEqual(result.returncode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
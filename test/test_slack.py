@@ -0,0 +1,146 @@
+"""Tests for slack notifications and digests, against a fake client."""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "docker"))
+
+from magic_bucket import Slack
+
+FAIL = Slack.EMOJI["fail"]
+INFO = Slack.EMOJI["info"]
+SUCCESS = Slack.EMOJI["success"]
+
+
+class FakeClient(object):
+    """Records posted messages, answering with `responses` in turn."""
+
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.texts = []
+        self.posted = threading.Event()
+
+    def api_call(self, method, channel=None, text=None, username=None):
+        self.texts.append(text)
+        self.posted.set()
+        if self.responses:
+            return self.responses.pop(0)
+        return {"ok": True}
+
+
+class SlackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.slack = Slack("token", client=self.client)
+
+    def tearDown(self):
+        self.slack.close()
+
+    def test_ungrouped_messages_are_posted(self):
+        self.slack.info("info")
+        self.slack.success("success")
+        self.slack.fail("fail")
+        self.slack.close()
+        self.assertEqual(self.client.texts, [
+            "{} info".format(INFO), "{} success".format(SUCCESS),
+            "{} fail".format(FAIL)])
+
+    def test_grouped_messages_wait_for_the_digest(self):
+        self.slack.success("one", group="pdal-info/a")
+        self.assertFalse(self.client.posted.wait(0.1))
+        self.slack.close()
+        self.assertEqual(self.client.texts, ["{} one".format(SUCCESS)])
+
+    def test_digest(self):
+        for i in range(3):
+            self.slack.success("ok {}".format(i), group="pdal-info/a")
+        self.slack.info("started", group="pdal-info/a")
+        self.slack.success("other", group="pdal-info/b")
+        self.slack.close()
+        self.assertEqual(self.client.texts, [
+            "{} 3 succeeded, 1 started in `pdal-info/a`".format(SUCCESS),
+            "{} other".format(SUCCESS)])
+
+    def test_failures_are_posted_right_away(self):
+        self.slack.success("ok", group="pdal-info/a")
+        self.slack.fail("broken", group="pdal-info/a")
+        self.assertTrue(self.client.posted.wait(5))
+        self.assertEqual(self.client.texts, ["{} broken".format(FAIL)])
+        self.slack.close()
+        self.assertEqual(self.client.texts[1],
+                         "{} 1 succeeded, 1 failed in `pdal-info/a`".format(
+                             FAIL))
+
+    def test_only_failures_have_no_digest(self):
+        self.slack.fail("one", group="pdal-info/a")
+        self.slack.fail("two", group="pdal-info/a")
+        self.slack.close()
+        self.assertEqual(self.client.texts, [
+            "{} one".format(FAIL), "{} two".format(FAIL)])
+
+    def test_digests_every_interval(self):
+        slack = Slack("token", client=self.client, digest_interval=0.05)
+        try:
+            slack.success("ok", group="pdal-info/a")
+            slack.success("ok", group="pdal-info/a")
+            self.assertTrue(self.client.posted.wait(5))
+            self.assertEqual(self.client.texts, [
+                "{} 2 succeeded in `pdal-info/a`".format(SUCCESS)])
+        finally:
+            slack.close()
+
+
+class DigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.slack = Slack("token", client=FakeClient())
+
+    def tearDown(self):
+        self.slack.close()
+
+    def test_lone_message(self):
+        self.assertEqual(self.slack.digest("g", [("info", "hello")]),
+                         "{} hello".format(INFO))
+
+    def test_only_failures(self):
+        self.assertIsNone(self.slack.digest("g", [("fail", "a")]))
+
+    def test_emoji_of_the_worst_kind(self):
+        self.assertEqual(
+            self.slack.digest("g", [("info", "a"), ("info", "b")]),
+            "{} 2 started in `g`".format(INFO))
+        self.assertEqual(
+            self.slack.digest("g", [("info", "a"), ("success", "b"),
+                                    ("fail", "c")]),
+            "{} 1 succeeded, 1 failed, 1 started in `g`".format(FAIL))
+
+
+class SendTest(unittest.TestCase):
+
+    def test_waits_out_rate_limits(self):
+        client = FakeClient([{"ok": False, "error": "ratelimited",
+                              "headers": {"Retry-After": "0"}}])
+        slack = Slack("token", client=client)
+        slack.info("hello")
+        slack.close()
+        self.assertEqual(client.texts, ["{} hello".format(INFO)] * 2)
+
+    def test_gives_up_on_other_errors(self):
+        client = FakeClient([{"ok": False, "error": "channel_not_found"}])
+        slack = Slack("token", client=client)
+        slack.info("hello")
+        slack.info("again")
+        start = time.time()
+        slack.close()
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(client.texts, ["{} hello".format(INFO),
+                                        "{} again".format(INFO)])
+
+
+if __name__ == "__main__":
+    unittest.main()
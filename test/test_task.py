@@ -0,0 +1,205 @@
+"""Tests for running tasks and skipping unchanged inputs, against the
+benchmark's stand-ins.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "docker"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import standins
+from magic_bucket import MagicBucket
+from magic_bucket.task import task as task_module
+from magic_bucket.task.task import Task
+
+BUCKET = "bucket"
+
+
+class CopyTask(Task):
+    """Copies its input to `<name>.out`, counting the copies."""
+
+    TOOLS = ["copy-tool"]
+    copies = 0
+
+    def __init__(self, magic_bucket, s3_object, setting="a"):
+        super(CopyTask, self).__init__(magic_bucket, s3_object)
+        self.setting = setting
+
+    def name(self):
+        return "copy"
+
+    def fingerprint_inputs(self):
+        return {"setting": self.setting}
+
+    def process(self, filename):
+        CopyTask.copies += 1
+        output = filename + ".out"
+        shutil.copyfile(filename, output)
+        return output
+
+
+class ConvertingTask(CopyTask):
+    """Converts its input before it is processed, as ape-near-field-prcs
+    does, remembering what was processed.
+    """
+
+    processed = []
+
+    def prepare_input(self, filename):
+        converted = filename + ".converted"
+        os.rename(filename, converted)
+        return converted
+
+    def process(self, filename):
+        ConvertingTask.processed.append(os.path.basename(filename))
+        return super(ConvertingTask, self).process(filename)
+
+
+class TaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "s3"))
+        self.work_root = os.path.join(self.directory, "work")
+        os.mkdir(self.work_root)
+        self.s3 = standins.S3(os.path.join(self.directory, "s3"))
+        self.magic_bucket = MagicBucket(
+            "us-east-1", "queue-url", s3=self.s3,
+            sqs_queue=standins.Queue())
+        task_module._tool_versions["copy-tool"] = "1"
+        CopyTask.copies = 0
+
+    def tearDown(self):
+        task_module._tool_versions.pop("copy-tool", None)
+        shutil.rmtree(self.directory)
+
+    def run_task(self, key="copy/dir/scan.las", setting="a",
+                 task_class=CopyTask):
+        task = task_class(self.magic_bucket,
+                          self.magic_bucket.s3_object(BUCKET, key), setting)
+        task.work_root = self.work_root
+        output = task.run()
+        self.assertEqual([], os.listdir(self.work_root))
+        return task, output
+
+    def test_uploads_output_and_manifest(self):
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"points")
+        task, output = self.run_task()
+        self.assertFalse(task.cache_hit)
+        self.assertEqual("copy/dir/output/scan.las.out", output.key)
+        manifest = self.magic_bucket.get_json(
+            BUCKET, "copy/dir/output/scan.las.manifest.json")
+        self.assertEqual({"fingerprint": task.current_fingerprint,
+                          "input": "copy/dir/scan.las",
+                          "output": "copy/dir/output/scan.las.out"},
+                         manifest)
+        self.assertEqual(
+            task.current_fingerprint,
+            output.metadata[Task.FINGERPRINT_METADATA])
+
+    def test_skips_unchanged_inputs(self):
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"points")
+        self.run_task()
+        task, output = self.run_task()
+        self.assertTrue(task.cache_hit)
+        self.assertEqual("copy/dir/output/scan.las.out", output.key)
+        self.assertEqual(1, CopyTask.copies)
+
+    def test_reruns_changed_inputs(self):
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"points")
+        self.run_task()
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"other points")
+        task, _ = self.run_task()
+        self.assertFalse(task.cache_hit)
+        self.assertEqual(2, CopyTask.copies)
+
+    def test_reruns_changed_configuration(self):
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"points")
+        self.run_task(setting="a")
+        task, _ = self.run_task(setting="b")
+        self.assertFalse(task.cache_hit)
+
+    def test_reruns_changed_tools(self):
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"points")
+        self.run_task()
+        task_module._tool_versions["copy-tool"] = "2"
+        task, _ = self.run_task()
+        self.assertFalse(task.cache_hit)
+
+    def test_reruns_when_the_output_lost_its_metadata(self):
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"points")
+        self.run_task()
+        self.s3.put(BUCKET, "copy/dir/output/scan.las.out", body=b"points")
+        task, _ = self.run_task()
+        self.assertFalse(task.cache_hit)
+
+    def test_reruns_when_the_output_is_missing(self):
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"points")
+        self.run_task()
+        del self.s3.objects[(BUCKET, "copy/dir/output/scan.las.out")]
+        task, _ = self.run_task()
+        self.assertFalse(task.cache_hit)
+
+    def test_archive_members(self):
+        archive = os.path.join(self.directory, "survey.zip")
+        with zipfile.ZipFile(archive, "w") as f:
+            f.writestr("east/scan.las", b"east")
+            f.writestr("west/scan.las", b"west")
+        self.s3.put(BUCKET, "copy/dir/survey.zip", filename=archive)
+        _, outputs = self.run_task("copy/dir/survey.zip")
+        self.assertEqual(["copy/dir/output/east/scan.las.out",
+                          "copy/dir/output/west/scan.las.out"],
+                         [output.key for output in outputs])
+        for member in ("east", "west"):
+            manifest = self.magic_bucket.get_json(
+                BUCKET, "copy/dir/output/{}/survey.zip.scan.las."
+                "manifest.json".format(member))
+            self.assertEqual("copy/dir/output/{}/scan.las.out".format(
+                member), manifest["output"])
+        self.run_task("copy/dir/survey.zip")
+        self.assertEqual(2, CopyTask.copies)
+
+    def test_archive_with_one_point_cloud(self):
+        archive = os.path.join(self.directory, "scan.las.zip")
+        with zipfile.ZipFile(archive, "w") as f:
+            f.writestr("survey/scan.las", b"points")
+            f.writestr("survey/scan.prj", b"PROJCS")
+            f.writestr("readme.txt", b"read me")
+        self.s3.put(BUCKET, "copy/dir/scan.las.zip", filename=archive)
+        task, output = self.run_task("copy/dir/scan.las.zip")
+        self.assertEqual([], task.members)
+        self.assertEqual("copy/dir/output/scan.las.out", output.key)
+        self.assertEqual(1, CopyTask.copies)
+
+    def test_inputs_are_prepared_outside_the_process_phase(self):
+        archive = os.path.join(self.directory, "survey.zip")
+        with zipfile.ZipFile(archive, "w") as f:
+            f.writestr("east/scan.las", b"east")
+            f.writestr("west/scan.las", b"west")
+        self.s3.put(BUCKET, "copy/dir/survey.zip", filename=archive)
+        self.s3.put(BUCKET, "copy/dir/scan.las", body=b"points")
+        ConvertingTask.processed = []
+        self.run_task(task_class=ConvertingTask)
+        self.run_task("copy/dir/survey.zip", task_class=ConvertingTask)
+        self.assertEqual(["scan.las.converted"] * 3,
+                         ConvertingTask.processed)
+
+    def test_member_keys_stay_in_the_output_directory(self):
+        task = CopyTask(self.magic_bucket, self.magic_bucket.s3_object(
+            BUCKET, "copy/dir/survey.zip"))
+        task.member = "/../a/./b/scan.las"
+        self.assertEqual("copy/dir/output/a/b/scan.las.out",
+                         task.output_key("/tmp/work/scan.las.out"))
+        self.assertEqual(
+            "copy/dir/output/a/b/survey.zip.scan.las.manifest.json",
+            task.manifest_key())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,281 @@
+"""Tests for the worker's pipeline and sqs bookkeeping, against the
+benchmark's stand-ins.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "docker"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import standins
+from magic_bucket import MagicBucket, Slack
+from magic_bucket.exceptions import MagicBucketException
+from magic_bucket.messages import InFlightMessages
+from magic_bucket.registry import registry
+from magic_bucket.task import TASK_CLASSES
+from magic_bucket.task.task import Task
+from magic_bucket.worker import Job, JobGroup, Worker
+
+BUCKET = "bucket"
+GB = 1024 * 1024 * 1024
+
+
+class CopyTask(Task):
+    """Copies its input to `<name>.out`, failing on inputs named `bad*`
+    and crashing on inputs named `crash*`.
+    """
+
+    NAME = "copy"
+
+    def name(self):
+        return self.NAME
+
+    def process(self, filename):
+        basename = os.path.basename(filename)
+        if basename.startswith("bad"):
+            raise MagicBucketException("bad input")
+        if basename.startswith("crash"):
+            raise RuntimeError("crash")
+        output = filename + ".out"
+        shutil.copyfile(filename, output)
+        return output
+
+
+class SlackClient(object):
+    """Records posted messages."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.texts = []
+
+    def api_call(self, method, channel=None, text=None, username=None):
+        with self.lock:
+            self.texts.append(text)
+        return {"ok": True}
+
+
+class ListSink(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def emit(self, record):
+        with self.lock:
+            self.records.append(record)
+
+
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "s3"))
+        self.work_root = os.path.join(self.directory, "work")
+        os.mkdir(self.work_root)
+        self.s3 = standins.S3(os.path.join(self.directory, "s3"))
+        self.queue = standins.Queue(max_wait=0)
+        self.magic_bucket = MagicBucket(
+            "us-east-1", self.queue.url, s3=self.s3, sqs_queue=self.queue)
+        self.client = SlackClient()
+        self.sink = ListSink()
+        TASK_CLASSES[CopyTask.NAME] = CopyTask
+        registry().tasks[CopyTask.NAME] = {}
+
+    def tearDown(self):
+        TASK_CLASSES.pop(CopyTask.NAME)
+        registry().tasks.pop(CopyTask.NAME)
+        self.magic_bucket.stop_consuming()
+        shutil.rmtree(self.directory)
+
+    def put(self, key, body=b"points", filename=None):
+        self.s3.put(BUCKET, key, body=body, filename=filename)
+        self.queue.send(json.dumps({"s3": {"bucket": {"name": BUCKET},
+                                           "object": {"key": key}}}))
+
+    def run_worker(self, **kwargs):
+        settings = {"work_root": self.work_root, "metrics_sink": self.sink,
+                    "disk_budget": GB, "memory_budget": GB}
+        settings.update(kwargs)
+        worker = Worker(self.magic_bucket,
+                        Slack("token", client=self.client), **settings)
+        try:
+            return worker, worker.run()
+        finally:
+            worker.slack.close()
+
+    def exists(self, key):
+        return (BUCKET, key) in self.s3.objects
+
+    def test_runs_jobs_through_the_stages(self):
+        for i in range(3):
+            self.put("copy/dir/scan_{}.las".format(i))
+        worker, utilization = self.run_worker(concurrency=2,
+                                              download_concurrency=2,
+                                              upload_concurrency=2)
+        self.assertEqual(["download", "process", "upload"],
+                         sorted(utilization))
+        for i in range(3):
+            self.assertTrue(self.exists(
+                "copy/dir/output/scan_{}.las.out".format(i)))
+        self.assertEqual({}, self.queue.messages)
+        self.assertEqual([], os.listdir(self.work_root))
+        self.assertEqual(0, worker.admission.disk_used)
+        self.assertEqual(["succeeded"] * 3,
+                         [record["status"] for record in self.sink.records
+                          if "status" in record])
+
+    def test_archive_members_share_the_message(self):
+        archive = os.path.join(self.directory, "survey.zip")
+        with zipfile.ZipFile(archive, "w") as f:
+            f.writestr("east/scan.las", b"east")
+            f.writestr("west/scan.las", b"west")
+        self.put("copy/dir/survey.zip", filename=archive)
+        self.run_worker()
+        self.assertTrue(self.exists("copy/dir/output/east/scan.las.out"))
+        self.assertTrue(self.exists("copy/dir/output/west/scan.las.out"))
+        self.assertEqual({}, self.queue.messages)
+        self.assertEqual([2], [record["members"]
+                               for record in self.sink.records
+                               if "members" in record])
+        self.assertEqual([], os.listdir(self.work_root))
+
+    def test_failures_are_reported_and_deleted(self):
+        self.put("copy/dir/bad.las")
+        self.put("copy/dir/good.las")
+        self.run_worker()
+        self.assertFalse(self.exists("copy/dir/output/bad.las.out"))
+        self.assertTrue(self.exists("copy/dir/output/good.las.out"))
+        self.assertEqual({}, self.queue.messages)
+        self.assertTrue(any("bad input" in text
+                            for text in self.client.texts))
+        self.assertEqual([], os.listdir(self.work_root))
+
+    def test_unknown_tasks_are_reported_and_deleted(self):
+        self.put("unknown/dir/scan.las")
+        self.run_worker()
+        self.assertEqual({}, self.queue.messages)
+        self.assertTrue(any("Unknown task: *unknown*" in text
+                            for text in self.client.texts))
+
+    def test_defers_jobs_that_do_not_fit(self):
+        self.put("copy/dir/scan.las")
+        self.run_worker(disk_budget=1, defer_seconds=60)
+        self.assertFalse(self.exists("copy/dir/output/scan.las.out"))
+        self.assertEqual((0, 1), self.queue.counts())
+        self.assertTrue(any(text.endswith("more than this worker has")
+                            for text in self.client.texts))
+
+    def test_gives_up_after_max_receives(self):
+        self.put("copy/dir/scan.las")
+        self.queue.messages["0"].attributes["ApproximateReceiveCount"] = "2"
+        self.run_worker(max_receives=2)
+        self.assertFalse(self.exists("copy/dir/output/scan.las.out"))
+        self.assertEqual({}, self.queue.messages)
+        self.assertTrue(any("Giving up on `copy/dir/scan.las` after 2 "
+                            "attempts" in text
+                            for text in self.client.texts))
+
+    def test_unhandled_exceptions_abandon_the_job(self):
+        self.put("copy/dir/crash.las")
+        with self.assertRaises(RuntimeError):
+            self.run_worker()
+        self.assertEqual((1, 0), self.queue.counts())
+        self.assertEqual(["abandoned"],
+                         [record["status"] for record in self.sink.records
+                          if "status" in record])
+        self.assertEqual([], os.listdir(self.work_root))
+
+    def test_unhandled_exceptions_stop_consuming(self):
+        self.put("copy/dir/crash.las")
+        for i in range(30):
+            self.put("copy/dir/scan_{}.las".format(i))
+        with self.assertRaises(RuntimeError):
+            self.run_worker()
+        self.assertEqual("error", self.magic_bucket.exit_cause)
+        visible, in_flight = self.queue.counts()
+        self.assertEqual(0, in_flight)
+        self.assertGreater(visible, 1)
+        self.assertEqual([], os.listdir(self.work_root))
+
+
+class JobGroupTest(unittest.TestCase):
+
+    def test_counts_down(self):
+        group = JobGroup(Job(None), 3)
+        self.assertFalse(group.done(True))
+        self.assertFalse(group.done(True))
+        self.assertTrue(group.done(True))
+        self.assertTrue(group.handled)
+
+    def test_one_abandoned_member_abandons_the_group(self):
+        group = JobGroup(Job(None), 2)
+        self.assertFalse(group.done(False))
+        self.assertTrue(group.done(True))
+        self.assertFalse(group.handled)
+
+
+class InFlightMessagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = standins.Queue(max_wait=0)
+        for i in range(3):
+            self.queue.send("message {}".format(i))
+        self.in_flight = InFlightMessages(self.queue, visibility_timeout=60)
+
+    def tearDown(self):
+        self.in_flight.stop()
+
+    def receive(self, visibility_timeout=60):
+        messages = self.queue.receive_messages(
+            MaxNumberOfMessages=10, VisibilityTimeout=visibility_timeout)
+        for message in messages:
+            self.in_flight.add(message)
+        return messages
+
+    def test_finished_messages_are_deleted_on_flush(self):
+        messages = self.receive()
+        self.in_flight.finish(messages[0])
+        self.assertEqual(2, self.in_flight.count())
+        self.assertEqual(3, len(self.queue.messages))
+        self.in_flight.flush()
+        self.assertEqual(["1", "2"], sorted(self.queue.messages))
+
+    def test_release(self):
+        messages = self.receive()
+        self.in_flight.release(messages[0])
+        self.in_flight.release(messages[1], 60)
+        self.assertEqual(1, self.in_flight.count())
+        self.assertEqual((1, 2), self.queue.counts())
+
+    def test_stop_releases_messages_in_flight(self):
+        messages = self.receive()
+        self.in_flight.finish(messages[0])
+        self.in_flight.stop()
+        self.assertEqual(0, self.in_flight.count())
+        self.assertEqual((2, 0), self.queue.counts())
+
+    def test_heartbeat_keeps_messages_invisible(self):
+        in_flight = InFlightMessages(self.queue, visibility_timeout=0.3)
+        try:
+            for message in self.queue.receive_messages(
+                    MaxNumberOfMessages=10, VisibilityTimeout=0.3):
+                in_flight.add(message)
+            in_flight.start()
+            time.sleep(0.6)
+            self.assertEqual((0, 3), self.queue.counts())
+        finally:
+            in_flight.stop()
+        self.assertEqual((3, 0), self.queue.counts())
+
+
+if __name__ == "__main__":
+    unittest.main()